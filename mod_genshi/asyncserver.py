@@ -0,0 +1,684 @@
+"""Event driven HTTP/1.1 server for WSGI applications.
+
+The AsyncWSGIServer class reads requests from many connections at once using
+non-blocking sockets and a select loop. Connections are kept alive between
+requests, and pipelined requests are answered in order.
+
+Applications are called from a fixed pool of threads, so that slow requests
+do not hold up the event loop. Requests accepted by the inline function are
+instead called from the event loop, with the response body sent as the socket
+becomes writable. This suits responses that are read from files, such as
+static files, which do not need to wait for a thread.
+"""
+from cStringIO import StringIO
+from email.utils import formatdate
+import collections
+import errno
+import fcntl
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib
+
+from mod_genshi.static import FileWrapper, HAVE_SENDFILE, sendfile
+from mod_genshi.version import __version__
+
+__all__ = ['AsyncWSGIServer']
+
+# largest request line and headers accepted
+MAX_HEADER_SIZE = 64 * 1024
+
+# largest request body accepted
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# size of reads from sockets
+RECV_SIZE = 64 * 1024
+
+# bytes of response output buffered for a connection above which threads
+# streaming a response wait for the client to read
+HIGH_WATER = 256 * 1024
+
+# statuses of responses that never have a body
+NO_BODY = ('1', '204', '304')
+
+AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def parse_request(head):
+    """Parse the request line and headers of a HTTP request.
+
+    Returns method, target, version and a list of header name and value
+    pairs. Raises ValueError if the request is malformed.
+    """
+    lines = head.split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/1.'):
+        raise ValueError("Unsupported version '{0}'".format(version))
+    headers = []
+    for line in lines[1:]:
+        if line[:1] in (' ', '\t') and headers:
+            name, value = headers.pop()
+            headers.append((name, value + ' ' + line.strip()))
+            continue
+        name, value = line.split(':', 1)
+        headers.append((name.strip(), value.strip()))
+    return method, target, version, headers
+
+
+class Connection(object):
+    """Client connection to an AsyncWSGIServer.
+
+    Requests are handled one at a time. Received data is buffered until the
+    current response is complete, then parsed as the next request.
+
+    Output written by threads is counted from when it is scheduled until it
+    is sent, so that a thread streaming a response can wait for the client
+    to read it in reserve.
+    """
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.socket = sock
+        self.address = address
+        self.received = ''
+        self.output = collections.deque()
+        self.buffered = 0
+        self.scheduled = 0
+        self.drained = threading.Condition()
+        self.body = None
+        self.file = None
+        self.offset = 0
+        self.remaining = 0
+        self.result = None
+        self.busy = False
+        self.closing = False
+        self.closed = False
+        self.keep_alive = False
+        self.chunked = False
+        self.head = False
+        self.version = None
+        self.active = time.time()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    @property
+    def readable(self):
+        return not (self.busy or self.closing)
+
+    @property
+    def writable(self):
+        return bool(self.output) or self.body is not None or \
+            self.file is not None
+
+    def read(self):
+        "Receive data from the client"
+        try:
+            data = self.socket.recv(RECV_SIZE)
+        except socket.error as err:
+            if err.args[0] in AGAIN:
+                return
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self.active = time.time()
+        self.received += data
+        self.process()
+
+    def flush(self):
+        "Send buffered output, then more of the response body"
+        while self.writable:
+            if not self.output:
+                if self.file is None:
+                    self._next_chunk()
+                elif not self._send_file():
+                    return
+                continue
+            data = self.output[0]
+            try:
+                sent = self.socket.send(data)
+            except socket.error as err:
+                if err.args[0] in AGAIN:
+                    return
+                self.close()
+                return
+            self.active = time.time()
+            self._sent(sent)
+            if sent < len(data):
+                self.output[0] = data[sent:]
+                return
+            self.output.popleft()
+        if self.closing and not self.busy:
+            self.close()
+
+    def _queue(self, data):
+        self.output.append(data)
+        self.buffered += len(data)
+
+    def _sent(self, size):
+        "Count output sent, waking a thread waiting in reserve"
+        self.buffered -= size
+        if self.buffered + self.scheduled < HIGH_WATER:
+            with self.drained:
+                self.drained.notify_all()
+
+    def reserve(self, size):
+        """Wait until the output buffered is below HIGH_WATER, then count
+        size bytes about to be written, from a thread.
+
+        Returns False if the connection was closed meanwhile.
+        """
+        with self.drained:
+            while not self.closed and \
+                    self.buffered + self.scheduled >= HIGH_WATER:
+                self.drained.wait()
+            self.scheduled += size
+        return not self.closed
+
+    def send_file(self, wrapper):
+        "Send the response body from a FileWrapper using sendfile"
+        self.file = wrapper
+        self.offset = wrapper.offset
+        self.remaining = wrapper.length
+        if not self.remaining:
+            self.file = None
+            self.finish()
+
+    def _send_file(self):
+        "Send part of a file, returning False if the socket is not writable"
+        try:
+            sent = sendfile(self.fileno(), self.file.fileno(), self.offset,
+                            self.remaining)
+        except OSError as err:
+            if err.errno in AGAIN:
+                return False
+            self.close()
+            return False
+        if not sent:
+            self.close()
+            return False
+        self.active = time.time()
+        self.offset += sent
+        self.remaining -= sent
+        if not self.remaining:
+            self.file = None
+            self.finish()
+        return True
+
+    def _next_chunk(self):
+        try:
+            chunk = self.body.next()
+        except StopIteration:
+            self.body = None
+            self.finish()
+        except Exception:
+            self.body = None
+            self.server.log_error(self.address)
+            self.close()
+        else:
+            self.write(chunk)
+
+    def _error(self, status):
+        "Send an error response, then close the connection"
+        self._queue(
+            'HTTP/1.1 {0}\r\nContent-Length: 0\r\n'
+            'Connection: close\r\n\r\n'.format(status))
+        self.closing = True
+        self.received = ''
+
+    def process(self):
+        "Start handling the next request, if it has been received"
+        if self.busy or self.closing or self.closed:
+            return
+        self.received = self.received.lstrip('\r\n')
+        end = self.received.find('\r\n\r\n')
+        if end < 0:
+            if len(self.received) > MAX_HEADER_SIZE:
+                self._error('431 Request Header Fields Too Large')
+            return
+        try:
+            method, target, version, headers = \
+                parse_request(self.received[:end])
+            environ = self.server.environ(self, method, target, version,
+                                          headers)
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self._error('400 Bad Request')
+            return
+        if length < 0:
+            self._error('400 Bad Request')
+            return
+        if length > MAX_BODY_SIZE:
+            self._error('413 Payload Too Large')
+            return
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', ''):
+            self._error('411 Length Required')
+            return
+        start = end + 4
+        if len(self.received) - start < length:
+            if environ.get('HTTP_EXPECT', '').lower() == '100-continue' \
+                    and len(self.received) == start:
+                self._queue('HTTP/1.1 100 Continue\r\n\r\n')
+            return
+        environ['wsgi.input'] = StringIO(
+            self.received[start:start + length])
+        self.received = self.received[start + length:]
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        self.version = version
+        if version == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in connection
+        else:
+            self.keep_alive = 'close' not in connection
+        self.head = method == 'HEAD'
+        self.busy = True
+        self.server.dispatch(self, environ)
+
+    def start(self, status, headers):
+        "Queue the status line and headers of a response"
+        names = set(name.lower() for name, value in headers)
+        for name, value in headers:
+            if name.lower() == 'connection' and 'close' in value.lower():
+                self.keep_alive = False
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'connection']
+        self.chunked = False
+        if self.head or status.startswith(NO_BODY):
+            self.head = True
+        elif 'content-length' in names:
+            pass
+        elif self.keep_alive and self.version != 'HTTP/1.0':
+            self.chunked = True
+            headers.append(('Transfer-Encoding', 'chunked'))
+        else:
+            self.keep_alive = False
+        headers.append(('Connection',
+                        'keep-alive' if self.keep_alive else 'close'))
+        if 'date' not in names:
+            headers.append(('Date', formatdate(usegmt=True)))
+        if 'server' not in names:
+            headers.append(('Server', self.server.software))
+        lines = ['HTTP/1.1 ' + status]
+        lines.extend(name + ': ' + value for name, value in headers)
+        lines.append('\r\n')
+        self._queue('\r\n'.join(lines))
+
+    def write(self, chunk, reserved=0):
+        """Queue part of the response body, with the number of bytes
+        reserved for it by a thread"""
+        if reserved:
+            with self.drained:
+                self.scheduled -= reserved
+        if self.closed or not chunk or self.head:
+            return
+        if self.chunked:
+            self._queue('{0:x}\r\n'.format(len(chunk)))
+            self._queue(chunk)
+            self._queue('\r\n')
+        else:
+            self._queue(chunk)
+
+    def finish(self):
+        "Complete the response, then handle the next request"
+        if self.closed:
+            return
+        if self.chunked:
+            self._queue('0\r\n\r\n')
+        self._close_result()
+        self.busy = False
+        if self.keep_alive:
+            self.process()
+        else:
+            self.closing = True
+
+    def _close_result(self):
+        result, self.result = self.result, None
+        if hasattr(result, 'close'):
+            try:
+                result.close()
+            except Exception:
+                self.server.log_error(self.address)
+
+    def close(self):
+        "Close the connection, abandoning any response in progress"
+        if self.closed:
+            return
+        self.closed = True
+        self.body = None
+        self.file = None
+        with self.drained:
+            self.drained.notify_all()
+        self.server.remove(self)
+        if not self.busy:
+            self._close_result()
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class AsyncWSGIServer(object):
+    """HTTP/1.1 server calling a WSGI application from a pool of threads.
+
+    The server listens on address, a host and port pair. Requests are handled
+    by at most threads application calls at a time. The inline function is
+    called with the environ of each request, and returns True if the
+    application should instead be called from the event loop. Idle
+    connections are closed after keep_alive seconds.
+
+    The server can be used in place of the wsgiref servers, providing the
+    serve_forever, handle_request and server_close methods. The threads are
+    started when the first request is received, as threads are not copied
+    to forked processes.
+    """
+
+    software = 'mod_genshi/' + __version__
+
+    # used for handle_request
+    timeout = None
+
+    multiprocess = False
+
+    def __init__(self, address, application, threads=8, inline=None,
+                 keep_alive=15.0, backlog=128):
+        self.application = application
+        self.threads = threads
+        self.inline = inline
+        self.keep_alive = keep_alive
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(backlog)
+        self.socket.setblocking(False)
+        host, self.server_port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.connections = {}
+        self._calls = collections.deque()
+        self._wakeup = None
+        self._requests = Queue.Queue()
+        self._pool = None
+        self._running = False
+
+    def environ(self, connection, method, target, version, headers):
+        "Create the WSGI environ for a request"
+        if '://' in target:
+            target = '/' + target.split('://', 1)[1].partition('/')[2]
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': str(self.server_port),
+            'SERVER_PROTOCOL': version,
+            'SERVER_SOFTWARE': self.software,
+            'REMOTE_ADDR': connection.address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.multiprocess,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+        return environ
+
+    def call_soon(self, function, *args):
+        "Call function from the event loop, from any thread"
+        self._calls.append((function, args))
+        if self._wakeup is None:
+            return
+        try:
+            os.write(self._wakeup[1], '\0')
+        except OSError:
+            pass
+
+    def _run_calls(self):
+        if self._wakeup is not None:
+            try:
+                os.read(self._wakeup[0], 4096)
+            except OSError:
+                pass
+        while self._calls:
+            function, args = self._calls.popleft()
+            function(*args)
+
+    def _start_response(self, response):
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            response[:] = [status, headers]
+            return response.append
+        return start_response
+
+    def _call(self, environ):
+        """Call the application, returning the result and a list of the
+        status, headers and chunks passed to write.
+
+        The list is filled in when start_response is called, which a
+        generator may only do once iterated.
+        """
+        response = []
+        result = self.application(environ, self._start_response(response))
+        return result, response
+
+    def dispatch(self, connection, environ):
+        "Call the application for a request from a connection"
+        if self.inline is not None and self.inline(environ):
+            self._call_inline(connection, environ)
+            return
+        if self._pool is None:
+            self._start()
+        self._requests.put((connection, environ))
+
+    def _call_inline(self, connection, environ):
+        result = None
+        try:
+            result, response = self._call(environ)
+            if isinstance(result, FileWrapper) and HAVE_SENDFILE and \
+                    len(response) == 2:
+                connection.result = result
+                connection.start(*response)
+                if connection.head:
+                    connection.finish()
+                elif connection.chunked:
+                    connection.body = iter(result)
+                else:
+                    connection.send_file(result)
+                return
+            body = iter(result)
+            for chunk in body:
+                if chunk or response:
+                    break
+            else:
+                chunk = ''
+        except Exception:
+            self.log_error(connection.address)
+            if hasattr(result, 'close'):
+                result.close()
+            self._fail(connection)
+            return
+        connection.result = result
+        connection.start(*response[:2])
+        for data in response[2:]:
+            connection.write(data)
+        connection.write(chunk)
+        connection.body = body
+
+    def _start(self):
+        "Start the pool of threads, and the pipe they use to wake the loop"
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._pool = []
+        for index in range(self.threads):
+            thread = threading.Thread(target=self._handle_requests,
+                                      name='mod_genshi.asyncserver')
+            thread.daemon = True
+            thread.start()
+            self._pool.append(thread)
+
+    def _handle_requests(self):
+        "Call the application for queued requests"
+        while True:
+            queued = self._requests.get()
+            if queued is None:
+                break
+            connection, environ = queued
+            self._respond(connection, environ)
+
+    def _respond(self, connection, environ):
+        """Call the application from a thread, sending output to the loop.
+
+        The result is iterated only as fast as the client reads it, and no
+        further once the connection is closed.
+        """
+        started = False
+        result = None
+        try:
+            result, response = self._call(environ)
+            for chunk in result:
+                if not started and (chunk or response):
+                    self.call_soon(connection.start, *response[:2])
+                    for data in response[2:]:
+                        self.call_soon(connection.write, data)
+                    started = True
+                if not connection.reserve(len(chunk)):
+                    break
+                self.call_soon(connection.write, chunk, len(chunk))
+            if not started:
+                self.call_soon(connection.start, *response[:2])
+                for data in response[2:]:
+                    self.call_soon(connection.write, data)
+            self.call_soon(connection.finish)
+        except Exception:
+            self.log_error(connection.address)
+            if started:
+                self.call_soon(connection.close)
+            else:
+                self.call_soon(self._fail, connection)
+        finally:
+            if hasattr(result, 'close'):
+                try:
+                    result.close()
+                except Exception:
+                    self.log_error(connection.address)
+
+    def _fail(self, connection):
+        connection._error('500 Internal Server Error')
+        connection.busy = False
+
+    def log_error(self, address):
+        "Report an exception raised while handling a request"
+        sys.stderr.write("Error handling request from {0}\n".format(
+            address[0]))
+        traceback.print_exc(file=sys.stderr)
+
+    def _accept(self):
+        for index in range(64):
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as err:
+                if err.args[0] in AGAIN + (errno.ECONNABORTED,):
+                    return
+                raise
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(self, sock, address)
+            self.connections[connection.fileno()] = connection
+
+    def remove(self, connection):
+        "Stop handling a closed connection"
+        self.connections.pop(connection.fileno(), None)
+
+    def _close_idle(self):
+        expired = time.time() - self.keep_alive
+        for connection in self.connections.values():
+            if not connection.busy and not connection.writable and \
+                    connection.active < expired:
+                connection.close()
+
+    def handle_request(self, timeout=None, accept=True):
+        "Wait for and handle events on the listening socket and connections"
+        if timeout is None:
+            timeout = self.timeout
+        readable = []
+        if self._wakeup is not None:
+            readable.append(self._wakeup[0])
+        if accept:
+            readable.append(self.socket)
+        writable = []
+        for connection in self.connections.values():
+            if connection.readable:
+                readable.append(connection)
+            if connection.writable:
+                writable.append(connection)
+        readable = select.select(readable, writable, [], timeout)[0]
+        for item in readable:
+            if item is self.socket:
+                self._accept()
+            elif not isinstance(item, Connection):
+                self._run_calls()
+            elif not item.closed:
+                item.read()
+        self._run_calls()
+        for connection in self.connections.values():
+            if connection.writable:
+                connection.flush()
+        self._close_idle()
+
+    def serve_forever(self, poll_interval=0.5):
+        "Handle requests until shutdown is called"
+        self._running = True
+        while self._running:
+            try:
+                self.handle_request(poll_interval)
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+
+    def shutdown(self):
+        "Stop serve_forever, from any thread"
+        self._running = False
+        self.call_soon(lambda: None)
+
+    def server_close(self, grace=10.0):
+        """Stop accepting connections, then complete requests in progress
+        for up to grace seconds before closing every connection."""
+        self.socket.close()
+        deadline = time.time() + grace
+        while time.time() < deadline and any(
+                connection.busy or connection.writable
+                for connection in self.connections.values()):
+            try:
+                self.handle_request(0.1, accept=False)
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+        for connection in self.connections.values():
+            connection.close()
+        if self._pool is None:
+            return
+        for thread in self._pool:
+            self._requests.put(None)
+        for thread in self._pool:
+            thread.join()
+        self._pool = None
+        for fd in self._wakeup:
+            os.close(fd)
+        self._wakeup = None
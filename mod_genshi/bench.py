@@ -0,0 +1,305 @@
+"""Benchmarks of the mod_genshi WSGI application.
+
+Runs scenarios against a copy of a fixture tree, by default the benchmarks
+directory installed with the package. Each scenario requests one path repeatedly,
+either by calling the WSGI application in-process, or over loopback HTTP
+through one of the servers of the mod_genshi.server module. Scenarios cover
+markup and text templates of different sizes, static files, forbidden and
+missing paths, and reload storms touching templates and modules between
+requests.
+
+Results are written as JSON, with the requests per second, latency
+percentiles, peak resident memory and the number of objects left allocated
+after each scenario. Results may be saved and compared with a later run:
+
+    python -m mod_genshi.bench -o baseline.json
+    python -m mod_genshi.bench --compare baseline.json
+
+The exit status is 1 if a scenario is slower than the baseline by more than
+the threshold.
+"""
+from collections import namedtuple
+from timeit import default_timer
+from wsgiref.simple_server import make_server
+from wsgiref.util import setup_testing_defaults
+import gc
+import httplib
+import json
+import optparse
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+
+from mod_genshi import importer
+from mod_genshi.asyncserver import AsyncWSGIServer
+from mod_genshi.server import RequestHandler, ThreadPoolWSGIServer
+from mod_genshi.wsgi import WSGI
+
+__all__ = ['Scenario', 'SCENARIOS', 'run', 'compare']
+
+# request path, expected status code, and files touched every touch_every
+# requests, relative to the fixture tree
+Scenario = namedtuple('Scenario', 'name path status touch')
+
+SCENARIOS = (
+    Scenario('markup-small', '/templates/small.html', 200, ()),
+    Scenario('markup-large', '/templates/large.html', 200, ()),
+    Scenario('text-small', '/templates/small.txt', 200, ()),
+    Scenario('text-large', '/templates/large.txt', 200, ()),
+    Scenario('static', '/static/logo.png', 200, ()),
+    Scenario('forbidden', '/templates/small.html.bak', 403, ()),
+    Scenario('not-found', '/templates/missing.html', 404, ()),
+    Scenario('reload-storm', '/templates/reload.html', 200,
+             ('benchapp/rows.py', 'templates/reload.html')),
+)
+
+SERVERS = ('async', 'threads', 'wsgiref')
+
+# default fixture tree, installed as package data. Its modules are in a
+# package named benchapp, so that they do not clash with the modules of
+# other applications imported in the same process.
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+
+class QuietRequestHandler(RequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def wsgi_client(app):
+    "Return a function calling app in-process, returning the status code"
+    def request(path):
+        environ = {'PATH_INFO': path}
+        setup_testing_defaults(environ)
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started.append(status)
+            return lambda data: None
+
+        result = app(environ, start_response)
+        try:
+            for chunk in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return int(started[0].split(None, 1)[0])
+    return request
+
+
+def http_client(port):
+    """Return a function requesting paths from a server over loopback,
+    reusing the connection when the server keeps it alive"""
+    connections = []
+
+    def request(path):
+        if not connections:
+            connections.append(httplib.HTTPConnection('127.0.0.1', port,
+                                                      timeout=30))
+        connection = connections[0]
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        if response.will_close:
+            connection.close()
+            connections.pop()
+        return response.status
+    return request
+
+
+def serve(app, server, threads=8):
+    "Start serving app on a loopback port, returning the server"
+    if server == 'async':
+        httpd = AsyncWSGIServer(('127.0.0.1', 0), app, threads=threads,
+                                inline=app.is_static)
+    elif server == 'threads':
+        httpd = make_server('127.0.0.1', 0, app,
+                            server_class=ThreadPoolWSGIServer,
+                            handler_class=QuietRequestHandler)
+        httpd.threads = threads
+    else:
+        httpd = make_server('127.0.0.1', 0, app,
+                            handler_class=QuietRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+
+def percentile(ordered, fraction):
+    "Return the nearest rank percentile of a sorted list"
+    if not ordered:
+        return None
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def run_scenario(request, base, scenario, requests, warmup, touch_every=10):
+    "Run a scenario, returning a dictionary of results"
+    touched = [os.path.join(base, path) for path in scenario.touch]
+    mtimes = [os.path.getmtime(path) for path in touched]
+    for index in range(warmup):
+        request(scenario.path)
+    gc.collect()
+    objects = len(gc.get_objects())
+    latencies = []
+    errors = 0
+    started = default_timer()
+    for index in range(requests):
+        if touched and index % touch_every == 0:
+            for pathname, mtime in zip(touched, mtimes):
+                mtime += index + 1
+                os.utime(pathname, (mtime, mtime))
+        before = default_timer()
+        status = request(scenario.path)
+        latencies.append(default_timer() - before)
+        if status != scenario.status:
+            errors += 1
+    elapsed = default_timer() - started
+    gc.collect()
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed if elapsed else None,
+        'latency_ms': dict(
+            (name, percentile(latencies, fraction) * 1000)
+            for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                   ('p99', 0.99), ('max', 1.0))),
+        'retained_objects': len(gc.get_objects()) - objects,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run(base=BASE, scenarios=SCENARIOS, modes=('wsgi', 'http'),
+        server='async', requests=1000, warmup=100):
+    """Run scenarios against a copy of the fixture tree in base.
+
+    Returns a dictionary of results by mode and scenario name.
+    """
+    tempdir = tempfile.mkdtemp(prefix='mod_genshi-bench-')
+    copy = os.path.join(tempdir, 'app')
+    shutil.copytree(base, copy)
+    app = WSGI(copy)
+    httpd = None
+    results = {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'server': server,
+        'results': {},
+    }
+    try:
+        for mode in modes:
+            if mode == 'wsgi':
+                request = wsgi_client(app)
+            else:
+                httpd = serve(app, server)
+                request = http_client(httpd.server_port)
+            found = results['results'][mode] = {}
+            for scenario in scenarios:
+                found[scenario.name] = run_scenario(
+                    request, copy, scenario, requests, warmup)
+            if httpd is not None:
+                httpd.shutdown()
+                httpd.server_close()
+                httpd = None
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+        app.importer.clear()
+        importer.unregister(copy)
+        shutil.rmtree(tempdir)
+    return results
+
+
+def compare(results, baseline, threshold=10.0):
+    """Compare results with a baseline.
+
+    Returns a list of report lines, and True if any scenario served fewer
+    requests per second than the baseline by more than threshold percent.
+    """
+    lines = []
+    regressed = False
+    for mode, scenarios in sorted(results['results'].items()):
+        saved = baseline.get('results', {}).get(mode, {})
+        for name, result in sorted(scenarios.items()):
+            if name not in saved or not saved[name]['requests_per_second']:
+                continue
+            old = saved[name]['requests_per_second']
+            new = result['requests_per_second'] or 0.0
+            change = (new - old) / old * 100
+            old_p50 = saved[name]['latency_ms']['p50']
+            new_p50 = result['latency_ms']['p50']
+            flag = ''
+            if change < -threshold:
+                regressed = True
+                flag = ' SLOWER'
+            lines.append('{0:5} {1:14} {2:10.1f} req/s {3:+7.1f}%  '
+                         'p50 {4:.3f} ms (was {5:.3f}){6}'.format(
+                             mode, name, new, change, new_p50, old_p50,
+                             flag))
+    return lines, regressed
+
+
+def parse_command_line(cmdline=None):
+    "Parse command line"
+    usage = "Usage: python -m mod_genshi.bench [options]"
+    cmdline = cmdline if cmdline is not None else sys.argv[1:]
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--base", default=BASE,
+        help="Fixture tree to copy and serve")
+    parser.add_option("-s", "--scenario", action="append", default=[],
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="Scenario to run, may be repeated, all scenarios by default")
+    parser.add_option("-m", "--mode", action="append", default=[],
+        choices=['wsgi', 'http'],
+        help="Call the application in-process with 'wsgi', or over "
+             "loopback with 'http', both by default")
+    parser.add_option("--server", choices=SERVERS, default='async',
+        help="Server used for http mode: async, threads or wsgiref")
+    parser.add_option("-n", "--requests", type="int", default=1000,
+        help="Number of requests per scenario")
+    parser.add_option("--warmup", type="int", default=100,
+        help="Number of requests before measuring each scenario")
+    parser.add_option("-o", "--output",
+        help="File to write JSON results to, instead of standard output")
+    parser.add_option("-c", "--compare",
+        help="Baseline JSON results to compare with")
+    parser.add_option("--threshold", type="float", default=10.0,
+        help="Percentage drop in requests per second reported as slower")
+    opts, args = parser.parse_args(cmdline)
+    return opts
+
+
+def main(cmdline=None):
+    opts = parse_command_line(cmdline)
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not opts.scenario or scenario.name in opts.scenario]
+    results = run(opts.base, scenarios, opts.mode or ('wsgi', 'http'),
+                  opts.server, opts.requests, opts.warmup)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as fileobj:
+            fileobj.write(text + '\n')
+    elif not opts.compare:
+        sys.stdout.write(text + '\n')
+    if opts.compare:
+        with open(opts.compare) as fileobj:
+            baseline = json.load(fileobj)
+        lines, regressed = compare(results, baseline, opts.threshold)
+        sys.stdout.write(''.join(line + '\n' for line in lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
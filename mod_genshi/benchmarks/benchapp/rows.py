@@ -0,0 +1,6 @@
+"""Rows rendered by the reload benchmark
+"""
+
+
+def rows(count):
+    return [(index, 'Row {0}'.format(index)) for index in range(count)]
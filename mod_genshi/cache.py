@@ -0,0 +1,139 @@
+"""Bounded in-memory caches for mod_genshi.
+
+The LRUCache class implements a least recently used cache bounded by the
+number of entries and, optionally, the total size of the entries. Entries may
+also be given a time to live, after which they are treated as missing. The
+cache is safe to share between threads.
+"""
+import threading
+import time
+
+__all__ = ['LRUCache']
+
+
+class _Node(object):
+    "Entry in the doubly linked recency list of an LRUCache"
+
+    __slots__ = ('prev', 'next', 'key', 'value', 'size', 'expires')
+
+    def __init__(self, key=None, value=None, size=0, expires=None):
+        self.prev = self.next = self
+        self.key = key
+        self.value = value
+        self.size = size
+        self.expires = expires
+
+
+class LRUCache(object):
+    """Least recently used cache.
+
+    The cache holds at most entries items, with a total size of at most size.
+    Passing None for either bound disables it. When an item is added that
+    would exceed a bound, the least recently used items are evicted. Items
+    larger than the size bound are not stored at all.
+
+    Items may be given a ttl in seconds, after which get treats them as
+    missing. The clock used for expiry may be overridden for testing.
+    """
+
+    def __init__(self, entries=None, size=None, clock=time.time):
+        self.max_entries = entries
+        self.max_size = size
+        self.clock = clock
+        self.size = 0
+        self._nodes = {}
+        self._head = _Node()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def _link(self, node):
+        head = self._head
+        node.prev = head
+        node.next = head.next
+        head.next.prev = node
+        head.next = node
+
+    def _unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self._nodes[node.key]
+        self.size -= node.size
+
+    def _evict(self):
+        head = self._head
+        while head.prev is not head and (
+                (self.max_entries is not None and
+                 len(self._nodes) > self.max_entries) or
+                (self.max_size is not None and self.size > self.max_size)):
+            self._remove(head.prev)
+
+    def get(self, key, default=None):
+        "Return the item for key, or default if it is missing or expired"
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is None:
+                return default
+            if node.expires is not None and node.expires <= self.clock():
+                self._remove(node)
+                return default
+            self._unlink(node)
+            self._link(node)
+            return node.value
+
+    def set(self, key, value, size=0, ttl=None):
+        "Store an item, evicting least recently used items as required"
+        if self.max_size is not None and size > self.max_size:
+            self.discard(key)
+            return
+        expires = None if ttl is None else self.clock() + ttl
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._remove(node)
+            node = _Node(key, value, size, expires)
+            self._nodes[key] = node
+            self.size += size
+            self._link(node)
+            self._evict()
+
+    def discard(self, key):
+        "Remove the item for key if present"
+        with self._lock:
+            node = self._nodes.get(key)
+            if node is not None:
+                self._remove(node)
+
+    def discard_if(self, predicate):
+        "Remove every item whose key and value satisfy predicate"
+        with self._lock:
+            for node in list(self._nodes.values()):
+                if predicate(node.key, node.value):
+                    self._remove(node)
+
+    def clear(self):
+        "Remove all items"
+        with self._lock:
+            self._nodes.clear()
+            self._head.prev = self._head.next = self._head
+            self.size = 0
+
+    def keys(self):
+        "Return keys, from the most to least recently used"
+        with self._lock:
+            keys = []
+            node = self._head.next
+            while node is not self._head:
+                keys.append(node.key)
+                node = node.next
+            return keys
+
+
+_missing = object()
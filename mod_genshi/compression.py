@@ -0,0 +1,30 @@
+"""Gzip compression of template output.
+
+The functions in this module compress complete response bodies, or chunks of
+streamed output. Each streamed chunk is flushed from the compressor, so that
+the client can decompress and use every chunk as soon as it is received,
+such as to fetch resources linked from the head of a page.
+"""
+import zlib
+
+__all__ = ['gzip_body', 'gzip_chunks']
+
+# window bits selecting the gzip format
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def gzip_body(body, level=6):
+    "Compress a complete body in the gzip format"
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress chunks in the gzip format, yielding one compressed chunk for
+    each chunk"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        if not chunk:
+            continue
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
@@ -6,11 +6,16 @@ __all__ = ['Config']
 
 
 class Config(object):
-    """Configuration container for mod_genshi WSGI application"""
+    """Configuration container for mod_genshi WSGI application
 
-    def __init__(self, base):
+    Settings passed as keyword arguments override the defaults. Passing an
+    unknown setting raises a TypeError.
+    """
+
+    def __init__(self, base, **settings):
         self.base = os.path.abspath(base)
         self.set_defaults()
+        self.update(settings)
 
     @property
     def base(self):
@@ -25,14 +30,78 @@ class Config(object):
         # http defaults
         self.default_content_type = 'text/plain'
         self.index = 'index.html'
+        # Server-Timing header with the duration of each phase of a request
+        self.server_timing = False
+        # URL of metrics in the Prometheus text format, or None
+        self.metrics_path = None
+        # directory where forked workers publish metrics, or None for a
+        # private temporary directory created before workers are forked
+        self.metrics_dir = None
+        # directory of cProfile stats of sampled requests by template, or
+        # None, sampling one in every profile_every requests, requests for
+        # paths matching profile_paths, and requests with profile_header
+        self.profile_dir = None
+        self.profile_every = 0
+        self.profile_paths = ()
+        self.profile_header = None
+        self.profile_max_bytes = 1024 * 1024
+        self.profile_backups = 3
         # routing
         self.suffix_blocked = ('.swp', '.bak', '~')
         self.suffix_markup = ('.htm', '.html', '.xhtml', '.xml')
         self.suffix_static = ('.ico', '.gif', '.jpeg', '.jpg', '.png', '.svg')
         self.suffix_text = ('.json', '.text', '.txt')
+        # number of resolved request paths to cache
+        self.route_cache_entries = 4096
         # python module imports
         self.pythondir = self.base
+        # top-level module names imported from pythondir, or None for those
+        # in pythondir that can not be imported from sys.path
+        self.python_packages = None
+        # directory to store compiled modules in, or None; it must be owned
+        # by the server user and not writable by others
+        self.python_cache_dir = None
+        # change detection for reloading, one of 'poll', 'inotify' or 'auto'
+        self.reload_watcher = 'poll'
+        # minimum milliseconds between checks for changes, or 'never'
+        self.reload_check_interval = 0
+        # precompile templates and import modules at start up, never reload
+        self.frozen = False
         # template loading
         self.templatedir = self.base
+        # directory to store compiled templates in, or None; it must be
+        # owned by the server user and not writable by others
+        self.template_cache_dir = None
+        # template output streaming
+        self.stream = False
+        self.stream_chunk_size = 8192
+        self.stream_flush = ('</head>',)
+        # rendered template output cache
+        self.output_cache = False
+        self.output_cache_entries = 1024
+        self.output_cache_bytes = 64 * 1024 * 1024
+        self.output_cache_ttl = 60
+        self.output_cache_path_ttl = ()
+        self.output_cache_vary = ()
+        # gzip compression of template output of the listed content types
+        self.compress = False
+        self.compress_min_bytes = 1024
+        self.compress_level = 6
+        self.compress_types = ('application/json', 'application/xhtml+xml',
+                               'application/xml', 'text/html', 'text/plain',
+                               'text/xml')
+        # ETag of template output, None, 'content' for a strong ETag of the
+        # output, or 'mtime' for a weak ETag of source modification times
+        self.template_etag = None
         # static files
         self.staticdir = self.base
+        # in-memory cache of static files no larger than static_cache_file_bytes
+        self.static_cache_bytes = 16 * 1024 * 1024
+        self.static_cache_file_bytes = 256 * 1024
+
+    def update(self, settings):
+        "Override default settings"
+        for name, value in settings.items():
+            if name.startswith('_') or not hasattr(self, name):
+                raise TypeError("Unknown setting '{0}'".format(name))
+            setattr(self, name, value)
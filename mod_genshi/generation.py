@@ -0,0 +1,73 @@
+"""Generations of loaded modules and templates.
+
+Modules are shared by every thread through sys.modules, so modules can not be
+unloaded while another thread is rendering a template that imports them. The
+Generation class separates requests into generations. Requests run within
+the current generation, and advancing to the next generation waits for the
+requests of the current generation to finish. Requests started while the
+generation advances wait for the next generation.
+"""
+from contextlib import contextmanager
+import threading
+
+__all__ = ['Generation']
+
+
+class Generation(object):
+    """Synchronise requests with changes to loaded modules.
+
+    The number attribute counts the number of times the generation has
+    advanced.
+    """
+
+    def __init__(self):
+        self.number = 0
+        self._active = 0
+        self._advancing = False
+        self._condition = threading.Condition(threading.Lock())
+
+    def enter(self):
+        "Start a request in the current generation, returning its number"
+        with self._condition:
+            while self._advancing:
+                self._condition.wait()
+            self._active += 1
+            return self.number
+
+    def leave(self):
+        "Finish a request started with enter"
+        with self._condition:
+            self._active -= 1
+            if not self._active:
+                self._condition.notify_all()
+
+    @contextmanager
+    def request(self):
+        "Context manager calling enter and leave"
+        number = self.enter()
+        try:
+            yield number
+        finally:
+            self.leave()
+
+    @contextmanager
+    def advance(self):
+        """Context manager advancing to the next generation.
+
+        Waits for requests in the current generation to finish, and holds
+        new requests until the context exits. Must not be used by a thread
+        within a request.
+        """
+        with self._condition:
+            while self._advancing:
+                self._condition.wait()
+            self._advancing = True
+            while self._active:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.number += 1
+                self._advancing = False
+                self._condition.notify_all()
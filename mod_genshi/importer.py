@@ -1,57 +1,278 @@
 """PEP 302 import hook to reload modules on changes.
 
 Implements an import hook using a finder and a loader class to load modules
-from a filesystem path using the existing imp module. The modification time of
-all Python source files are recorded. The modifiation times can then be used
+from a filesystem path using the existing imp module. The finder is added to
+sys.meta_path and only claims the top-level modules and packages found in its
+path, and their submodules, declining any other import with a set lookup.
+Top-level names that can also be imported from sys.path are left to the normal
+import machinery. The modification time of all Python source files are
+recorded. The modifiation times can then be used
 later to generate a list of modified modules, unload modified modules or unload
 all modules if any are modified.
 
+Changes are detected using a watcher from the mod_genshi.watcher module.
+Modules whose source files are watched are only checked for modification
+after the watcher reports a change, otherwise source files are polled.
+
+The source of each module is also scanned for import statements, and the
+loader records the modules imported while each module is executed, including
+imports of computed names. Modules bound to the globals of a module when it
+has been executed are also recorded, which covers computed names of modules
+already loaded. Only imports of computed names made later, from functions,
+of modules already loaded are missed, as recording those would take a hook
+on every import of the process. Submodules are treated as importing their
+parent package, as a package imported again has no attributes for submodules left
+loaded. This import graph is used to unload a modified module along with the
+modules importing it, directly or indirectly, keeping the other loaded
+modules.
+
+Like the FileFinder of importlib, modules are found by looking up names in a
+cached listing of each directory, listed again only when the modification
+time of the directory changes, rather than probing for every suffix. Source
+modules are executed from code objects cached by the finder, keyed by the
+modification time and size of the source, so that reloading a module whose
+source is unchanged does not compile it again. Compiled .pyc files are not
+used, as their header only records the modification time of the source.
+Instead, the code and imports of each source file may be written to a cache
+directory, in a file recording the modification time and size of the source,
+so that processes started later, such as new workers, do not compile every
+module again.
+
+The import lock is held while registering paths and unloading modules, so
+that these do not interleave with imports in other threads.
+
 To use, call the register classmethod on ReloadingFinder. This method is
-indempotent. Calling this method will register a token at the end of sys.path
-to initiate imports from the path location.
+indempotent. Calling this method will add a finder for the path location to
+the end of sys.meta_path.
 """
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+import ast
+import hashlib
 import imp
+import marshal
 import os
-import random
-import string
 import sys
+import tempfile
+import types
+
+from mod_genshi.templatecache import private_directory
+from mod_genshi.watcher import Watcher
 
 
 # containers for common data sets
 Location = namedtuple('Location', 'fobject pathname description')
 Source = namedtuple('Source', 'pathname mtime')
+Compiled = namedtuple('Compiled', 'mtime size code imports')
+
+# version of files in a bytecode cache directory, which are only valid for
+# the Python version writing them
+VERSION = (1, sys.version, imp.get_magic())
+
+
+def _prefixes(name):
+    "Yield a dotted module name and the names of its parent packages"
+    parts = name.split('.')
+    for index in range(1, len(parts) + 1):
+        yield '.'.join(parts[:index])
+
+
+def find_imports(node, package=None):
+    """Return names of modules that may be imported by an abstract syntax tree.
+
+    Includes the parent packages of imported modules. As names imported using
+    'from module import name' may be modules, these are also included. If
+    package is given, names are also resolved relative to that package.
+    """
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Import):
+            modules = [alias.name for alias in child.names]
+        elif isinstance(child, ast.ImportFrom):
+            base = child.module or ''
+            if child.level and package is not None:
+                parent = package.rsplit('.', child.level - 1)[0]
+                base = parent + '.' + base if base else parent
+            modules = [base + '.' + alias.name if base else alias.name
+                       for alias in child.names if alias.name != '*']
+            if base:
+                modules.append(base)
+        else:
+            continue
+        for module in modules:
+            names.update(_prefixes(module))
+            if package is not None and not getattr(child, 'level', 0):
+                names.update(_prefixes(package + '.' + module))
+    return names
+
+
+class BytecodeCache(object):
+    """Code objects and imports of module source files.
+
+    Entries are kept while the modification time and size of the source are
+    unchanged. If directory is given, entries are also stored in files in
+    the directory, which is created and checked like that of a
+    TemplateCache. Files that do not match the source, and files that can
+    not be loaded, are ignored and replaced.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = None
+        if directory is not None:
+            self.directory = private_directory(directory, 'Python cache')
+        self._entries = {}
+
+    def get(self, pathname, package=None):
+        """Return the Compiled entry of a source file.
+
+        Imports are resolved relative to package. Raises SyntaxError if the
+        source can not be compiled.
+        """
+        stat = os.stat(pathname)
+        entry = self._entries.get(pathname)
+        if entry is not None and entry.mtime == stat.st_mtime and \
+                entry.size == stat.st_size:
+            return entry
+        entry = self._load(pathname, package, stat)
+        if entry is None:
+            with open(pathname, 'rU') as fileobj:
+                node = ast.parse(fileobj.read(), pathname)
+            code = compile(node, pathname, 'exec', dont_inherit=True)
+            entry = Compiled(stat.st_mtime, stat.st_size, code,
+                             find_imports(node, package))
+            self._save(pathname, package, entry)
+        self._entries[pathname] = entry
+        return entry
+
+    def discard_stale(self, pathname):
+        """Forget the entry of a source file if the source was modified or
+        removed since, so that entries of removed modules are not kept"""
+        entry = self._entries.get(pathname)
+        if entry is None:
+            return
+        try:
+            stat = os.stat(pathname)
+        except OSError:
+            stat = None
+        if stat is None or entry.mtime != stat.st_mtime or \
+                entry.size != stat.st_size:
+            self._entries.pop(pathname, None)
+
+    def _filename(self, pathname, package):
+        key = '\0'.join((os.path.abspath(pathname), package or ''))
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest + '.marshal')
+
+    def _metadata(self, pathname, package, mtime, size):
+        return (VERSION, os.path.abspath(pathname), package, mtime, size)
+
+    def _load(self, pathname, package, stat):
+        "Return the stored entry of a source file, or None"
+        if self.directory is None:
+            return None
+        try:
+            fileobj = open(self._filename(pathname, package), 'rb')
+        except IOError:
+            return None
+        try:
+            if marshal.load(fileobj) != self._metadata(
+                    pathname, package, stat.st_mtime, stat.st_size):
+                return None
+            code, imports = marshal.load(fileobj)
+        except Exception:
+            return None
+        finally:
+            fileobj.close()
+        return Compiled(stat.st_mtime, stat.st_size, code, set(imports))
+
+    def _save(self, pathname, package, entry):
+        "Store an entry in the directory, if any"
+        if self.directory is None:
+            return
+        try:
+            fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                marshal.dump(self._metadata(pathname, package, entry.mtime,
+                                            entry.size), fileobj)
+                marshal.dump((entry.code, sorted(entry.imports)), fileobj)
+            os.rename(temppath, self._filename(pathname, package))
+        except Exception:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
 
 
 class ReloadingLoader(object):
     """Import hook loader.
 
-    Used by the ReloadingFinder class. Implemented using the imp module.
+    Used by the ReloadingFinder class. Source modules and packages are
+    executed from code in a BytecodeCache, other modules are loaded using the
+    imp module. Imports are reported to finder, if given.
     """
 
-    def __init__(self, source, token):
+    def __init__(self, source, bytecode, finder=None):
         self.source = source
-        self.token = token
+        self.bytecode = bytecode
+        self.finder = finder
 
     def load_module(self, fullname):
         "Import hook protocol."
+        if self.finder is None:
+            return self._load_module(fullname)
+        self.finder._enter(fullname)
         try:
-            module = imp.load_module(fullname, *self.source)
-            if hasattr(module, '__path__'):
-                module.__path__ = [self.token + self.source.pathname]
-            return module
+            module = self._load_module(fullname)
         finally:
-            if hasattr(self.source.fobject, 'close'):
-                self.source.fobject.close()
+            self.finder._exit()
+        self.finder._record_globals(fullname, module)
+        return module
+
+    def _load_module(self, fullname):
+        suffix, mode, kind = self.source.description
+        if kind not in (imp.PY_SOURCE, imp.PKG_DIRECTORY):
+            try:
+                return imp.load_module(fullname, *self.source)
+            finally:
+                if hasattr(self.source.fobject, 'close'):
+                    self.source.fobject.close()
+        if kind == imp.PKG_DIRECTORY:
+            pathname = os.path.join(self.source.pathname, '__init__.py')
+            package = fullname
+        else:
+            pathname = self.source.pathname
+            package = fullname.rpartition('.')[0] or None
+        code = self.bytecode.get(pathname, package).code
+        module = sys.modules.get(fullname)
+        created = module is None
+        if created:
+            module = sys.modules[fullname] = imp.new_module(fullname)
+        module.__file__ = pathname
+        module.__loader__ = self
+        if kind == imp.PKG_DIRECTORY:
+            module.__path__ = [self.source.pathname]
+            module.__package__ = fullname
+        try:
+            exec code in module.__dict__
+        except BaseException:
+            if created:
+                sys.modules.pop(fullname, None)
+            raise
+        return sys.modules[fullname]
 
 
 class ReloadingFinder(object):
-    """Import hook loader.
+    """Import hook finder.
 
     Finds modules using the imp module. Records the modification time for
-    module source files. The default search path for modules is empty by
-    default. This can be over ridden by passing a iterable of paths name when
-    creating the instance.
+    module source files. Only modules within the top-level names in packages
+    are found. If packages is None, these are the modules and packages in
+    path that can not be imported from sys.path, rescanned by refresh when
+    the directory changes.
 
     Instances have the following properties.
 
@@ -63,48 +284,63 @@ class ReloadingFinder(object):
     ismodified property that is True if there are modified modules.
 
     To create a ReloadingFinder, use the register class method. This will
-    return a new instance of ReloadingFinder after adding a token to sys.path.
-    Use the unregister class method to reverse this.
+    return a new instance of ReloadingFinder after adding it to
+    sys.meta_path. Use the unregister class method to reverse this.
     """
 
-    MTIMES = defaultdict(dict)
-    PATHS = {}
-    TOKENS = {}
-
-    TOKEN_LEN = 40
-
-    def __init__(self, index):
-        try:
-            suffix = index[self.TOKEN_LEN:]
-            self._token = index[:self.TOKEN_LEN]
-            self._path = [self.PATHS[self._token]]
-            if suffix:
-                self._path = [suffix]
-            self._mtimes = self.MTIMES[self._token]
-        except KeyError:
-            raise ImportError
+    FINDERS = {}
+
+    def __init__(self, path, watcher=None, packages=None, cache_dir=None):
+        self._path = path
+        self._watcher = watcher or Watcher()
+        self._mtimes = {}
+        self._imports = {}
+        self._dirty = set()
+        self._polled = set()
+        self._listings = {}
+        self._bytecode = BytecodeCache(cache_dir)
+        self._loading = []
+        self._scanned = None
+        self._configured = packages is not None
+        self.packages = frozenset(packages or ())
+        self.refresh()
 
     @classmethod
-    def register(cls, path):
-        "Create a new reloading path"
-        if path not in cls.TOKENS:
-            token = "".join(random.choice(string.letters)
-                            for i in range(cls.TOKEN_LEN))
-            cls.TOKENS[path] = token
-            cls.PATHS[token] = path
-            sys.path.append(token)
-        token = cls.TOKENS[path]
-        return cls(cls.TOKENS[path])
+    def register(cls, path, watcher=None, packages=None, cache_dir=None):
+        """Create a new reloading path
+
+        Changes to modules are detected using watcher. By default modules are
+        polled for changes. Passing a watcher for an existing path replaces
+        the watcher for modules imported afterwards. Compiled modules are
+        stored in cache_dir, if given, which likewise replaces the cache of
+        an existing path.
+        """
+        imp.acquire_lock()
+        try:
+            finder = cls.FINDERS.get(path)
+            if finder is None:
+                finder = cls.FINDERS[path] = cls(path, watcher, packages,
+                                                 cache_dir)
+                sys.meta_path.append(finder)
+            else:
+                if watcher is not None:
+                    finder._watcher = watcher
+                if cache_dir is not None:
+                    finder._bytecode = BytecodeCache(cache_dir)
+            return finder
+        finally:
+            imp.release_lock()
 
     @classmethod
     def unregister(cls, path):
         "Remove an existing reloading path"
-        if path not in cls.TOKENS:
-            return
-        token = cls.TOKENS[path]
-        del cls.TOKENS[path]
-        del cls.PATHS[token]
-        sys.path.remove(token)
+        imp.acquire_lock()
+        try:
+            finder = cls.FINDERS.pop(path, None)
+            if finder in sys.meta_path:
+                sys.meta_path.remove(finder)
+        finally:
+            imp.release_lock()
 
     @property
     def ismodified(self):
@@ -118,9 +354,7 @@ class ReloadingFinder(object):
 
     @loaded.deleter
     def loaded(self):
-        for fullname in self.loaded:
-            del sys.modules[fullname]
-            del self._mtimes[fullname]
+        self.unload(self.loaded)
 
     @property
     def modified(self):
@@ -128,19 +362,92 @@ class ReloadingFinder(object):
 
     @modified.deleter
     def modified(self):
-        for fullname in self.modified:
-            del sys.modules[fullname]
-            del self._mtimes[fullname]
+        self.unload(self.modified)
+
+    def _enter(self, fullname):
+        "Record that the module being loaded, if any, imports fullname"
+        if self._loading:
+            self._imports.setdefault(self._loading[-1], set()).add(fullname)
+        self._loading.append(fullname)
+
+    def _exit(self):
+        self._loading.pop()
+
+    def _record_globals(self, fullname, module):
+        """Record loaded modules bound to the globals of a module after it
+        was executed, such as modules of computed names already loaded"""
+        imported = set(value.__name__ for value in vars(module).values()
+                       if isinstance(value, types.ModuleType) and
+                       value.__name__ in self._mtimes)
+        imported.discard(fullname)
+        if imported:
+            self._imports.setdefault(fullname, set()).update(imported)
+
+    def _find_packages(self, filenames):
+        "Return names of top-level modules in filenames not on sys.path"
+        names = set()
+        for filename in filenames:
+            name, suffix = os.path.splitext(filename)
+            if suffix != '.py' and (suffix or '__init__.py' not in
+                                    self._listing(os.path.join(self._path,
+                                                               filename))):
+                continue
+            if name in names or name in sys.builtin_module_names:
+                continue
+            try:
+                fobject, pathname, description = imp.find_module(name)
+            except ImportError:
+                names.add(name)
+                continue
+            if hasattr(fobject, 'close'):
+                fobject.close()
+        return names
+
+    def _listing(self, directory):
+        """Return the names in a directory, listed again only when the
+        modification time of the directory changes"""
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            self._listings.pop(directory, None)
+            return frozenset()
+        listing = self._listings.get(directory)
+        if listing is not None and listing[0] == mtime:
+            return listing[1]
+        try:
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            names = frozenset()
+        self._listings[directory] = (mtime, names)
+        return names
 
     def _find_location(self, module, path):
-        fobject, pathname, description = imp.find_module(module, path)
-        location = Location(fobject, pathname, description)
-        return location
+        for directory in path:
+            names = self._listing(directory)
+            if module in names:
+                pathname = os.path.join(directory, module)
+                if '__init__.py' in self._listing(pathname):
+                    return Location(None, pathname,
+                                    ('', '', imp.PKG_DIRECTORY))
+            if module + '.py' in names:
+                return Location(None, os.path.join(directory, module + '.py'),
+                                ('.py', 'U', imp.PY_SOURCE))
+            for suffix, mode, kind in imp.get_suffixes():
+                if module + suffix in names:
+                    return Location(*imp.find_module(module, [directory]))
+        raise ImportError('No module named ' + module)
 
     def _iter_modified(self):
-        for fullname in self._mtimes:
-            location = self._mtimes[fullname]
-            mtime = os.path.getmtime(location.pathname)
+        if not self._dirty and not self._polled:
+            return
+        for fullname, location in list(self._mtimes.items()):
+            if fullname not in self._polled and \
+                    os.path.abspath(location.pathname) not in self._dirty:
+                continue
+            try:
+                mtime = os.path.getmtime(location.pathname)
+            except OSError:
+                mtime = None
             if mtime != location.mtime:
                 yield fullname
 
@@ -148,27 +455,213 @@ class ReloadingFinder(object):
         hierarchy = fullname.rsplit('.', 1)
         return hierarchy[-1]
 
+    def _record_imports(self, fullname, location):
+        suffix, mode, kind = location.description
+        if kind == imp.PKG_DIRECTORY:
+            pathname = os.path.join(location.pathname, '__init__.py')
+            package = fullname
+        elif kind == imp.PY_SOURCE:
+            pathname = location.pathname
+            package = fullname.rpartition('.')[0] or None
+        else:
+            self._imports[fullname] = set()
+            return
+        try:
+            self._imports[fullname] = set(self._bytecode.get(
+                pathname, package).imports)
+        except (IOError, OSError, SyntaxError):
+            self._imports[fullname] = set()
+
     def _record_mtime(self, fullname, location):
+        suffix, mode, kind = location.description
+        if kind == imp.PKG_DIRECTORY:
+            # the directory changes whenever a file in the package is added
+            location = location._replace(pathname=os.path.join(
+                location.pathname, '__init__.py'))
+        pathname = os.path.abspath(location.pathname)
+        self._dirty.discard(pathname)
         mtime = os.path.getmtime(location.pathname)
         source = Source(location.pathname, mtime)
         self._mtimes[fullname] = source
+        if self._watcher.watch(pathname, self._dirty.add):
+            self._polled.discard(fullname)
+        else:
+            self._polled.add(fullname)
+
+    def rewatch(self, watcher):
+        """Watch loaded modules using a new watcher.
+
+        Used to replace a watcher that stopped working, such as a watcher
+        inherited from the parent of a forked process.
+        """
+        self._watcher = watcher
+        for fullname, source in list(self._mtimes.items()):
+            pathname = os.path.abspath(source.pathname)
+            if watcher.watch(pathname, self._dirty.add):
+                self._polled.discard(fullname)
+            else:
+                self._polled.add(fullname)
+
+    def refresh(self):
+        """Find top-level modules added to or removed from path.
+
+        The directory is only scanned when its modification time changes, and
+        never if packages were given when creating the instance.
+        """
+        if self._configured:
+            return
+        filenames = self._listing(self._path)
+        if filenames is self._scanned:
+            return
+        self._scanned = filenames
+        self.packages = frozenset(self._find_packages(filenames))
 
     def clear(self):
         "Unload all imported modules"
         del self.loaded
 
-    def find_module(self, fullname):
+    def _requires(self, fullname):
+        "Return modules imported by a module, including its parent package"
+        imports = self._imports.get(fullname, set())
+        parent = fullname.rpartition('.')[0]
+        if parent:
+            return imports | set([parent])
+        return imports
+
+    def dependents(self, fullnames):
+        """Return loaded modules that import, directly or indirectly, any of
+        the given modules, including the submodules of given packages. The
+        given modules are included in the result.
+        """
+        affected = set(fullnames)
+        loaded = set(self._mtimes) | set(self._imports)
+        changed = True
+        while changed:
+            changed = False
+            for fullname in loaded - affected:
+                if self._requires(fullname) & affected:
+                    affected.add(fullname)
+                    changed = True
+        return affected
+
+    def ordered(self, fullnames):
+        """Return the given modules in dependency order, each module after
+        the modules it imports, unless they import each other"""
+        fullnames = set(fullnames)
+        ordered = []
+        visited = set()
+
+        def visit(fullname):
+            if fullname in visited:
+                return
+            visited.add(fullname)
+            for imported in sorted(self._requires(fullname) & fullnames):
+                visit(imported)
+            ordered.append(fullname)
+
+        for fullname in sorted(fullnames):
+            visit(fullname)
+        return ordered
+
+    def _source(self, fullname):
+        """Return the source file of a module found by this finder, and the
+        package its imports are relative to, or None"""
+        package, _, module = fullname.rpartition('.')
+        if package:
+            parent = self._source(package)
+            if parent is None or \
+                    os.path.basename(parent[0]) != '__init__.py':
+                return None
+            path = [os.path.dirname(parent[0])]
+        else:
+            path = [self._path]
+        try:
+            location = self._find_location(module, path)
+        except ImportError:
+            return None
+        if hasattr(location.fobject, 'close'):
+            location.fobject.close()
+        suffix, mode, kind = location.description
+        if kind == imp.PKG_DIRECTORY:
+            return os.path.join(location.pathname, '__init__.py'), fullname
+        if kind == imp.PY_SOURCE:
+            return location.pathname, package or None
+        return None
+
+    def mtimes(self, fullnames):
+        """Return modification times of the source files of the given modules
+        and of the modules they require, directly or indirectly.
+
+        Modules are looked up whether or not they are loaded, so that the
+        result is the same in every process. Names that are not modules of
+        this finder, such as names imported from modules, are ignored.
+        """
+        mtimes = {}
+        visited = set()
+        pending = list(fullnames)
+        while pending:
+            fullname = pending.pop()
+            if fullname in visited or \
+                    fullname.partition('.')[0] not in self.packages:
+                continue
+            visited.add(fullname)
+            source = self._source(fullname)
+            if source is None:
+                continue
+            pathname, package = source
+            pending.append(fullname.rpartition('.')[0])
+            try:
+                mtimes[fullname] = os.path.getmtime(pathname)
+                pending.extend(self._bytecode.get(pathname, package).imports)
+            except (IOError, OSError, SyntaxError):
+                mtimes[fullname] = None
+        return mtimes
+
+    def unload(self, fullnames):
+        "Unload the given modules"
+        imp.acquire_lock()
+        try:
+            for fullname in fullnames:
+                sys.modules.pop(fullname, None)
+                source = self._mtimes.pop(fullname, None)
+                if source is not None:
+                    self._bytecode.discard_stale(source.pathname)
+                self._imports.pop(fullname, None)
+                self._polled.discard(fullname)
+        finally:
+            imp.release_lock()
+
+    def reload_modified(self):
+        """Unload modified modules and the modules importing them, directly
+        or indirectly, so that they are imported again when next used.
+
+        Returns the names of the unloaded modules in dependency order.
+        Modules are unloaded in the reverse order, importers first.
+        """
+        imp.acquire_lock()
+        try:
+            modified = self.modified
+            if not modified:
+                return []
+            modules = self.ordered(self.dependents(modified))
+            self.unload(reversed(modules))
+            return modules
+        finally:
+            imp.release_lock()
+
+    def find_module(self, fullname, path=None):
         "Import hook protocol."
+        if fullname.partition('.')[0] not in self.packages:
+            return None
         try:
             module = self._module_name(fullname)
-            location = self._find_location(module, self._path)
-            self._record_mtime(fullname, location)
-            return ReloadingLoader(location, self._token)
+            location = self._find_location(module, path or [self._path])
         except ImportError:
-            pass
-
+            return None
+        self._record_mtime(fullname, location)
+        self._record_imports(fullname, location)
+        return ReloadingLoader(location, self._bytecode, self)
 
-sys.path_hooks.append(ReloadingFinder)
 
 register = ReloadingFinder.register
 unregister = ReloadingFinder.unregister
@@ -0,0 +1,267 @@
+"""Genshi template loader that records template dependencies.
+
+Extends the Genshi TemplateLoader to scan each template when it is compiled.
+Static xi:include references and modules imported by py:python blocks are
+recorded, along with the modification time of the template source. The
+dependencies are used to find the templates affected by changes to other
+templates or to Python modules, so that only output derived from those
+templates needs to be discarded.
+
+Template files are watched using a watcher from the mod_genshi.watcher
+module. Templates whose files are watched are returned from the cache without
+checking the modification time of the file, unless the watcher has reported a
+change. Alternatively, a check interval limits how often the modification
+time of each template file is checked.
+
+Compiled templates do not hold references to imported modules. Modules are
+imported each time the template is rendered, so templates do not need to be
+recompiled when a module changes.
+"""
+from collections import Counter
+import os
+import time
+
+from genshi.template import TemplateLoader, TemplateError
+from genshi.template.base import EXEC, INCLUDE, SUB
+from genshi.template.eval import _parse
+
+from mod_genshi import importer
+from mod_genshi.watcher import Watcher
+
+__all__ = ['Loader']
+
+
+class Loader(TemplateLoader):
+    """Template loader recording dependencies of loaded templates.
+
+    Templates are identified by their absolute file path. Changes to
+    template files are detected using the watcher keyword argument, polling
+    by default. The check_interval keyword argument is the minimum number of
+    seconds between checks of a template file for changes. None means files
+    are never checked after they are compiled. If the template_cache keyword
+    argument is a TemplateCache, compiled templates are stored in and loaded
+    from it.
+
+    The stats attribute counts loads of templates by result: 'hit' for
+    templates that did not need to be compiled, 'miss' for newly compiled
+    templates and 'reload' for templates compiled again after a change.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.watcher = kwargs.pop('watcher', None) or Watcher()
+        self.check_interval = kwargs.pop('check_interval', 0)
+        self.clock = kwargs.pop('clock', time.time)
+        self.template_cache = kwargs.pop('template_cache', None)
+        TemplateLoader.__init__(self, *args, **kwargs)
+        self._checked = {}
+        self._templates = {}
+        self._mtimes = {}
+        self._includes = {}
+        self._imports = {}
+        self._dirty = set()
+        self._watched = set()
+        self.stats = Counter()
+
+    def _compile(self, cls, fileobj, filepath, filename, encoding, stat):
+        "Compile template, or load it from the template cache"
+        if encoding is None:
+            encoding = self.default_encoding
+        if self.template_cache is None or stat is None:
+            return TemplateLoader._instantiate(self, cls, fileobj, filepath,
+                                               filename, encoding=encoding)
+        tmpl = self.template_cache.load(self, cls, filepath, encoding, stat)
+        if tmpl is None:
+            tmpl = TemplateLoader._instantiate(self, cls, fileobj, filepath,
+                                               filename, encoding=encoding)
+            tmpl.stream
+            self.template_cache.save(self, tmpl, encoding, stat)
+        return tmpl
+
+    def _instantiate(self, cls, fileobj, filepath, filename, encoding=None):
+        "Record template modification time before parsing."
+        pathname = os.path.abspath(filepath)
+        self._dirty.discard(pathname)
+        self.stats['reload' if filepath in self._mtimes else 'miss'] += 1
+        try:
+            stat = os.fstat(fileobj.fileno())
+            self._mtimes[filepath] = stat.st_mtime
+        except (AttributeError, OSError):
+            stat = None
+            self._mtimes[filepath] = None
+        tmpl = self._compile(cls, fileobj, filepath, filename, encoding, stat)
+        if self.watcher.watch(pathname, self._dirty.add):
+            self._watched.add(filepath)
+        else:
+            self._watched.discard(filepath)
+        return tmpl
+
+    def rewatch(self, watcher):
+        """Watch compiled templates using a new watcher.
+
+        Used to replace a watcher that stopped working, such as a watcher
+        inherited from the parent of a forked process.
+        """
+        self._lock.acquire()
+        try:
+            self.watcher = watcher
+            for filepath in self._mtimes:
+                pathname = os.path.abspath(filepath)
+                if watcher.watch(pathname, self._dirty.add):
+                    self._watched.add(filepath)
+                else:
+                    self._watched.discard(filepath)
+        finally:
+            self._lock.release()
+
+    def _isclean(self, filepath):
+        """Return True if the template does not need to be checked.
+
+        This is the case if the watcher has not seen the template change, or
+        if the template was checked within the check interval.
+        """
+        if self.check_interval is None:
+            return filepath in self._mtimes
+        if filepath in self._watched and \
+                os.path.abspath(filepath) not in self._dirty:
+            return True
+        if not self.check_interval:
+            return False
+        checked = self._checked.get(filepath)
+        return checked is not None and \
+            self.clock() - checked < self.check_interval
+
+    def _cached_template(self, filename, relative_to):
+        "Return a cached template if it does not need to be checked"
+        if relative_to and (not self.search_path or
+                            not os.path.isabs(relative_to)):
+            filename = os.path.join(os.path.dirname(relative_to), filename)
+        try:
+            tmpl = self._cache[os.path.normpath(filename)]
+        except KeyError:
+            return None
+        if self._isclean(tmpl.filepath):
+            return tmpl
+        return None
+
+    def _scan(self, tmpl, stream, includes, imports):
+        "Find includes and imports in a template stream"
+        for kind, data, pos in stream:
+            if kind is EXEC:
+                try:
+                    node = _parse(data.source, mode='exec')
+                except SyntaxError:
+                    continue
+                imports.update(importer.find_imports(node))
+            elif kind is SUB:
+                self._scan(tmpl, data[1], includes, imports)
+            elif kind is INCLUDE:
+                href, cls, fallback = data
+                if fallback:
+                    self._scan(tmpl, fallback, includes, imports)
+                if not isinstance(href, basestring):
+                    continue
+                try:
+                    included = self.load(href, relative_to=pos[0],
+                                         cls=cls or tmpl.__class__)
+                except TemplateError:
+                    continue
+                includes.add(included.filepath)
+
+    def _record(self, tmpl):
+        "Record dependencies of a newly compiled template"
+        filepath = tmpl.filepath
+        self._templates[filepath] = tmpl
+        includes = set()
+        imports = set()
+        self._scan(tmpl, tmpl.stream, includes, imports)
+        self._includes[filepath] = includes
+        self._imports[filepath] = imports
+
+    def load(self, filename, relative_to=None, cls=None, encoding=None):
+        "Load template, recording dependencies when it is compiled."
+        self._lock.acquire()
+        try:
+            tmpl = self._cached_template(filename, relative_to)
+            if tmpl is None:
+                now = self.clock()
+                compiled = self.stats['miss'] + self.stats['reload']
+                tmpl = TemplateLoader.load(self, filename,
+                                           relative_to=relative_to, cls=cls,
+                                           encoding=encoding)
+                self._checked[tmpl.filepath] = now
+                if compiled == self.stats['miss'] + self.stats['reload']:
+                    self.stats['hit'] += 1
+            else:
+                self.stats['hit'] += 1
+            if self._templates.get(tmpl.filepath) is not tmpl:
+                self._record(tmpl)
+            return tmpl
+        finally:
+            self._lock.release()
+
+    def dependencies(self, filepath):
+        "Return templates included, directly or indirectly, by a template"
+        found = set()
+        pending = [filepath]
+        while pending:
+            for included in self._includes.get(pending.pop(), ()):
+                if included not in found:
+                    found.add(included)
+                    pending.append(included)
+        found.discard(filepath)
+        return found
+
+    def dependents(self, filepaths=(), modules=()):
+        """Return templates affected by changes to templates or modules.
+
+        Includes the given templates and every template that imports one of
+        the given modules, as well as any template including these templates.
+        """
+        modules = set(modules)
+        affected = set(filepaths)
+        for filepath, imports in self._imports.items():
+            if imports & modules:
+                affected.add(filepath)
+        changed = True
+        while changed:
+            changed = False
+            for filepath, includes in self._includes.items():
+                if filepath not in affected and includes & affected:
+                    affected.add(filepath)
+                    changed = True
+        return affected
+
+    def imports(self, filepaths):
+        "Return modules imported by py:python blocks of templates"
+        imports = set()
+        for filepath in filepaths:
+            imports.update(self._imports.get(filepath, ()))
+        return imports
+
+    def mtimes(self, filepaths):
+        "Return modification times of templates when they were compiled"
+        return dict((filepath, self._mtimes.get(filepath))
+                    for filepath in filepaths)
+
+    def modified(self, mtimes):
+        """Return templates whose source has changed.
+
+        mtimes is a mapping of template path to modification time, as
+        returned by the mtimes method.
+        """
+        modified = []
+        for filepath, recorded in mtimes.items():
+            if recorded != self._mtimes.get(filepath):
+                modified.append(filepath)
+                continue
+            if self._isclean(filepath):
+                continue
+            try:
+                mtime = os.path.getmtime(filepath)
+            except OSError:
+                mtime = None
+            if mtime is None or mtime != recorded:
+                modified.append(filepath)
+            else:
+                self._checked[filepath] = self.clock()
+        return modified
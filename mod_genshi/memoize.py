@@ -0,0 +1,320 @@
+"""Memoization of functions computing template data.
+
+The memoize decorator caches the results of a function by its arguments, in
+a least recently used cache bounded by a number of entries. Results may be
+given a time to live, after which they are computed again. With stale, an
+expired result is still returned for up to stale more seconds while it is
+computed again in a background thread.
+
+    from mod_genshi.memoize import memoize
+
+    @memoize(ttl=60, stale=300)
+    def navigation(section):
+        ...
+
+Genshi does not parse decorators in py:python blocks, where functions are
+memoized by calling memoize instead:
+
+    navigation = memoize(navigation, ttl=60)
+
+Memoized functions are registered by the file and name of the function, so
+that a function defined again with the same code, such as by a py:python
+block executed on every render, keeps its cached results. Results are
+discarded when the module or template defining the function is reloaded,
+and when any module it imports is modified.
+
+The function defined again must also see the same data: the values of the
+variables it closes over must be equal, and the globals it refers to must be
+the same objects, except for functions, which are compared by code as a
+py:python block defines them again on every render. Otherwise its results
+replace the cached results, so a function closing over a value that changes
+on every call gains nothing from being memoized. Genshi looks up the names
+used in templates in the data of the render, which is not compared, so a
+function defined in a template should be given the data its results depend
+on as arguments.
+
+The hit, miss and stale counts of each function are added to the request
+metrics, if enabled.
+
+Background computations run as requests of the generation of the
+application, so that the modules they use are not unloaded while they run.
+"""
+from collections import Counter
+import functools
+import threading
+import time
+import types
+
+from mod_genshi.cache import LRUCache
+
+__all__ = ['Memoized', 'Registry', 'REGISTRY', 'memoize']
+
+
+class Memoized(object):
+    """Function caching results by arguments.
+
+    Calls with arguments that can not be hashed are not cached. The stats
+    attribute counts calls by result: hit, miss, stale, uncached and error,
+    for background computations that failed. Background computations run
+    within a request of the generation attribute, if set.
+    """
+
+    def __init__(self, function, ttl=None, entries=128, stale=None,
+                 clock=time.time):
+        self.function = function
+        self.ttl = ttl
+        self.entries = entries
+        self.stale = stale
+        self.clock = clock
+        self.cache = LRUCache(entries, clock=clock)
+        self.stats = Counter()
+        self.generation = None
+        self._cleared = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        functools.update_wrapper(self, function)
+
+    @property
+    def label(self):
+        "Name of the function in metrics"
+        module = getattr(self.function, '__module__', None)
+        if module is None:
+            return '{0}:{1}'.format(self.function.func_code.co_filename,
+                                    self.function.__name__)
+        return '{0}.{1}'.format(module, self.function.__name__)
+
+    def __call__(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            entry = self.cache.get(key, _missing)
+        except TypeError:
+            self._count('uncached')
+            return self.function(*args, **kwargs)
+        if entry is _missing:
+            self._count('miss')
+            return self._compute(key, args, kwargs, self._cleared)
+        value, expires = entry
+        if expires is None or self.clock() < expires:
+            self._count('hit')
+        else:
+            self._count('stale')
+            self._revalidate(key, args, kwargs)
+        return value
+
+    def _count(self, result):
+        "Count a call, which other threads may count at the same time"
+        with self._lock:
+            self.stats[result] += 1
+
+    def _compute(self, key, args, kwargs, cleared):
+        "Call the function and cache the result, unless cleared meanwhile"
+        value = self.function(*args, **kwargs)
+        if self.ttl is None:
+            expires = ttl = None
+        else:
+            expires = self.clock() + self.ttl
+            ttl = self.ttl + (self.stale or 0)
+        if cleared == self._cleared:
+            self.cache.set(key, (value, expires), ttl=ttl)
+        return value
+
+    def _refresh(self, key, args, kwargs, cleared):
+        """Compute a result in a request of the generation, unless cleared
+        while waiting for it, as modules the function uses may be unloaded"""
+        try:
+            if self.generation is None:
+                self._compute(key, args, kwargs, cleared)
+            else:
+                with self.generation.request():
+                    if cleared == self._cleared:
+                        self._compute(key, args, kwargs, cleared)
+        except Exception:
+            self._count('error')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _revalidate(self, key, args, kwargs):
+        "Compute a stale result again in a background thread"
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        thread = threading.Thread(target=self._refresh,
+                                  args=(key, args, kwargs, self._cleared),
+                                  name='mod_genshi.memoize')
+        thread.daemon = True
+        thread.start()
+
+    def clear(self):
+        "Discard cached results"
+        self._cleared += 1
+        self.cache.clear()
+
+    def after_fork(self):
+        """Reset counts and background computations inherited from the
+        parent process"""
+        self.stats.clear()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+
+def _environment(function):
+    """Return the closure values and referenced globals of function, which
+    results depend on besides arguments"""
+    closure = tuple(_contents(cell) for cell in function.func_closure or ())
+    names = function.func_code.co_names
+    globals = tuple((name, function.func_globals.get(name, _missing))
+                    for name in names if name != _DATA)
+    return closure, globals
+
+
+def _contents(cell):
+    "Return the value of a closure cell, or _missing if not yet assigned"
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return _missing
+
+
+def _same_object(value, other):
+    """Return whether values are the same object, or functions with equal
+    code. Globals not yet assigned, such as a function decorated before its
+    name is bound, match any value."""
+    if value is other or value is _missing or other is _missing:
+        return True
+    if isinstance(value, Memoized):
+        value = value.function
+    if isinstance(other, Memoized):
+        other = other.function
+    if isinstance(value, types.FunctionType) and \
+            isinstance(other, types.FunctionType):
+        return value.func_code == other.func_code
+    if isinstance(value, types.MethodType):
+        return value == other
+    return False
+
+
+def _same_environment(first, second):
+    "Return whether environments have equal closures and the same globals"
+    if len(first[0]) != len(second[0]) or len(first[1]) != len(second[1]):
+        return False
+    for value, other in zip(first[0], second[0]):
+        if not _same_object(value, other) and value != other:
+            return False
+    for (name, value), (other_name, other) in zip(first[1], second[1]):
+        if name != other_name or not _same_object(value, other):
+            return False
+    return True
+
+
+class Registry(object):
+    "Memoized functions of a process"
+
+    def __init__(self):
+        self.generation = None
+        self._functions = {}
+        self._retired = Counter()
+        self._lock = threading.Lock()
+
+    def register(self, memoized):
+        """Return the registered memoized function with the same file, name,
+        code, environment and options as memoized, or else register memoized.
+
+        A function found is updated to call the function of memoized, keeping
+        its cached results.
+        """
+        function = memoized.function
+        code = function.func_code
+        key = (code.co_filename, function.__name__)
+        options = (memoized.ttl, memoized.entries, memoized.stale)
+        with self._lock:
+            existing = self._functions.get(key)
+            if existing is not None and \
+                    existing.function.func_code == code and \
+                    (existing.ttl, existing.entries, existing.stale) == \
+                    options and \
+                    _same_environment(_environment(existing.function),
+                                      _environment(function)):
+                existing.function = function
+                return existing
+            memoized.generation = self.generation
+            self._functions[key] = memoized
+        if existing is not None:
+            self._retire(existing)
+        return memoized
+
+    def _retire(self, memoized):
+        "Clear a memoized function, keeping its counts for the metrics"
+        memoized.clear()
+        with memoized._lock:
+            stats = list(memoized.stats.items())
+        with self._lock:
+            for result, count in stats:
+                self._retired[memoized.label, result] += count
+
+    def set_generation(self, generation):
+        """Run background computations of registered and future functions
+        within requests of generation"""
+        with self._lock:
+            self.generation = generation
+            for memoized in self._functions.values():
+                memoized.generation = generation
+
+    def invalidate(self, modules=(), filenames=()):
+        """Discard results of functions defined in the given modules or
+        files, such as modules and templates reloaded"""
+        modules = set(modules)
+        filenames = set(filenames)
+        with self._lock:
+            retired = []
+            for key, memoized in list(self._functions.items()):
+                function = memoized.function
+                if getattr(function, '__module__', None) in modules or \
+                        function.func_code.co_filename in filenames:
+                    retired.append(memoized)
+                    del self._functions[key]
+        for memoized in retired:
+            self._retire(memoized)
+
+    def collect(self):
+        "Return counts of calls by function and result for the metrics"
+        with self._lock:
+            counts = Counter(self._retired)
+            functions = list(self._functions.values())
+        for memoized in functions:
+            with memoized._lock:
+                stats = list(memoized.stats.items())
+            for result, count in stats:
+                counts[memoized.label, result] += count
+        return [('mod_genshi_memoize_calls_total',
+                 (('function', label), ('result', result)), count)
+                for (label, result), count in sorted(counts.items())]
+
+    def after_fork(self):
+        "Reset counts inherited from the parent process"
+        self._lock = threading.Lock()
+        self._retired.clear()
+        for memoized in self._functions.values():
+            memoized.after_fork()
+
+
+# memoized functions of this process
+REGISTRY = Registry()
+
+
+def memoize(function=None, ttl=None, entries=128, stale=None):
+    """Decorator memoizing a function, with results kept for ttl seconds and
+    at most entries results. Expired results are returned for up to stale
+    seconds while computed again. Use as @memoize or @memoize(ttl=60).
+    """
+    if function is None:
+        return functools.partial(memoize, ttl=ttl, entries=entries,
+                                 stale=stale)
+    return REGISTRY.register(Memoized(function, ttl, entries, stale))
+
+
+_missing = object()
+
+# global of functions in templates holding the data of the current render
+_DATA = '__data__'
@@ -0,0 +1,315 @@
+"""Request metrics in the Prometheus text format.
+
+The Metrics class counts events and records histograms of observed values,
+each identified by a metric name and a tuple of label pairs. Metrics are
+rendered in the Prometheus text exposition format.
+
+Forked worker processes each count their own requests. After a fork, a
+background thread periodically writes the metrics of the worker to a file in
+a directory shared by all workers, and rendering the metrics adds up the
+files of every worker, so that the metrics describe the whole server. The
+files of workers that exit are added to a single file and removed, so
+counters never decrease and the directory does not grow as workers are
+replaced. A lock file serializes this with reading the files.
+
+By default the directory is a new private temporary directory, created when
+the metrics are created in the parent process, before workers are forked,
+and removed when that process exits.
+"""
+from contextlib import contextmanager
+import atexit
+import errno
+import fcntl
+import marshal
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+__all__ = ['Metrics']
+
+# metric types and help text
+METRICS = {
+    'mod_genshi_requests_total':
+        ('counter', 'Requests by template and status code.'),
+    'mod_genshi_errors_total':
+        ('counter', 'Error responses by status code.'),
+    'mod_genshi_request_duration_seconds':
+        ('histogram', 'Time to produce a response, by template.'),
+    'mod_genshi_response_bytes_total':
+        ('counter', 'Bytes in responses with a known length, by template.'),
+    'mod_genshi_template_loads_total':
+        ('counter', 'Template loads by cache result: hit, miss or reload.'),
+    'mod_genshi_reloads_total':
+        ('counter', 'Reloads of modified modules.'),
+    'mod_genshi_modules_unloaded_total':
+        ('counter', 'Modules unloaded by reloads.'),
+    'mod_genshi_memoize_calls_total':
+        ('counter', 'Calls of memoized functions by result: hit, miss, '
+                    'stale, uncached or error.'),
+}
+
+# file adding up the metrics of workers that exited
+EXITED = 'exited.metrics'
+
+# file locked while reading metrics files, and while adding up the files of
+# workers that exited
+LOCK = 'metrics.lock'
+
+# upper bounds of histogram buckets
+BUCKETS = {
+    'mod_genshi_request_duration_seconds':
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+}
+
+
+class Metrics(object):
+    """Counters and histograms of a process, or of a group of workers.
+
+    directory is where forked workers publish their metrics, every interval
+    seconds. Collectors are callables called when rendering metrics, each
+    returning (name, labels, value) tuples of counters maintained elsewhere.
+    """
+
+    def __init__(self, directory=None, interval=1.0, clock=time.time):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='mod_genshi-metrics-')
+            atexit.register(_remove_directory, directory, os.getpid())
+        self.directory = directory
+        self.interval = interval
+        self.clock = clock
+        self.collectors = []
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._publisher = None
+
+    def inc(self, name, labels=(), value=1):
+        "Add value to a counter"
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        "Record a value in a histogram"
+        key = (name, labels)
+        bounds = BUCKETS[name]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(bounds) + 2)
+            for index, bound in enumerate(bounds):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            else:
+                histogram[len(bounds)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        """Return the counters and histograms of this process.
+
+        Histograms are lists of the count in each bucket, the count above
+        the last bucket and the sum of the values.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((key, list(histogram))
+                              for key, histogram in self._histograms.items())
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                key = (name, labels)
+                counters[key] = counters.get(key, 0) + value
+        return counters, histograms
+
+    def _filename(self, pid):
+        return os.path.join(self.directory, '{0}.metrics'.format(pid))
+
+    def publish(self):
+        "Write the metrics of this process to the shared directory"
+        try:
+            os.makedirs(self.directory, 0700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self._write(self._filename(os.getpid()), self.snapshot())
+
+    def _write(self, pathname, metrics):
+        "Write counters and histograms to a file, atomically"
+        fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                marshal.dump(metrics, fileobj)
+            os.rename(temppath, pathname)
+        except Exception:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+            raise
+
+    def _publish_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except (IOError, OSError):
+                continue
+
+    def after_fork(self):
+        """Discard metrics inherited from the parent process, and start
+        publishing the metrics of this worker"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+        self._publisher = threading.Thread(target=self._publish_forever,
+                                           name='mod_genshi.metrics')
+        self._publisher.daemon = True
+        self._publisher.start()
+
+    @contextmanager
+    def _locked(self, operation):
+        "Hold the lock file of the directory"
+        fd = os.open(os.path.join(self.directory, LOCK),
+                     os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def _read(self, filename):
+        "Return the counters and histograms of a file, or None"
+        try:
+            with open(os.path.join(self.directory, filename),
+                      'rb') as fileobj:
+                return marshal.load(fileobj)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def _merge_exited(self):
+        """Add the files of workers that exited to the EXITED file, and
+        remove them"""
+        with self._locked(fcntl.LOCK_EX):
+            filenames = [filename for filename in os.listdir(self.directory)
+                         if _pid(filename) is not None and
+                         not _alive(_pid(filename))]
+            if not filenames:
+                return
+            exited = self._read(EXITED) or ({}, {})
+            for filename in filenames:
+                other = self._read(filename)
+                if other is not None:
+                    _add(exited, other)
+            self._write(os.path.join(self.directory, EXITED), exited)
+            for filename in filenames:
+                os.remove(os.path.join(self.directory, filename))
+
+    def collect(self):
+        """Return counters and histograms of this process, added to those
+        published by other workers and those of workers that exited"""
+        metrics = self.snapshot()
+        if self._publisher is None:
+            return metrics
+        try:
+            filenames = os.listdir(self.directory)
+            if any(not _alive(pid) for pid in map(_pid, filenames)
+                   if pid is not None):
+                self._merge_exited()
+            with self._locked(fcntl.LOCK_SH):
+                own = os.path.basename(self._filename(os.getpid()))
+                for filename in os.listdir(self.directory):
+                    if not filename.endswith('.metrics') or filename == own:
+                        continue
+                    other = self._read(filename)
+                    if other is not None:
+                        _add(metrics, other)
+        except (IOError, OSError):
+            pass
+        return metrics
+
+    def render(self):
+        "Return the metrics of the server in the Prometheus text format"
+        counters, histograms = self.collect()
+        series = {}
+        for (name, labels), value in sorted(counters.items()):
+            series.setdefault(name, []).append(_sample(name, labels, value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            samples = series.setdefault(name, [])
+            cumulative = 0
+            bounds = BUCKETS[name] + ('+Inf',)
+            for bound, count in zip(bounds, histogram):
+                cumulative += count
+                samples.append(_sample(name + '_bucket',
+                                       labels + (('le', bound),), cumulative))
+            samples.append(_sample(name + '_sum', labels, histogram[-1]))
+            samples.append(_sample(name + '_count', labels, cumulative))
+        lines = []
+        for name in sorted(series):
+            kind, text = METRICS[name]
+            lines.append('# HELP {0} {1}'.format(name, text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            lines.extend(series[name])
+        return ''.join(line + '\n' for line in lines)
+
+
+def _add(metrics, other):
+    "Add counters and histograms to those of metrics, in place"
+    counters, histograms = metrics
+    other_counters, other_histograms = other
+    for key, value in other_counters.items():
+        counters[key] = counters.get(key, 0) + value
+    for key, other_histogram in other_histograms.items():
+        histogram = histograms.get(key)
+        if histogram is None:
+            histograms[key] = list(other_histogram)
+        else:
+            for index, value in enumerate(other_histogram):
+                histogram[index] += value
+
+
+def _pid(filename):
+    "Return the process id of a worker metrics file name, or None"
+    name, extension = os.path.splitext(filename)
+    if extension != '.metrics' or not name.isdigit():
+        return None
+    return int(name)
+
+
+def _alive(pid):
+    "Return whether a process exists"
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+def _remove_directory(directory, pid):
+    "Remove a temporary directory at exit of the process that created it"
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _format(value):
+    "Format a sample or label value"
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _escape(value):
+    "Escape a label value"
+    return _format(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _sample(name, labels, value):
+    "Format a sample line"
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(label, _escape(text))
+                               for label, text in labels) + '}'
+    return '{0} {1}'.format(name, _format(value))
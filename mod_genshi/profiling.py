@@ -0,0 +1,121 @@
+"""Sampling of requests with cProfile.
+
+The Profiler class decides which requests to profile, either one in every
+few requests, requests for paths matching a pattern, or requests carrying a
+header. The stats of profiled requests are added up by template, in pstats
+files that can be read with the pstats module. Each process writes its own
+files, named after the template and the process id, which can be combined
+with pstats.Stats.add.
+
+Files larger than a maximum size are rotated, keeping a number of backups
+with the suffixes .1, .2 and so on, so that stats of recent requests are
+not diluted by older requests.
+"""
+import cProfile
+import errno
+import fnmatch
+import itertools
+import os
+import pstats
+import re
+import tempfile
+import threading
+
+__all__ = ['Profiler']
+
+
+class Profiler(object):
+    """Profile sampled requests, adding up stats by template in directory.
+
+    One in every every requests is profiled, or none if every is 0, as well
+    as requests for paths matching one of the fnmatch patterns in paths and
+    requests with a header named header. Stats files are rotated when larger
+    than max_bytes, keeping up to backups older files.
+    """
+
+    def __init__(self, directory, every=0, paths=(), header=None,
+                 max_bytes=1024 * 1024, backups=3):
+        self.directory = os.path.abspath(directory)
+        self.every = every
+        self.paths = paths
+        self.header = header
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._count = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def sampled(self, environ):
+        "Return True if a request should be profiled"
+        if self.header is not None:
+            key = 'HTTP_' + self.header.upper().replace('-', '_')
+            if environ.get(key):
+                return True
+        if self.paths:
+            path = environ.get('SCRIPT_NAME', '') + \
+                environ.get('PATH_INFO', '')
+            for pattern in self.paths:
+                if fnmatch.fnmatch(path, pattern):
+                    return True
+        return bool(self.every) and next(self._count) % self.every == 0
+
+    def run(self, name, function, *args):
+        """Call function with args under cProfile, adding the stats to those
+        of template name"""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self.save(name, profile)
+
+    def filename(self, name):
+        "Return the path of the stats file of a template in this process"
+        name = re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('_') or 'other'
+        return os.path.join(self.directory, '{0}.{1}.pstats'.format(
+            name, os.getpid()))
+
+    def _rotate(self, pathname):
+        "Rename a stats file to the first backup, shifting older backups"
+        for index in range(self.backups, 0, -1):
+            source = pathname if index == 1 else \
+                '{0}.{1}'.format(pathname, index - 1)
+            if os.path.exists(source):
+                os.rename(source, '{0}.{1}'.format(pathname, index))
+        if os.path.exists(pathname):
+            os.remove(pathname)
+
+    def save(self, name, profile):
+        """Add the stats of a profile to the stats file of a template.
+
+        Returns True if the stats were written.
+        """
+        pathname = self.filename(name)
+        with self._lock:
+            try:
+                os.makedirs(self.directory)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    return False
+            try:
+                stats = pstats.Stats(profile)
+                if os.path.exists(pathname):
+                    if os.path.getsize(pathname) >= self.max_bytes:
+                        self._rotate(pathname)
+                    else:
+                        stats.add(pathname)
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                stats = pstats.Stats(profile)
+            temppath = None
+            try:
+                fd, temppath = tempfile.mkstemp(dir=self.directory,
+                                                suffix='.tmp')
+                os.close(fd)
+                stats.dump_stats(temppath)
+                os.rename(temppath, pathname)
+            except (IOError, OSError):
+                try:
+                    if temppath is not None:
+                        os.remove(temppath)
+                except OSError:
+                    pass
+                return False
+        return True
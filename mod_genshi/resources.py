@@ -0,0 +1,257 @@
+"""Long-lived resources that survive module reloads.
+
+Modules imported from the python directory are unloaded and executed again
+when they or the modules they import change, so objects created at module
+level, such as connection pools, are created again and the previous objects
+are left to the garbage collector. Resources declared in the registry are
+kept across reloads instead. A resource is created by calling its factory
+when first used, and kept until it is declared again with a factory whose
+code changed, when the previous value is closed. Factories are compared by
+their bytecode, constants and names, ignoring line numbers, and by the
+values of their defaults, closures and the globals they refer to, so that
+changing a setting such as a connection string creates the resource again.
+Classes and instances defined in the module of the factory are compared by
+their contents in the same way, as are partials and methods.
+
+Declare resources at module level, and get their value when needed:
+
+    from mod_genshi import resources
+
+    pool = resources.declare('db', create_pool, lambda pool: pool.close())
+
+    def rows():
+        connection = pool.get().connection()
+
+Resources are closed when the server stops. Forked worker processes discard
+resources created by the parent process without closing them, as closing
+would also affect the parent, and create their own when first used.
+"""
+import functools
+import itertools
+import sys
+import threading
+import traceback
+import types
+
+__all__ = ['Resource', 'Registry', 'REGISTRY', 'declare']
+
+
+def _code(code):
+    """Return the parts of a code object that affect what it does, without
+    line numbers, and the global names used by it and nested code"""
+    consts = []
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const, nested = _code(const)
+            names.update(nested)
+        consts.append((type(const), const))
+    return (code.co_code, tuple(consts), code.co_names, code.co_varnames,
+            code.co_freevars, code.co_argcount, code.co_flags), names
+
+
+def _module(value):
+    """Return the name of the module defining a function or class, or the
+    function of a partial or method"""
+    while isinstance(value, (functools.partial, types.MethodType)):
+        if isinstance(value, functools.partial):
+            value = value.func
+        else:
+            value = value.im_func
+    if isinstance(value, types.FunctionType):
+        return value.func_globals.get('__name__')
+    return getattr(value, '__module__', None)
+
+
+def _values(values, module, seen):
+    return tuple(_value(value, module, seen) for value in values)
+
+
+def _items(items, module, seen):
+    return tuple((name, _value(value, module, seen))
+                 for name, value in sorted(items)
+                 if name not in ('__dict__', '__weakref__'))
+
+
+def _value(value, module, seen):
+    """Return a value comparing equal for the same value after module is
+    reloaded.
+
+    Functions, classes and instances of classes defined in module are
+    compared by their code and contents, as reloading defines them again.
+    Other values are compared as they are, as are objects of other modules,
+    which are the same objects unless their module was reloaded too.
+    """
+    if isinstance(value, types.ModuleType):
+        return ('module', value.__name__)
+    if id(value) in seen:
+        return ('recursive', getattr(value, '__name__', None))
+    seen = seen | frozenset([id(value)])
+    if isinstance(value, functools.partial):
+        return ('partial', _value(value.func, module, seen),
+                _values(value.args, module, seen),
+                _items((value.keywords or {}).items(), module, seen))
+    if isinstance(value, types.MethodType):
+        return ('method', _value(value.im_func, module, seen),
+                _value(value.im_self, module, seen))
+    if isinstance(value, (staticmethod, classmethod)):
+        return (type(value).__name__, _value(value.__func__, module, seen))
+    if isinstance(value, property):
+        return ('property', _values((value.fget, value.fset, value.fdel),
+                                    module, seen))
+    if isinstance(value, types.FunctionType):
+        if _module(value) == module:
+            return _function(value, module, seen)
+    elif isinstance(value, (type, types.ClassType)):
+        if value.__module__ == module:
+            return ('class', value.__name__,
+                    _values(value.__bases__, module, seen),
+                    _items(vars(value).items(), module, seen))
+    elif hasattr(value, '__dict__') and \
+            getattr(type(value), '__module__', None) == module:
+        return ('instance', _value(type(value), module, seen),
+                _items(vars(value).items(), module, seen))
+    return value
+
+
+def _function(function, module, seen):
+    "Return the fingerprint of a function defined in module"
+    code, names = _code(function.func_code)
+    globals = [(name, function.func_globals[name]) for name in names
+               if name in function.func_globals]
+    return ('function', code,
+            _values(function.func_defaults or (), module, seen),
+            _values(map(_contents, function.func_closure or ()), module,
+                    seen),
+            _items(globals, module, seen))
+
+
+def _fingerprint(factory):
+    """Return a value comparing equal for factories with the same code and
+    data, such as a function defined again by reloading its module"""
+    return _value(factory, _module(factory), frozenset())
+
+
+def _contents(cell):
+    "Return the value of a closure cell, or None if not yet assigned"
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return None
+
+
+class Resource(object):
+    """A named value created by factory when first used, and closed by
+    calling close with the value, if given.
+
+    Creating the value is thread-safe, the factory is called once.
+    """
+
+    def __init__(self, name, factory, close=None):
+        self.name = name
+        self.factory = factory
+        self.closer = close
+        self.fingerprint = _fingerprint(factory)
+        self._lock = threading.Lock()
+        self._created = False
+        self._value = None
+
+    @property
+    def created(self):
+        return self._created
+
+    def get(self):
+        "Return the value, creating it if needed"
+        if self._created:
+            return self._value
+        with self._lock:
+            if not self._created:
+                self._value = self.factory()
+                self._created = True
+        return self._value
+
+    def close(self):
+        "Close the value if it was created"
+        with self._lock:
+            if not self._created:
+                return
+            value = self._value
+            self._created = False
+            self._value = None
+        if self.closer is not None:
+            self.closer(value)
+
+    def discard(self):
+        """Forget the value without closing it, in a forked process.
+
+        The lock is replaced, as it may have been held by another thread of
+        the parent process when forked.
+        """
+        self._lock = threading.Lock()
+        self._created = False
+        self._value = None
+
+
+class Registry(object):
+    "Named resources of a process"
+
+    def __init__(self):
+        self._resources = {}
+        self._order = {}
+        self._count = itertools.count()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._resources
+
+    def declare(self, name, factory, close=None):
+        """Return the resource named name.
+
+        An existing resource is returned if its factory has the same code as
+        factory. Otherwise the existing resource is closed and replaced.
+        """
+        fingerprint = _fingerprint(factory)
+        with self._lock:
+            previous = self._resources.get(name)
+            if previous is not None and previous.fingerprint == fingerprint:
+                previous.closer = close
+                return previous
+            resource = self._resources[name] = Resource(name, factory, close)
+            self._order[name] = next(self._count)
+        if previous is not None:
+            self._close(previous)
+        return resource
+
+    def _close(self, resource):
+        try:
+            resource.close()
+        except Exception:
+            sys.stderr.write("Error closing resource {0}\n".format(
+                resource.name))
+            traceback.print_exc(file=sys.stderr)
+
+    def close(self):
+        """Close every resource, in the reverse order of declaration.
+
+        Errors are written to standard error, so that the remaining resources
+        are still closed.
+        """
+        with self._lock:
+            resources = sorted(self._resources.values(),
+                               key=lambda resource: self._order[resource.name])
+            self._resources.clear()
+            self._order.clear()
+        for resource in reversed(resources):
+            self._close(resource)
+
+    def after_fork(self):
+        "Forget values created by the parent process, without closing them"
+        self._lock = threading.Lock()
+        for resource in self._resources.values():
+            resource.discard()
+
+
+# resources of this process
+REGISTRY = Registry()
+
+declare = REGISTRY.declare
@@ -1,17 +1,257 @@
-"""mod_genshi development server.
+"""mod_genshi HTTP server.
+
+By default a single process serves one request at a time, which is only
+suitable for development. With the --workers option the server binds the
+listening socket and loads the application once, then forks worker processes
+sharing the socket and the loaded application. With the --threads option
+each process handles requests using a pool of threads. The --async option
+uses an event driven HTTP/1.1 server supporting keep-alive connections, from
+the mod_genshi.asyncserver module.
 """
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from wsgiref import simple_server
 from functools import partial
+import errno
 import optparse
 import os
+import Queue
+import select
+import signal
 import socket
 import sys
+import threading
 import time
 import webbrowser
 
 from mod_genshi.app import handler
+from mod_genshi.asyncserver import AsyncWSGIServer
+from mod_genshi.static import FileWrapper, HAVE_SENDFILE, sendfile
+
+__all__ = ['PreforkServer', 'RequestHandler', 'ThreadPoolMixIn',
+           'ThreadPoolWSGIServer']
+
+
+class ServerHandler(simple_server.ServerHandler):
+    "wsgiref handler sending file wrappers using sendfile"
+
+    wsgi_file_wrapper = FileWrapper
+
+    def sendfile(self):
+        "Send the file wrapped by the result using sendfile"
+        if not HAVE_SENDFILE:
+            return False
+        try:
+            out_fd = self.stdout.fileno()
+            in_fd = self.result.fileno()
+        except (AttributeError, IOError, ValueError):
+            return False
+        if not self.headers_sent:
+            self.bytes_sent = 0
+            self.send_headers()
+        self._flush()
+        offset, remaining = self.result.offset, self.result.length
+        while remaining > 0:
+            sent = sendfile(out_fd, in_fd, offset, remaining)
+            if not sent:
+                break
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class RequestHandler(WSGIRequestHandler):
+    "wsgiref request handler sending files using sendfile"
+
+    def handle(self):
+        "Handle a single HTTP request"
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(),
+                                self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+# old style class, like the SocketServer mix-in classes it is used with
+class ThreadPoolMixIn:
+    """Mix-in class to handle requests using a fixed number of threads.
+
+    The threads are started when the first request is received, as threads
+    are not copied to forked processes. The close_pool method waits for
+    queued requests to be handled, and should be called when the server is
+    closed.
+    """
+
+    threads = 8
+
+    _pool = None
+
+    def _start(self):
+        self._requests = Queue.Queue()
+        self._pool = []
+        for index in range(self.threads):
+            thread = threading.Thread(target=self._handle_requests,
+                                      name='mod_genshi.server')
+            thread.daemon = True
+            thread.start()
+            self._pool.append(thread)
+
+    def _handle_requests(self):
+        "Handle queued requests until a None request is queued"
+        while True:
+            queued = self._requests.get()
+            if queued is None:
+                break
+            request, client_address = queued
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.close_request(request)
+
+    def process_request(self, request, client_address):
+        "Queue a request for a thread from the pool"
+        if self._pool is None:
+            self._start()
+        self._requests.put((request, client_address))
+
+    def close_pool(self):
+        "Stop the pool of threads after handling queued requests"
+        if self._pool is None:
+            return
+        for thread in self._pool:
+            self._requests.put(None)
+        for thread in self._pool:
+            thread.join()
+        self._pool = None
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, WSGIServer):
+    "WSGI server handling requests using a pool of threads"
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        self.close_pool()
+
+
+class PreforkServer(object):
+    """Serve requests from forked worker processes.
+
+    The httpd server must already be bound and listening. Each worker handles
+    requests from the shared socket until it receives SIGTERM or SIGINT,
+    finishing the current request first. The master process replaces workers
+    that exit, and stops all workers when it receives SIGTERM or SIGINT.
+
+    If after_fork is given, it is called in each worker process after it is
+    forked. If before_exit is given, it is called in each worker process
+    when it stops handling requests.
+    """
+
+    # minimum lifetime of a worker before it is replaced without delay
+    RESPAWN_DELAY = 1.0
+
+    def __init__(self, httpd, workers, after_fork=None, before_exit=None):
+        self.httpd = httpd
+        self.workers = workers
+        self.after_fork = after_fork
+        self.before_exit = before_exit
+        self.running = False
+        self.pids = {}
+
+    def stop(self, signum=None, frame=None):
+        "Stop serving requests"
+        self.running = False
+
+    def _handle_signals(self, restart):
+        "Stop on SIGTERM and SIGINT, restarting interrupted system calls"
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+            signal.siginterrupt(signum, not restart)
+
+    def _work(self):
+        "Handle requests in a worker process until stopped"
+        # let the current request finish, while select still returns early
+        self._handle_signals(True)
+        if self.after_fork is not None:
+            self.after_fork()
+        # workers not accepting a connection return to check for signals
+        self.httpd.socket.setblocking(False)
+        self.httpd.timeout = self.RESPAWN_DELAY
+        try:
+            while self.running:
+                try:
+                    self.httpd.handle_request()
+                except select.error as err:
+                    if err.args[0] != errno.EINTR:
+                        raise
+            self.httpd.server_close()
+        finally:
+            if self.before_exit is not None:
+                self.before_exit()
+
+    def spawn(self):
+        "Fork a new worker process"
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._work()
+            except Exception:
+                status = 1
+            finally:
+                os._exit(status)
+        self.pids[pid] = time.time()
+        return pid
+
+    def _wait(self):
+        "Wait for a worker to exit, returning its pid or None"
+        try:
+            pid, status = os.wait()
+        except OSError as err:
+            if err.errno in (errno.EINTR, errno.ECHILD):
+                return None
+            raise
+        return pid
+
+    def serve_forever(self):
+        "Start workers and replace them as they exit until stopped"
+        self.running = True
+        self._handle_signals(False)
+        try:
+            while self.running and len(self.pids) < self.workers:
+                self.spawn()
+            while self.running:
+                pid = self._wait()
+                started = self.pids.pop(pid, None)
+                if started is None or not self.running:
+                    continue
+                if time.time() - started < self.RESPAWN_DELAY:
+                    time.sleep(self.RESPAWN_DELAY)
+                if self.running:
+                    self.spawn()
+        finally:
+            self.shutdown()
 
-__all__ = []
+    def shutdown(self):
+        "Stop every worker and wait for them to exit"
+        self.running = False
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.pids.pop(pid, None)
+        while self.pids:
+            pid = self._wait()
+            self.pids.pop(pid, None)
 
 
 def parse_command_line(cmdline=None):
@@ -29,6 +269,19 @@ def parse_command_line(cmdline=None):
         help="Open a new web browser tab for the server")
     parser.add_option("-r", "--autoraise", action="store_true", default=False,
         help="Auto raise the web browser")
+    parser.add_option("-n", "--workers", type="int", default=0,
+        help="Number of worker processes to fork, 0 to serve requests from a "
+             "single process")
+    parser.add_option("--threads", type="int", default=0,
+        help="Number of threads handling requests in each process, 0 to "
+             "handle one request at a time")
+    parser.add_option("-a", "--async", action="store_true", default=False,
+        dest="event_driven",
+        help="Serve HTTP/1.1 keep-alive connections from an event loop, "
+             "calling the application from a pool of threads")
+    parser.add_option("-f", "--frozen", action="store_true", default=False,
+        help="Compile templates and import modules before serving, and "
+             "ignore later changes")
     opts, args = parser.parse_args(cmdline)
     return opts
 
@@ -52,12 +305,33 @@ def run(cmdline=None):
         time.sleep(0.5)
         command()
         sys.exit(0)
+    if opts.frozen:
+        handler.freeze()
     try:
         sys.stdout.write("Serving on port {0} ...\n".format(opts.port))
-        httpd = make_server('', opts.port, handler)
-        httpd.serve_forever()
+        if opts.event_driven:
+            httpd = AsyncWSGIServer(('', opts.port), handler,
+                                    threads=opts.threads or 8,
+                                    inline=handler.is_static)
+            httpd.multiprocess = opts.workers > 0
+        elif opts.threads > 0:
+            httpd = make_server('', opts.port, handler,
+                                server_class=ThreadPoolWSGIServer,
+                                handler_class=RequestHandler)
+            httpd.threads = opts.threads
+        else:
+            httpd = make_server('', opts.port, handler,
+                                handler_class=RequestHandler)
+        if opts.workers > 0:
+            server = PreforkServer(httpd, opts.workers, handler.after_fork,
+                                   handler.close)
+            server.serve_forever()
+        else:
+            httpd.serve_forever()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        handler.close()
 
 
 if __name__ == '__main__':
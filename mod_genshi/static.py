@@ -0,0 +1,500 @@
+"""Static file serving, with an in-memory cache of small files.
+
+The StaticCache class is a WSGI application serving files from a directory.
+Small files are kept in memory along with their response headers, including
+an ETag computed from the content and the Last-Modified time, so that cached
+files are served without opening the file. Conditional requests using
+If-None-Match or If-Modified-Since are answered with 304 Not Modified, and
+single byte ranges are supported.
+
+Precompressed copies of a file, named by adding .br or .gz to the file name,
+are served instead of the file to clients accepting that content encoding.
+The compressed copies found for each file are cached. Copies that are not
+watched are assumed to be written along with the file, and are looked for
+again when the modification time of the file changes.
+
+Cached files are checked for changes the same way as templates, using a
+watcher from the mod_genshi.watcher module and a check interval. Larger files
+are returned using the wsgi.file_wrapper of the server, if available. The
+FileWrapper class is a wsgi.file_wrapper that servers can send using the
+sendfile function, without copying the file through the interpreter. Other
+requests are passed to a fallback application.
+"""
+from email.utils import formatdate, parsedate_tz, mktime_tz
+import ctypes
+import errno
+import hashlib
+import mimetypes
+import os
+import stat
+import threading
+import time
+
+from mod_genshi.cache import LRUCache
+from mod_genshi.watcher import Watcher
+
+__all__ = ['StaticCache', 'FileWrapper', 'HAVE_SENDFILE', 'sendfile']
+
+# size of blocks read from files that are not sent using sendfile
+BLOCK_SIZE = 64 * 1024
+
+# content encodings of precompressed copies, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# number of files whose precompressed copies are cached
+ENCODING_ENTRIES = 4096
+
+
+def _libc_sendfile():
+    "Return the sendfile function of the C library, or None"
+    try:
+        function = ctypes.CDLL(None, use_errno=True).sendfile64
+    except (AttributeError, OSError):
+        return None
+    function.argtypes = (ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t)
+    function.restype = ctypes.c_ssize_t
+    return function
+
+_sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+HAVE_SENDFILE = _sendfile is not None
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Copy up to count bytes at offset in file in_fd to socket out_fd.
+
+    Returns the number of bytes sent. Raises OSError if the copy fails,
+    including with ENOSYS if sendfile is not available.
+    """
+    if _sendfile is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    if _sendfile is getattr(os, 'sendfile', None):
+        return _sendfile(out_fd, in_fd, offset, count)
+    sent = _sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_longlong(offset)),
+                     count)
+    if sent < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return sent
+
+
+class FileWrapper(object):
+    """Iterable over length bytes of a file, starting at offset.
+
+    Compatible with wsgi.file_wrapper, for which offset defaults to the
+    current position and length to the rest of the file. Servers may instead
+    send the bytes using sendfile with the fileno, offset and length
+    attributes.
+    """
+
+    def __init__(self, fileobj, blksize=BLOCK_SIZE, offset=None,
+                 length=None):
+        self.fileobj = fileobj
+        self.blksize = blksize
+        if offset is None:
+            offset = fileobj.tell()
+        if length is None:
+            length = os.fstat(fileobj.fileno()).st_size - offset
+        self.offset = offset
+        self.length = length
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def __iter__(self):
+        self.fileobj.seek(self.offset)
+        remaining = self.length
+        while remaining > 0:
+            block = self.fileobj.read(min(self.blksize, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+    def close(self):
+        self.fileobj.close()
+
+
+class StaticFile(object):
+    """Response headers of a static file, and the content of cached files.
+
+    The headers are those of a complete 200 response.
+    """
+
+    __slots__ = ('body', 'mtime', 'size', 'etag', 'headers', 'checked')
+
+    def __init__(self, body, mtime, size, content_type, encoding, checked,
+                 etag=None):
+        self.body = body
+        self.mtime = mtime
+        self.size = size
+        if etag is None:
+            etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+        self.etag = etag
+        self.headers = [('Content-Type', content_type),
+                        ('Content-Length', str(size)),
+                        ('ETag', self.etag),
+                        ('Last-Modified', formatdate(mtime, usegmt=True)),
+                        ('Accept-Ranges', 'bytes')]
+        if encoding is not None:
+            self.headers.append(('Content-Encoding', encoding))
+        self.checked = checked
+
+    def validators(self):
+        "Return the ETag and Last-Modified headers"
+        return self.headers[2:4]
+
+    def partial(self, start, end):
+        "Return headers for a 206 response with bytes start to end"
+        headers = list(self.headers)
+        headers[1] = ('Content-Length', str(end - start + 1))
+        headers.append(('Content-Range',
+                        'bytes {0}-{1}/{2}'.format(start, end, self.size)))
+        return headers
+
+
+class StaticCache(object):
+    """WSGI application serving static files from memory.
+
+    Files in directory no larger than file_size bytes are cached, up to a
+    total of size bytes. Other files are read from disk for each request.
+    Requests for anything other than a regular file, including methods other
+    than GET and HEAD, are passed to the fallback application.
+
+    Requests for a file with a precompressed copy, such as style.css.gz for
+    style.css, are sent the copy if the client accepts its encoding.
+
+    Changes to cached files are detected using the watcher keyword argument,
+    polling by default. The check_interval keyword argument is the minimum
+    number of seconds between checks of a file that is not watched. None
+    means files are never checked after they are cached.
+    """
+
+    def __init__(self, directory, fallback, size, file_size, watcher=None,
+                 check_interval=0, clock=time.time):
+        self.directory = os.path.abspath(directory)
+        self.fallback = fallback
+        self.file_size = file_size
+        self.watcher = watcher or Watcher()
+        self.check_interval = check_interval
+        self.clock = clock
+        self.files = LRUCache(size=size)
+        self.encodings = LRUCache(entries=ENCODING_ENTRIES, clock=clock)
+        self._dirty = set()
+        self._watched = set()
+        self._lock = threading.Lock()
+
+    def _filepath(self, path_info):
+        "Return the file path for a request, or None if it is outside"
+        filepath = os.path.abspath(
+            os.path.join(self.directory, path_info.lstrip('/')))
+        if not filepath.startswith(self.directory + os.sep):
+            return None
+        return filepath
+
+    def _isfresh(self, filepath, cached):
+        "Return True if a cached file has not changed"
+        if self.check_interval is None:
+            return True
+        if filepath in self._watched and filepath not in self._dirty:
+            return True
+        now = self.clock()
+        if self.check_interval and now - cached.checked < self.check_interval:
+            return True
+        try:
+            info = os.stat(filepath)
+        except OSError:
+            return False
+        if info.st_mtime != cached.mtime or info.st_size != cached.size:
+            return False
+        cached.checked = now
+        return True
+
+    def _load(self, filepath):
+        "Read a file into the cache, returning None if it is not cacheable"
+        self._dirty.discard(filepath)
+        now = self.clock()
+        try:
+            info = os.stat(filepath)
+            if not stat.S_ISREG(info.st_mode) or \
+                    info.st_size > self.file_size:
+                return None
+            with open(filepath, 'rb') as fileobj:
+                body = fileobj.read()
+        except (IOError, OSError):
+            return None
+        content_type, encoding = _guess_type(filepath)
+        cached = StaticFile(body, info.st_mtime, len(body), content_type,
+                            encoding, now)
+        self.files.set(filepath, cached, size=len(body))
+        with self._lock:
+            if self.watcher.watch(filepath, self._dirty.add):
+                self._watched.add(filepath)
+            else:
+                self._watched.discard(filepath)
+        return cached
+
+    def get(self, path_info):
+        "Return the StaticFile for a request path, or None if not cached"
+        filepath = self._filepath(path_info)
+        if filepath is None:
+            return None
+        return self._get(filepath)
+
+    def _get(self, filepath):
+        cached = self.files.get(filepath)
+        if cached is not None and self._isfresh(filepath, cached):
+            return cached
+        return self._load(filepath)
+
+    def rewatch(self, watcher):
+        """Watch cached files using a new watcher.
+
+        Used to replace a watcher that stopped working, such as a watcher
+        inherited from the parent of a forked process.
+        """
+        with self._lock:
+            self.watcher = watcher
+            self._watched.clear()
+            for filepath in self.files.keys():
+                if watcher.watch(filepath, self._dirty.add):
+                    self._watched.add(filepath)
+        self.encodings.clear()
+
+    def _encodings_changed(self, pathname):
+        "Discard the cached encodings of a file after a change to a copy"
+        for encoding, suffix in ENCODINGS:
+            if pathname.endswith(suffix):
+                self.encodings.discard(pathname[:-len(suffix)])
+
+    def _encodings(self, filepath):
+        """Return the encodings of the precompressed copies of a file.
+
+        Cached until the watcher reports a change to a copy, or for the check
+        interval if the copies are not watched. With a check interval of 0,
+        cached until the modification time of the file changes.
+        """
+        mtime = None
+        entry = self.encodings.get(filepath)
+        if entry is not None:
+            found, checked = entry
+            if checked is None:
+                return found
+            mtime = _getmtime(filepath)
+            if mtime == checked:
+                return found
+        elif self.check_interval == 0:
+            mtime = _getmtime(filepath)
+        found = tuple(encoding for encoding, suffix in ENCODINGS
+                      if os.path.isfile(filepath + suffix))
+        watched = [self.watcher.watch(filepath + suffix,
+                                      self._encodings_changed)
+                   for encoding, suffix in ENCODINGS]
+        if self.check_interval is None or all(watched):
+            self.encodings.set(filepath, (found, None))
+        elif self.check_interval:
+            self.encodings.set(filepath, (found, None),
+                               ttl=self.check_interval)
+        elif mtime is not None:
+            self.encodings.set(filepath, (found, mtime))
+        return found
+
+    def _open(self, filepath):
+        """Open a file that is not cached, returning the file and a
+        StaticFile without content, or None if it is not a regular file"""
+        try:
+            fileobj = open(filepath, 'rb')
+        except IOError:
+            return None
+        info = os.fstat(fileobj.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            fileobj.close()
+            return None
+        content_type, encoding = _guess_type(filepath)
+        etag = '"{0:x}-{1:x}"'.format(int(info.st_mtime), info.st_size)
+        return fileobj, StaticFile(None, info.st_mtime, info.st_size,
+                                   content_type, encoding, None, etag)
+
+    def _lookup(self, filepath):
+        """Return an open file or None, and the StaticFile for a path, or
+        None if it is not a regular file"""
+        if self.file_size:
+            cached = self._get(filepath)
+            if cached is not None:
+                return None, cached
+        return self._open(filepath)
+
+    def _file_body(self, environ, fileobj, start, length, size):
+        "Return an iterable over part of a file, using the file wrapper"
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and issubclass(file_wrapper, FileWrapper):
+            return file_wrapper(fileobj, BLOCK_SIZE, start, length)
+        if file_wrapper is not None and start == 0 and length == size:
+            return file_wrapper(fileobj, BLOCK_SIZE)
+        return FileWrapper(fileobj, BLOCK_SIZE, start, length)
+
+    def __call__(self, environ, start_response):
+        "Serve a static file"
+        method = environ.get('REQUEST_METHOD')
+        if method not in ('GET', 'HEAD'):
+            return self.fallback(environ, start_response)
+        filepath = self._filepath(environ.get('PATH_INFO', ''))
+        if filepath is None:
+            return self.fallback(environ, start_response)
+        vary = []
+        found = None
+        encodings = self._encodings(filepath)
+        if encodings:
+            vary.append(('Vary', 'Accept-Encoding'))
+            encoding = negotiate_encoding(environ, encodings)
+            if encoding is not None:
+                found = self._lookup(filepath + dict(ENCODINGS)[encoding])
+        if not found:
+            found = self._lookup(filepath)
+        if not found:
+            return self.fallback(environ, start_response)
+        fileobj, cached = found
+        try:
+            if not_modified(environ, cached):
+                start_response('304 Not Modified',
+                               cached.validators() + vary)
+                return []
+            byte_range = parse_range(environ, cached)
+            if byte_range is False:
+                start_response('416 Requested Range Not Satisfiable', [
+                    ('Content-Range', 'bytes */{0}'.format(cached.size)),
+                    ('Content-Length', '0')] + vary)
+                return []
+            if byte_range is None:
+                start, end = 0, cached.size - 1
+                start_response('200 OK', cached.headers + vary)
+            else:
+                start, end = byte_range
+                start_response('206 Partial Content',
+                               cached.partial(start, end) + vary)
+            if method == 'HEAD':
+                return []
+            if fileobj is None:
+                if byte_range is None:
+                    return [cached.body]
+                return [cached.body[start:end + 1]]
+            body = self._file_body(environ, fileobj, start, end - start + 1,
+                                   cached.size)
+            fileobj = None
+            return body
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+def _getmtime(filepath):
+    "Return the modification time of a file, or None if it is missing"
+    try:
+        return os.stat(filepath).st_mtime
+    except OSError:
+        return None
+
+
+def _guess_type(filepath):
+    "Guess the content type and encoding of a file"
+    if filepath.endswith('.br'):
+        content_type, encoding = mimetypes.guess_type(filepath[:-3])[0], 'br'
+    else:
+        content_type, encoding = mimetypes.guess_type(filepath)
+    if content_type is None:
+        content_type = 'application/octet-stream'
+    return content_type, encoding
+
+
+def negotiate_encoding(environ, encodings):
+    """Return the first of encodings accepted by the client, or None.
+
+    Encodings are accepted if listed in the Accept-Encoding header with a
+    non-zero quality, or matched by *.
+    """
+    accepted = {}
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, sep, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        coding = coding.strip().lower()
+        if coding:
+            accepted[coding] = quality
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def parse_range(environ, cached):
+    """Return the first and last byte of the range requested for a file.
+
+    Returns None if the whole file should be sent, or False if the range can
+    not be satisfied. Requests for more than one range are sent the whole
+    file.
+    """
+    header = environ.get('HTTP_RANGE', '')
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    if_range = environ.get('HTTP_IF_RANGE')
+    if if_range is not None:
+        if if_range.startswith(('"', 'W/')):
+            if if_range != cached.etag:
+                return None
+        else:
+            parsed = parsedate_tz(if_range)
+            if parsed is None or int(cached.mtime) != mktime_tz(parsed):
+                return None
+    start, sep, end = header[6:].strip().partition('-')
+    try:
+        if not sep:
+            return None
+        elif not start:
+            suffix = int(end)
+            if suffix <= 0:
+                return False
+            start, end = max(0, cached.size - suffix), cached.size - 1
+        else:
+            start = int(start)
+            end = min(int(end), cached.size - 1) if end else cached.size - 1
+    except ValueError:
+        return None
+    if start >= cached.size:
+        return False
+    if start > end:
+        return None
+    return start, end
+
+
+def etag_matches(environ, etag):
+    """Return True if the If-None-Match header of a request matches etag,
+    using the weak comparison"""
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for candidate in environ.get('HTTP_IF_NONE_MATCH', '').split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+
+def not_modified(environ, cached):
+    "Return True if a conditional request matches the cached file"
+    if environ.get('HTTP_IF_NONE_MATCH') is not None:
+        return etag_matches(environ, cached.etag)
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None:
+        parsed = parsedate_tz(if_modified_since.split(';')[0])
+        if parsed is None:
+            return False
+        return int(cached.mtime) <= mktime_tz(parsed)
+    return False
@@ -0,0 +1,62 @@
+"""Incremental serialization of Genshi template output.
+
+Genshi serializes event streams lazily, one token at a time. The functions in
+this module encode those tokens and gather them into byte chunks suitable for
+use as a WSGI application iterator. This avoids holding the complete rendered
+page in memory before the first byte is sent to the client.
+"""
+import itertools
+
+from genshi.output import TextSerializer
+
+__all__ = ['iter_chunks', 'prime']
+
+
+def _errors(method):
+    "Encoding error handler for a serialization method, as used by Genshi"
+    if method != 'text' and not isinstance(method, TextSerializer):
+        return 'xmlcharrefreplace'
+    return 'replace'
+
+
+def iter_chunks(stream, encoding='utf-8', size=8192, flush=()):
+    """Serialize a Genshi stream into encoded chunks.
+
+    Chunks are at least size bytes long, except for the last chunk. A chunk is
+    also emitted early after any serialized token containing one of the flush
+    markers, such as '</head>', so that the client may begin fetching linked
+    resources.
+    """
+    method = stream.serializer or 'xml'
+    errors = _errors(method)
+    buffered = []
+    length = 0
+    for text in stream.serialize(method):
+        data = text.encode(encoding, errors)
+        buffered.append(data)
+        length += len(data)
+        if length >= size or _has_marker(text, flush):
+            yield ''.join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+def _has_marker(text, markers):
+    for marker in markers:
+        if marker in text:
+            return True
+    return False
+
+
+def prime(chunks):
+    """Evaluate the first chunk of an iterator, returning a new iterator.
+
+    Errors raised while producing the first chunk propagate to the caller,
+    while the response status can still be changed.
+    """
+    chunks = iter(chunks)
+    for first in chunks:
+        return itertools.chain([first], chunks)
+    return iter([])
@@ -0,0 +1,196 @@
+"""Persistent cache of compiled Genshi templates.
+
+Compiled templates are pickled to a cache directory, so that new processes
+can load templates without parsing and compiling the template source. Code
+objects are serialized with the marshal module.
+
+Each template has a single cache file, named from a hash of the template path,
+template class and encoding. The file starts with metadata recording the
+modification time and size of the template source, and the versions of
+Genshi and Python. Entries with metadata that does not match, and entries
+that can not be loaded, are ignored and replaced.
+
+Entries are written to a temporary file and renamed into place, so that
+processes sharing the cache directory never read a partially written entry.
+
+Loading an entry runs code, so the directory is created readable and
+writable only by its owner, and a directory owned by another user or
+writable by others is refused.
+"""
+import errno
+import hashlib
+import imp
+import marshal
+import os
+import sys
+import tempfile
+import types
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import genshi
+
+__all__ = ['TemplateCache', 'private_directory']
+
+VERSION = (1, getattr(genshi, '__version__', None), sys.version,
+           imp.get_magic())
+
+
+class TemplateCache(object):
+    """Directory of compiled templates.
+
+    The directory is created if it does not exist. Raises ValueError if the
+    directory is owned by another user, or writable by group or others.
+    """
+
+    def __init__(self, directory):
+        self.directory = private_directory(directory, 'Template cache')
+
+    def _pathname(self, cls, filepath, encoding):
+        key = '\0'.join((cls.__module__, cls.__name__, filepath,
+                         encoding or ''))
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, digest + '.pickle')
+
+    def _metadata(self, loader, filepath, stat):
+        return (VERSION, filepath, stat.st_mtime, stat.st_size,
+                loader.variable_lookup, loader.allow_exec)
+
+    def load(self, loader, cls, filepath, encoding, stat):
+        """Return a cached template, or None if the cache entry is missing or
+        stale. stat is the result of os.stat for the template source.
+        """
+        pathname = self._pathname(cls, filepath, encoding)
+        try:
+            fileobj = open(pathname, 'rb')
+        except IOError:
+            return None
+        try:
+            unpickler = pickle.Unpickler(fileobj)
+            unpickler.persistent_load = _persistent_load(loader)
+            if unpickler.load() != self._metadata(loader, filepath, stat):
+                return None
+            return unpickler.load()
+        except Exception:
+            return None
+        finally:
+            fileobj.close()
+
+    def save(self, loader, tmpl, encoding, stat):
+        """Add a compiled template to the cache.
+
+        Returns True if the template was written to the cache.
+        """
+        pathname = self._pathname(type(tmpl), tmpl.filepath, encoding)
+        fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fileobj:
+                pickler = pickle.Pickler(fileobj, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = _persistent_id(loader)
+                pickler.dump(self._metadata(loader, tmpl.filepath, stat))
+                pickler.dump(tmpl)
+            os.rename(temppath, pathname)
+        except Exception:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+            return False
+        return True
+
+
+def private_directory(directory, description):
+    """Create a directory of cached code if it does not exist, readable and
+    writable only by its owner, and return its absolute path.
+
+    Raises ValueError if the directory is owned by another user, or writable
+    by group or others.
+    """
+    directory = os.path.abspath(directory)
+    try:
+        os.makedirs(directory, 0700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid():
+        raise ValueError("{0} directory {1} is not owned by the current "
+                         "user".format(description, directory))
+    if stat.st_mode & 022:
+        raise ValueError("{0} directory {1} is writable by other "
+                         "users".format(description, directory))
+    return directory
+
+
+def _closure(func):
+    "Return closure contents, with references to func itself replaced"
+    if func.func_closure is None:
+        return None
+    closure = []
+    for cell in func.func_closure:
+        value = cell.cell_contents
+        if value is func:
+            closure.append((True, None))
+        else:
+            closure.append((False, value))
+    return tuple(closure)
+
+
+def _cell(value=None):
+    "Create a closure cell holding value"
+    return (lambda: value).func_closure[0]
+
+
+def _function(code, module, name, defaults, closure):
+    """Reverse of the function persistent id.
+
+    Cells referring to the function itself are cells of func, which the
+    assignment of the function fills in.
+    """
+    __import__(module)
+    func = None
+    cells = None
+    if closure is not None:
+        cells = []
+        for recursive, value in closure:
+            if recursive:
+                cells.append((lambda: func).func_closure[0])
+            else:
+                cells.append(_cell(value))
+        cells = tuple(cells)
+    func = types.FunctionType(code, sys.modules[module].__dict__, name,
+                              defaults, cells)
+    return func
+
+
+def _persistent_id(loader):
+    """Pickle the loader by reference, code objects using marshal and
+    functions by their code and closure"""
+    def persistent_id(obj):
+        if obj is loader:
+            return ('loader',)
+        if isinstance(obj, types.CodeType):
+            return ('code', marshal.dumps(obj))
+        if isinstance(obj, types.FunctionType):
+            return ('function', obj.func_code, obj.__module__, obj.func_name,
+                    obj.func_defaults, _closure(obj))
+        return None
+    return persistent_id
+
+
+def _persistent_load(loader):
+    "Reverse of _persistent_id"
+    def persistent_load(pid):
+        if pid[0] == 'loader':
+            return loader
+        if pid[0] == 'code':
+            return marshal.loads(pid[1])
+        if pid[0] == 'function':
+            return _function(*pid[1:])
+        raise pickle.UnpicklingError("Unknown persistent id")
+    return persistent_load
@@ -0,0 +1,86 @@
+"""Timing of the phases of request handling.
+
+A Timings object records the time spent in each phase of a request, such as
+resolving the route or rendering the template, and formats the timings as a
+Server-Timing header. The NULL object has the same interface but records
+nothing, so that timing costs next to nothing when disabled. The Timings of
+a request are stored in the WSGI environ for middleware to log.
+"""
+from contextlib import contextmanager
+from timeit import default_timer
+
+__all__ = ['Timings', 'NULL', 'ENVIRON_KEY']
+
+# WSGI environ key of the Timings of a request
+ENVIRON_KEY = 'mod_genshi.timings'
+
+
+class Timings(object):
+    """Durations of the phases of a request, in seconds.
+
+    The phases attribute is a list of [name, seconds] pairs in the order the
+    phases first started. Time spent in a phase more than once is added up.
+    """
+
+    def __init__(self, clock=default_timer):
+        self.clock = clock
+        self.started = clock()
+        self.phases = []
+        self._index = {}
+
+    def add(self, name, seconds):
+        "Add time spent in a phase"
+        index = self._index.get(name)
+        if index is None:
+            self._index[name] = len(self.phases)
+            self.phases.append([name, seconds])
+        else:
+            self.phases[index][1] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        "Context manager timing a phase"
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, self.clock() - started)
+
+    def header(self):
+        "Return a Server-Timing header value, including the total so far"
+        phases = self.phases + [['total', self.clock() - self.started]]
+        return ', '.join('{0};dur={1:.3f}'.format(name, seconds * 1000)
+                         for name, seconds in phases)
+
+    def start_response(self, start_response):
+        "Wrap a WSGI start_response callable to add a Server-Timing header"
+        def timed_start_response(status, headers, exc_info=None):
+            headers = list(headers)
+            headers.append(('Server-Timing', self.header()))
+            return start_response(status, headers, exc_info)
+        return timed_start_response
+
+
+class _NullPhase(object):
+    "Context manager that does nothing"
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _NullTimings(object):
+    "Timings that records nothing"
+
+    _phase = _NullPhase()
+
+    def add(self, name, seconds):
+        pass
+
+    def phase(self, name):
+        return self._phase
+
+
+NULL = _NullTimings()
@@ -0,0 +1,236 @@
+"""File change detection backends.
+
+The importer and template loader detect changes to source files using a
+watcher. The default Watcher class does not receive change notifications, so
+the modification time of every file has to be polled whenever changes are
+checked. The InotifyWatcher class uses the Linux inotify API from a background
+thread, calling a callback as soon as a watched file changes. Files reported
+as watched only need to be checked after a callback for them.
+
+To create a watcher by name, use the create function.
+
+As an alternative to watchers, the Throttle class limits how often files are
+polled for changes.
+"""
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+__all__ = ['Watcher', 'InotifyWatcher', 'Throttle', 'create']
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0x00080000
+
+EVENT = struct.Struct('iIII')
+
+
+class Watcher(object):
+    """Change detection backend that relies on polling.
+
+    Subclasses that receive change notifications override watch.
+    """
+
+    def watch(self, pathname, callback):
+        """Request notification of changes to pathname.
+
+        Returns True if callback will be called with pathname when the file
+        changes, or False if the file must be polled for changes.
+        """
+        return False
+
+    def close(self):
+        "Stop watching for changes"
+
+
+class InotifyWatcher(Watcher):
+    """Change detection backend using Linux inotify.
+
+    Watches the directory containing each file, so that files replaced by
+    editors using rename are still reported. Watching a directory also
+    reports changes to the entries of that directory. Callbacks are called
+    from a background thread.
+
+    Raises OSError if inotify is not available.
+    """
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+            IN_MOVE_SELF)
+
+    def __init__(self):
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self._wakeup = os.pipe()
+        self._lock = threading.Lock()
+        self._dirs = {}
+        self._wds = {}
+        self._callbacks = {}
+        self._thread = threading.Thread(target=self._run,
+                                        name='mod_genshi.watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _add_watch(self, dirpath):
+        if dirpath in self._wds:
+            return True
+        pathname = dirpath
+        if isinstance(pathname, unicode):
+            pathname = pathname.encode(sys.getfilesystemencoding() or 'utf-8')
+        wd = self._libc.inotify_add_watch(self._fd, pathname,
+                                          self.MASK | IN_ONLYDIR)
+        if wd < 0:
+            return False
+        self._wds[dirpath] = wd
+        self._dirs[wd] = dirpath
+        return True
+
+    def watch(self, pathname, callback):
+        "Request notification of changes to pathname."
+        pathname = os.path.abspath(pathname)
+        dirpaths = [os.path.dirname(pathname)]
+        if os.path.isdir(pathname):
+            dirpaths.append(pathname)
+        with self._lock:
+            for dirpath in dirpaths:
+                if not self._add_watch(dirpath):
+                    return False
+            callbacks = self._callbacks.setdefault(pathname, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+        return True
+
+    def _notify(self, pathnames):
+        with self._lock:
+            calls = [(callback, pathname) for pathname in pathnames
+                     for callback in self._callbacks.get(pathname, ())]
+        for callback, pathname in calls:
+            callback(pathname)
+
+    def _dispatch(self, data):
+        changed = set()
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            with self._lock:
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self._callbacks)
+                    continue
+                dirpath = self._dirs.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self._dirs[wd]
+                    del self._wds[dirpath]
+                    prefix = dirpath + os.sep
+                    changed.update(pathname for pathname in self._callbacks
+                                   if pathname.startswith(prefix))
+            changed.add(dirpath)
+            if name:
+                changed.add(os.path.join(dirpath, name))
+        self._notify(changed)
+
+    def _run(self):
+        wakeup = self._wakeup[0]
+        while True:
+            try:
+                readable = select.select([self._fd, wakeup], [], [])[0]
+                if wakeup in readable:
+                    break
+                data = os.read(self._fd, 64 * 1024)
+            except (OSError, select.error) as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                break
+            self._dispatch(data)
+
+    def close(self):
+        "Stop watching for changes"
+        if self._thread is None:
+            return
+        os.write(self._wakeup[1], '\0')
+        self._thread.join()
+        self._thread = None
+        for fd in (self._fd,) + self._wakeup:
+            os.close(fd)
+
+
+class Throttle(object):
+    """Limit how often an action is performed.
+
+    The ready method returns True at most once every interval seconds, even
+    when called from several threads at the same time. An interval of 0 means
+    always ready, and None means never ready.
+    """
+
+    def __init__(self, interval, clock=time.time):
+        self.interval = interval
+        self.clock = clock
+        self._next = None
+        self._lock = threading.Lock()
+
+    def ready(self):
+        "Return True if the action should be performed now"
+        if self.interval is None:
+            return False
+        if not self.interval:
+            return True
+        now = self.clock()
+        if self._next is not None and now < self._next:
+            return False
+        with self._lock:
+            if self._next is not None and now < self._next:
+                return False
+            self._next = now + self.interval
+            return True
+
+
+def _libc():
+    "Return the C library, if it supports inotify"
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (AttributeError, OSError):
+        raise OSError(errno.ENOSYS, "inotify is not available")
+    return libc
+
+
+def create(backend='auto'):
+    """Create a watcher by name.
+
+    Backends are 'poll', 'inotify' and 'auto'. The 'auto' backend uses inotify
+    when available, and polling otherwise.
+    """
+    if backend == 'poll':
+        return Watcher()
+    elif backend == 'inotify':
+        return InotifyWatcher()
+    elif backend == 'auto':
+        try:
+            return InotifyWatcher()
+        except OSError:
+            return Watcher()
+    raise ValueError("Unknown watcher backend '{0}'".format(backend))
@@ -1,30 +1,189 @@
 """WSGI application class for mod_genshi
 """
+from collections import namedtuple
+import fnmatch
+import hashlib
 import mimetypes
 import os
 import re
 
-from genshi.template import TemplateLoader, TemplateNotFound, TemplateError
+from genshi.template import TemplateNotFound, TemplateError
 from genshi.template import MarkupTemplate, NewTextTemplate
 from webob import Request, Response
 from webob.exc import HTTPNotFound, HTTPForbidden, HTTPError, HTTPServerError
 from webob.static import DirectoryApp
 
+from mod_genshi import cache
+from mod_genshi import compression
 from mod_genshi import configuration
+from mod_genshi import generation
 from mod_genshi import importer
+from mod_genshi import loader
+from mod_genshi import memoize
+from mod_genshi import metrics
+from mod_genshi import profiling
+from mod_genshi import resources
+from mod_genshi import static
+from mod_genshi import streaming
+from mod_genshi import templatecache
+from mod_genshi import timing
+from mod_genshi import watcher
 
 __all__ = ['WSGI']
 
+# rendered template response stored in the output cache
+Page = namedtuple('Page', 'template includes status headerlist body')
+
+# request path resolved to a template or static file, or an error response
+Route = namedtuple('Route', 'path style content_type encoding error')
+
+# WSGI environ key of the Route of a request, once resolved
+ROUTE_KEY = 'mod_genshi.route'
+
 
 class WSGI(object):
     """mod_genshi WSGI application."""
 
-    def __init__(self, base=os.curdir):
-        self.config = configuration.Config(base)
-        self.static = DirectoryApp(self.config.staticdir)
-        self.loader = TemplateLoader(self.config.templatedir,
-                                     auto_reload=True)
-        self.importer = importer.register(self.config.pythondir)
+    def __init__(self, base=os.curdir, **settings):
+        self.config = configuration.Config(base, **settings)
+        self.watcher = watcher.create(self.config.reload_watcher)
+        interval = self.config.reload_check_interval
+        if interval == 'never':
+            interval = None
+        else:
+            interval = interval / 1000.0
+        self.reload_throttle = watcher.Throttle(interval)
+        self.static = static.StaticCache(self.config.staticdir,
+                                         DirectoryApp(self.config.staticdir),
+                                         self.config.static_cache_bytes,
+                                         self.config.static_cache_file_bytes,
+                                         watcher=self.watcher,
+                                         check_interval=interval)
+        template_cache = None
+        if self.config.template_cache_dir is not None:
+            template_cache = templatecache.TemplateCache(
+                self.config.template_cache_dir)
+        self.loader = loader.Loader(self.config.templatedir,
+                                    auto_reload=True, watcher=self.watcher,
+                                    check_interval=interval,
+                                    template_cache=template_cache)
+        self.importer = importer.register(self.config.pythondir,
+                                          self.watcher,
+                                          self.config.python_packages,
+                                          self.config.python_cache_dir)
+        self.pages = cache.LRUCache(self.config.output_cache_entries,
+                                    self.config.output_cache_bytes)
+        self.generation = generation.Generation()
+        memoize.REGISTRY.set_generation(self.generation)
+        self.routes = cache.LRUCache(self.config.route_cache_entries)
+        self.metrics = None
+        if self.config.metrics_path is not None:
+            self.metrics = metrics.Metrics(self.config.metrics_dir)
+            self.metrics.collectors.append(self._loader_stats)
+            self.metrics.collectors.append(memoize.REGISTRY.collect)
+        self.profiler = None
+        if self.config.profile_dir is not None:
+            self.profiler = profiling.Profiler(
+                self.config.profile_dir, self.config.profile_every,
+                self.config.profile_paths, self.config.profile_header,
+                self.config.profile_max_bytes, self.config.profile_backups)
+        if self.config.frozen:
+            self.freeze()
+
+    def _iter_files(self, basepath):
+        "Yield paths relative to basepath of files that are not hidden"
+        for dirpath, dirnames, filenames in os.walk(basepath):
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, basepath)
+
+    def _precompile(self):
+        "Compile every template file, returning the number compiled"
+        compiled = 0
+        for path in self._iter_files(self.config.templatedir):
+            style = self._get_template_style(path)
+            if style is None:
+                continue
+            try:
+                self._is_template_path_blocked(path)
+                self.loader.load(path, cls=style)
+            except (HTTPError, TemplateError):
+                continue
+            compiled += 1
+        return compiled
+
+    def _is_package(self, parts):
+        "Return True if a directory and all its parents are packages"
+        for index in range(1, len(parts) + 1):
+            path = os.path.join(self.config.pythondir, *parts[:index])
+            if not os.path.isfile(os.path.join(path, '__init__.py')):
+                return False
+        return True
+
+    def _preimport(self):
+        "Import every package, and the modules of packages"
+        names = []
+        for path in self._iter_files(self.config.pythondir):
+            dirname, filename = os.path.split(path)
+            module, suffix = os.path.splitext(filename)
+            if not dirname or suffix != '.py':
+                continue
+            package = dirname.split(os.sep)
+            if not self._is_package(package):
+                continue
+            if module != '__init__':
+                package.append(module)
+            names.append('.'.join(package))
+        for name in sorted(names):
+            try:
+                __import__(name)
+            except Exception:
+                continue
+
+    def freeze(self):
+        """Compile all templates and import all modules, then stop checking
+        for changes to either, or to cached static files.
+
+        Templates that fail to compile and modules that fail to import are
+        skipped, and will fail again when requested.
+        """
+        compiled = self._precompile()
+        if self.loader._cache.capacity < compiled:
+            self.loader._cache.capacity = compiled
+        self._preimport()
+        self.loader.check_interval = None
+        self.static.check_interval = None
+        self.reload_throttle.interval = None
+
+    def close(self):
+        "Close resources declared by modules and templates"
+        resources.REGISTRY.close()
+
+    def after_fork(self):
+        """Prepare a forked worker process to handle requests.
+
+        Watchers receiving notifications from a background thread stop
+        working in forked processes, as the thread is not copied. These are
+        replaced with a new watcher. Metrics are published for the metrics
+        of all workers to be added up. Resources created by the parent
+        process are discarded, and counts of memoized functions reset.
+        """
+        resources.REGISTRY.after_fork()
+        memoize.REGISTRY.after_fork()
+        if self.metrics is not None:
+            self.loader.stats.clear()
+            self.metrics.after_fork()
+        if self.config.reload_watcher == 'poll':
+            return
+        self.watcher = watcher.create(self.config.reload_watcher)
+        self.loader.rewatch(self.watcher)
+        self.importer.rewatch(self.watcher)
+        self.static.rewatch(self.watcher)
+        self.routes.clear()
 
     def _is_path_blocked(self, basepath, relpath):
         "Raise HTTPForbidden if path is blocked"
@@ -56,6 +215,81 @@ class WSGI(object):
             path += self.config.index
         return path
 
+    def is_static(self, environ):
+        "Return True if a request is for a static file, not a template"
+        return self._request_route(environ).style is None
+
+    def _resolve(self, url):
+        "Resolve request path to a Route"
+        path = self._get_basic_path(url)
+        style = self._get_template_style(path)
+        content_type = encoding = None
+        try:
+            if style:
+                self._is_template_path_blocked(path)
+                basepath = self.config.templatedir
+                content_type, encoding = self._guess_type(path)
+            else:
+                self._is_static_path_blocked(path)
+                basepath = self.config.staticdir
+        except HTTPForbidden:
+            return Route(path, style, None, None, HTTPForbidden)
+        if not os.path.isfile(os.path.join(basepath, path)):
+            return Route(path, style, None, None, HTTPNotFound)
+        return Route(path, style, content_type, encoding, None)
+
+    def _request_route(self, environ):
+        """Return the Route of a request, resolved once per request and kept
+        in the environ"""
+        route = environ.get(ROUTE_KEY)
+        if route is None:
+            route = environ[ROUTE_KEY] = self._route(Request(environ).path)
+        return route
+
+    def _routes_changed(self, pathname):
+        "Discard cached routes after a change to the files they resolve to"
+        self.routes.clear()
+
+    def _route(self, url):
+        """Return the Route for a request path, using the route cache.
+
+        Routes are cached until the watcher reports a change to the
+        directory of the file or to any directory above it within the base
+        directory, such as a file or symbolic link being removed or replaced.
+        If these directories are not watched, or are outside the base
+        directory as for paths escaping it, routes are cached for the check
+        interval.
+        """
+        route = self.routes.get(url)
+        if route is not None:
+            return route
+        route = self._resolve(url)
+        interval = self.loader.check_interval
+        basepath = os.path.abspath(
+            self.config.templatedir if route.style else self.config.staticdir)
+        dirpath = os.path.dirname(os.path.abspath(os.path.join(basepath,
+                                                               route.path)))
+        inside = dirpath == basepath or dirpath.startswith(basepath + os.sep)
+        if interval is None or \
+                inside and self._watch_directories(basepath, dirpath):
+            self.routes.set(url, route)
+        elif interval:
+            self.routes.set(url, route, ttl=interval)
+        return route
+
+    def _watch_directories(self, basepath, dirpath):
+        """Watch a directory and the directories above it up to basepath,
+        returning True if all are watched"""
+        while True:
+            if not self.watcher.watch(dirpath, self._routes_changed):
+                return False
+            if dirpath == basepath:
+                return True
+            parent = os.path.dirname(dirpath)
+            if parent == dirpath:
+                return True
+            dirpath = parent
+
     def _get_template_style(self, path):
         "Return class for template type"
         if path.endswith(self.config.suffix_markup):
@@ -64,42 +298,348 @@ class WSGI(object):
             return NewTextTemplate
         return None
 
-    def _headers(self, template, response):
-        "Populate '200 OK' HTTP response, guessing the content type"
+    def _guess_type(self, template):
+        "Guess the content type and encoding of template output"
         content_type, encoding = mimetypes.guess_type(template)
-        if encoding is not None:
-            response.content_encoding = encoding
         if content_type is None:
             content_type = self.config.default_content_type
+        return content_type, encoding
+
+    def _headers(self, template, response, guessed=None):
+        """Populate '200 OK' HTTP response, guessing the content type unless
+        the content type and encoding are given as guessed"""
+        content_type, encoding = guessed or self._guess_type(template)
+        if encoding is not None:
+            response.content_encoding = encoding
         response.content_type = content_type
         response.status_code = 200
 
     def _body(self, path, style, request, response):
-        "Generate response body from Genshi template"
+        """Generate response body from Genshi template.
+
+        Only the first chunk of streamed output is included in the render
+        timing.
+        """
+        timings = request.environ.get(timing.ENVIRON_KEY, timing.NULL)
+        with timings.phase('load'):
+            template = self.loader.load(path, cls=style)
+        with timings.phase('generate'):
+            stream = template.generate(REQUEST=request, RESPONSE=response)
+        with timings.phase('render'):
+            if self.config.stream:
+                chunks = streaming.iter_chunks(
+                    stream, size=self.config.stream_chunk_size,
+                    flush=self.config.stream_flush)
+                response.app_iter = streaming.prime(chunks)
+            else:
+                response.body = stream.render()
+
+    def _accepts_gzip(self, request):
+        "Return True if template output may be compressed for request"
+        if not self.config.compress:
+            return False
+        accepted = static.negotiate_encoding(request.environ, ('gzip',))
+        return accepted is not None
+
+    def _compress(self, request, response):
+        """Compress the response body if the content type is compressible and
+        the client accepts gzip"""
+        if not self.config.compress or response.status_int != 200 or \
+                response.content_encoding is not None or \
+                response.content_type not in self.config.compress_types:
+            return
+        response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+        if not self._accepts_gzip(request):
+            return
+        level = self.config.compress_level
+        if response.content_length is None:
+            response.app_iter = compression.gzip_chunks(response.app_iter,
+                                                        level)
+        elif response.content_length >= self.config.compress_min_bytes:
+            response.body = compression.gzip_body(response.body, level)
+        else:
+            return
+        response.content_encoding = 'gzip'
+
+    def _is_cacheable_request(self, request):
+        "Return True if the output cache may answer request"
+        if not self.config.output_cache:
+            return False
+        return request.method in ('GET', 'HEAD')
+
+    def _is_cacheable_response(self, response):
+        "Return True if response may be stored in the output cache"
+        if response.status_int != 200 or 'Set-Cookie' in response.headers:
+            return False
+        cache_control = response.cache_control
+        return not (cache_control.no_store or cache_control.private)
+
+    def _page_key(self, path, request):
+        "Output cache key for a request"
+        headers = tuple(request.headers.get(name)
+                        for name in self.config.output_cache_vary)
+        return (path, request.query_string, headers,
+                self._accepts_gzip(request))
+
+    def _page_ttl(self, path):
+        "Return the time to live of output cached for path"
+        for pattern, ttl in self.config.output_cache_path_ttl:
+            if fnmatch.fnmatch(path, pattern):
+                return ttl
+        return self.config.output_cache_ttl
+
+    def _store_page(self, key, path, template, response):
+        "Add response to the output cache once the body is complete"
+        ttl = self._page_ttl(path)
+        if ttl is not None and ttl <= 0:
+            return
+        if not self._is_cacheable_response(response):
+            return
+        headerlist = list(response.headerlist)
+        includes = self.loader.mtimes(
+            self.loader.dependencies(template.filepath))
+
+        def store(body):
+            page = Page(template, includes, response.status, headerlist, body)
+            self.pages.set(key, page, size=len(body), ttl=ttl)
+
+        if response.content_length is not None:
+            store(response.body)
+        else:
+            response.app_iter = _collect(response.app_iter, store,
+                                         self.pages.max_size)
+
+    def _mtime_etag(self, route, request):
+        """Return a weak ETag from the modification times of a template, the
+        templates it includes and the modules they import, and the request
+        headers output depends on.
+
+        Included templates are only reloaded when rendering, so the current
+        modification times of included templates that changed are used.
+        """
+        template = self.loader.load(route.path, cls=route.style)
+        templates = self.loader.dependencies(template.filepath)
+        templates.add(template.filepath)
+        mtimes = self.loader.mtimes(templates)
+        for filepath in self.loader.modified(mtimes):
+            try:
+                mtimes[filepath] = os.path.getmtime(filepath)
+            except OSError:
+                mtimes[filepath] = None
+        modules = self.importer.mtimes(self.loader.imports(templates))
+        headers = tuple(request.headers.get(name)
+                        for name in self.config.output_cache_vary)
+        key = repr((sorted(mtimes.items()),
+                    sorted(modules.items()), request.query_string, headers,
+                    self._accepts_gzip(request)))
+        return 'W/"{0}"'.format(hashlib.md5(key).hexdigest())
+
+    def _content_etag(self, response):
+        "Return a strong ETag of the response body, or None if streamed"
+        if response.content_length is None:
+            return None
+        return '"{0}"'.format(hashlib.md5(response.body).hexdigest())
+
+    def _not_modified(self, etag, response=None):
+        "Return a '304 Not Modified' response, copying headers of response"
+        headerlist = [('ETag', etag)]
+        if response is not None:
+            for name in ('Cache-Control', 'Vary'):
+                if name in response.headers:
+                    headerlist.append((name, response.headers[name]))
+        not_modified = Response(status=304, headerlist=headerlist)
+        del not_modified.content_length
+        return not_modified
+
+    def _render(self, route, request, response):
+        """Generate template response with an ETag if enabled, answering
+        matching conditional requests with '304 Not Modified'.
+
+        With mtime ETags, matching requests are answered without rendering.
+        """
+        mode = self.config.template_etag
+        if mode == 'mtime':
+            etag = self._mtime_etag(route, request)
+            if static.etag_matches(request.environ, etag):
+                return self._not_modified(etag)
+        response = self._render_page(route, request, response)
+        if response.status_int != 200:
+            return response
+        if mode == 'content':
+            etag = self._content_etag(response)
+        elif mode != 'mtime':
+            etag = None
+        if etag is None:
+            return response
+        response.headers['ETag'] = etag
+        if static.etag_matches(request.environ, etag):
+            return self._not_modified(etag, response)
+        return response
+
+    def _render_page(self, route, request, response):
+        "Generate template response, using the output cache if enabled"
+        path, style = route.path, route.style
+        guessed = (route.content_type, route.encoding)
+        if not self._is_cacheable_request(request):
+            self._headers(path, response, guessed)
+            self._body(path, style, request, response)
+            self._compress(request, response)
+            return response
         template = self.loader.load(path, cls=style)
-        stream = template.generate(REQUEST=request, RESPONSE=response)
-        response.body = stream.render()
+        key = self._page_key(path, request)
+        page = self.pages.get(key)
+        if page is not None and page.template is template and \
+                not self.loader.modified(page.includes):
+            return Response(body=page.body, status=page.status,
+                            headerlist=list(page.headerlist))
+        self._headers(path, response, guessed)
+        if self.config.output_cache_vary:
+            response.vary = self.config.output_cache_vary
+        self._body(path, style, request, response)
+        self._compress(request, response)
+        self._store_page(key, path, template, response)
+        return response
 
     def _reload(self):
-        if self.importer.ismodified:
-            self.importer.clear()
-            self.loader._cache.clear()
+        """Unload modified modules and discard output depending on them.
+
+        Modules are unloaded once requests rendering templates have finished,
+        by advancing the generation.
+        """
+        if not self.reload_throttle.ready():
+            return
+        self.importer.refresh()
+        if not self.importer.ismodified:
+            return
+        with self.generation.advance():
+            modules = self.importer.reload_modified()
+            if not modules:
+                return
+            if self.metrics is not None:
+                self.metrics.inc('mod_genshi_reloads_total')
+                self.metrics.inc('mod_genshi_modules_unloaded_total',
+                                 value=len(modules))
+            templates = self.loader.dependents(modules=modules)
+            memoize.REGISTRY.invalidate(modules, templates)
+            self.pages.discard_if(
+                lambda key, page: page.template.filepath in templates)
+
+    def _loader_stats(self):
+        "Return template load counters for the metrics"
+        return [('mod_genshi_template_loads_total', (('result', result),),
+                 count) for result, count in self.loader.stats.items()]
+
+    def _serve_metrics(self, environ, start_response):
+        "Serve the metrics of the server"
+        body = self.metrics.render()
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _measure(self, environ, start_response):
+        """Serve a HTTP request, recording metrics.
+
+        Streamed responses are recorded once exhausted or closed, so that the
+        duration includes rendering and errors while rendering are counted.
+        """
+        started = self.metrics.clock()
+        response = []
+
+        def measured_start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return start_response(status, headers, exc_info)
+
+        def failed():
+            response[:] = ['500 Internal Server Error', []]
+
+        def record():
+            self._record(environ, response, self.metrics.clock() - started)
+
+        try:
+            chunks = self._dispatch(environ, measured_start_response)
+        except Exception:
+            failed()
+            record()
+            raise
+        if isinstance(chunks, (list, tuple)):
+            record()
+            return chunks
+        return ClosingIterator(chunks, record, failed)
+
+    def _template_name(self, environ):
+        "Return the template a request is for, or '' if it is not"
+        route = self._request_route(environ)
+        if route.style and route.error is None:
+            return route.path
+        return ''
+
+    def _record(self, environ, response, duration):
+        "Record metrics of a response"
+        template = self._template_name(environ)
+        status, headers = response or ('500 Internal Server Error', [])
+        code = int(status.split(None, 1)[0])
+        self.metrics.inc('mod_genshi_requests_total',
+                         (('template', template), ('status', code)))
+        if code >= 400:
+            self.metrics.inc('mod_genshi_errors_total', (('status', code),))
+        self.metrics.observe('mod_genshi_request_duration_seconds',
+                             (('template', template),), duration)
+        for name, value in headers:
+            if name.lower() == 'content-length' and value.isdigit():
+                self.metrics.inc('mod_genshi_response_bytes_total',
+                                 (('template', template),), int(value))
+
+    def _dispatch(self, environ, start_response):
+        """Serve a HTTP request, under cProfile if sampled.
+
+        Streamed output is only profiled up to the first chunk.
+        """
+        if self.profiler is None or not self.profiler.sampled(environ):
+            return self._serve(environ, start_response)
+        return self.profiler.run(self._template_name(environ), self._serve,
+                                 environ, start_response)
 
     def __call__(self, environ, start_response):
+        "Serve a HTTP request, or the metrics if enabled"
+        if self.metrics is None:
+            return self._dispatch(environ, start_response)
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if path == self.config.metrics_path:
+            return self._serve_metrics(environ, start_response)
+        return self._measure(environ, start_response)
+
+    def _serve(self, environ, start_response):
         "Serve a HTTP request"
+        timings = timing.NULL
+        if self.config.server_timing:
+            timings = environ[timing.ENVIRON_KEY] = timing.Timings()
+            start_response = timings.start_response(start_response)
         request = Request(environ)
         response = Response()
         try:
-            path = self._get_basic_path(request.path)
-            style = self._get_template_style(request.path)
-            if style:
-                self._is_template_path_blocked(path)
-                self._reload()
-                self._headers(path, response)
-                self._body(path, style, request, response)
+            with timings.phase('route'):
+                route = self._request_route(environ)
+            if route.error is not None:
+                raise route.error(comment=route.path)
+            if route.style:
+                with timings.phase('reload'):
+                    self._reload()
+                # streamed output is rendered while the response is iterated,
+                # so the generation is left once it is exhausted or closed
+                self.generation.enter()
+                try:
+                    response = self._render(route, request, response)
+                    chunks = response(environ, start_response)
+                except BaseException:
+                    self.generation.leave()
+                    raise
+                if isinstance(chunks, (list, tuple)):
+                    self.generation.leave()
+                    return chunks
+                return ClosingIterator(chunks, self.generation.leave)
             else:
-                self._is_static_path_blocked(path)
-                response = request.get_response(self.static)
+                return self.static(environ, start_response)
         except TemplateNotFound:
             response = HTTPNotFound(comment=request.path)
         except TemplateError:
@@ -107,3 +647,57 @@ class WSGI(object):
         except HTTPError as err:
             response = err
         return response(environ, start_response)
+
+
+class ClosingIterator(object):
+    """Iterable of response chunks, calling callback once the chunks are
+    exhausted, or when closed by the server after closing chunks. If
+    iterating the chunks raises an exception, error is called before
+    callback."""
+
+    def __init__(self, chunks, callback, error=None):
+        self.chunks = chunks
+        self.callback = callback
+        self.error = error
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                yield chunk
+        except Exception:
+            if self.error is not None:
+                self.error()
+            self._done()
+            raise
+        self._done()
+
+    def _done(self):
+        callback, self.callback = self.callback, None
+        if callback is not None:
+            callback()
+
+    def close(self):
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            self._done()
+
+
+def _collect(chunks, callback, limit=None):
+    """Yield chunks, passing the joined body to callback once exhausted.
+
+    The body is not collected if it grows larger than limit.
+    """
+    collected = []
+    length = 0
+    for chunk in chunks:
+        if collected is not None:
+            length += len(chunk)
+            if limit is not None and length > limit:
+                collected = None
+            else:
+                collected.append(chunk)
+        yield chunk
+    if collected is not None:
+        callback(''.join(collected))
@@ -27,6 +27,7 @@ setup(
     name="mod_genshi",
     version=load_version(),
     packages=['mod_genshi'],
+    package_data={'mod_genshi': ['benchmarks/*/*']},
     zip_safe=False,
     author="Aaron Iles",
     author_email="aaron.iles@gmail.com",
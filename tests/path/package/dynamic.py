@@ -0,0 +1 @@
+module = __import__('package.' + 'module', fromlist=['module'])
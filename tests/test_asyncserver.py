@@ -0,0 +1,185 @@
+import httplib
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import unittest2
+
+from mod_genshi.asyncserver import AsyncWSGIServer, MAX_BODY_SIZE
+from mod_genshi.asyncserver import parse_request
+from mod_genshi.static import FileWrapper
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    path = environ['PATH_INFO']
+    headers = [('Content-Type', 'text/plain')]
+    if path == '/length':
+        headers.append(('Content-Length', str(len(path + body))))
+    start_response('200 OK', headers)
+    return [path, body]
+
+
+class TestParseRequest(unittest2.TestCase):
+
+    def test_request(self):
+        method, target, version, headers = parse_request(
+            'GET /path?q=1 HTTP/1.1\r\nHost: example\r\nX-Long: a\r\n b')
+        self.assertEqual((method, target, version),
+                         ('GET', '/path?q=1', 'HTTP/1.1'))
+        self.assertEqual(headers, [('Host', 'example'), ('X-Long', 'a b')])
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, parse_request, 'GET /')
+        self.assertRaises(ValueError, parse_request, 'GET / HTTP/2.0')
+        self.assertRaises(ValueError, parse_request,
+                          'GET / HTTP/1.1\r\nno colon')
+
+
+class TestAsyncWSGIServer(unittest2.TestCase):
+
+    def setUp(self):
+        self.inlined = []
+        self.server = AsyncWSGIServer(('127.0.0.1', 0), echo_app,
+                                      threads=2, inline=self.inline)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def inline(self, environ):
+        if environ['PATH_INFO'].startswith('/inline'):
+            self.inlined.append(environ['PATH_INFO'])
+            return True
+        return False
+
+    def connect(self):
+        return httplib.HTTPConnection('127.0.0.1', self.server.server_port,
+                                      timeout=5)
+
+    def raw(self, data):
+        sock = socket.create_connection(('127.0.0.1',
+                                         self.server.server_port), 5)
+        sock.sendall(data)
+        received = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            received.append(chunk)
+        sock.close()
+        return ''.join(received)
+
+    def test_keep_alive(self):
+        connection = self.connect()
+        for path in ('/one', '/two', '/inline'):
+            connection.request('GET', path)
+            response = connection.getresponse()
+            self.assertEqual(response.read(), path)
+            self.assertEqual(response.getheader('connection'), 'keep-alive')
+            self.assertEqual(response.getheader('transfer-encoding'),
+                             'chunked')
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.inlined, ['/inline'])
+        connection.close()
+
+    def test_content_length(self):
+        connection = self.connect()
+        connection.request('POST', '/length', 'body')
+        response = connection.getresponse()
+        self.assertEqual(response.read(), '/lengthbody')
+        self.assertIsNone(response.getheader('transfer-encoding'))
+        connection.close()
+
+    def test_pipelining(self):
+        data = self.raw('GET /length HTTP/1.1\r\nHost: x\r\n\r\n'
+                        'GET /inline HTTP/1.1\r\nHost: x\r\n\r\n'
+                        'GET /last HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertEqual(data.count('HTTP/1.1 200 OK'), 3)
+        self.assertLess(data.index('/length'), data.index('/inline'))
+        self.assertLess(data.index('/inline'), data.index('/last'))
+        self.assertIn('Connection: close', data)
+
+    def test_http10(self):
+        data = self.raw('GET /old HTTP/1.0\r\n\r\n')
+        self.assertIn('Connection: close', data)
+        self.assertNotIn('chunked', data)
+        self.assertTrue(data.endswith('\r\n\r\n/old'))
+
+    def test_head(self):
+        connection = self.connect()
+        connection.request('HEAD', '/length')
+        response = connection.getresponse()
+        self.assertEqual(response.read(), '')
+        self.assertEqual(response.getheader('content-length'), '7')
+        connection.close()
+
+    def test_bad_request(self):
+        data = self.raw('NONSENSE\r\n\r\n')
+        self.assertTrue(data.startswith('HTTP/1.1 400 Bad Request'))
+
+    def test_invalid_content_length(self):
+        data = self.raw('POST / HTTP/1.1\r\nContent-Length: -5\r\n\r\n')
+        self.assertTrue(data.startswith('HTTP/1.1 400 Bad Request'))
+        data = self.raw('POST / HTTP/1.1\r\nContent-Length: {0}\r\n\r\n'
+                        .format(MAX_BODY_SIZE + 1))
+        self.assertTrue(data.startswith('HTTP/1.1 413 Payload Too Large'))
+
+    def test_error(self):
+        def failing_app(environ, start_response):
+            raise RuntimeError("failed")
+        self.server.application = failing_app
+        self.server.log_error = lambda address: None
+        data = self.raw('GET / HTTP/1.1\r\n\r\n')
+        self.assertTrue(data.startswith('HTTP/1.1 500'))
+
+    def test_file_wrapper(self):
+        fileobj = tempfile.TemporaryFile()
+        fileobj.write('x' * 100000 + 'end')
+        fileobj.flush()
+        def file_app(environ, start_response):
+            self.assertIs(environ['wsgi.file_wrapper'], FileWrapper)
+            start_response('200 OK', [('Content-Length', '100001')])
+            copy = os.fdopen(os.dup(fileobj.fileno()), 'rb')
+            return environ['wsgi.file_wrapper'](copy, offset=2,
+                                                length=100001)
+        self.server.application = file_app
+        connection = self.connect()
+        for path in ('/inline', '/pool'):
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+            self.assertEqual(len(body), 100001)
+            self.assertTrue(body.endswith('xend'))
+        connection.close()
+
+    def test_backpressure(self):
+        produced = []
+        def stream_app(environ, start_response):
+            start_response('200 OK', [('Content-Length', str(32 << 20))])
+            for index in range(32):
+                produced.append(index)
+                yield 'x' * (1 << 20)
+        self.server.application = stream_app
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.settimeout(5)
+        sock.connect(('127.0.0.1', self.server.server_port))
+        sock.sendall('GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+        time.sleep(0.5)
+        self.assertLess(len(produced), 16)
+        received = 0
+        while True:
+            chunk = sock.recv(1 << 20)
+            if not chunk:
+                break
+            received += len(chunk)
+        sock.close()
+        self.assertEqual(len(produced), 32)
+        self.assertGreater(received, 32 << 20)
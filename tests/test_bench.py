@@ -0,0 +1,40 @@
+import unittest2
+
+from mod_genshi import bench
+
+
+class TestBench(unittest2.TestCase):
+
+    def test_run(self):
+        scenarios = [scenario for scenario in bench.SCENARIOS
+                     if scenario.name in ('markup-small', 'not-found',
+                                          'reload-storm')]
+        results = bench.run(scenarios=scenarios, modes=('wsgi', 'http'),
+                            requests=20, warmup=2)
+        for mode in ('wsgi', 'http'):
+            found = results['results'][mode]
+            self.assertEqual(sorted(found), ['markup-small', 'not-found',
+                                             'reload-storm'])
+            for result in found.values():
+                self.assertEqual(result['requests'], 20)
+                self.assertEqual(result['errors'], 0)
+                self.assertGreater(result['requests_per_second'], 0)
+                self.assertLessEqual(result['latency_ms']['p50'],
+                                     result['latency_ms']['max'])
+
+    def test_compare(self):
+        def results(rps):
+            return {'results': {'wsgi': {'static': {
+                'requests_per_second': rps, 'latency_ms': {'p50': 1.0}}}}}
+        lines, regressed = bench.compare(results(95.0), results(100.0))
+        self.assertFalse(regressed)
+        self.assertEqual(len(lines), 1)
+        lines, regressed = bench.compare(results(80.0), results(100.0))
+        self.assertTrue(regressed)
+        self.assertIn('SLOWER', lines[0])
+
+    def test_percentile(self):
+        ordered = range(1, 101)
+        self.assertEqual(bench.percentile(ordered, 0.5), 51)
+        self.assertEqual(bench.percentile(ordered, 1.0), 100)
+        self.assertIsNone(bench.percentile([], 0.5))
@@ -0,0 +1,81 @@
+import unittest2
+
+from mod_genshi.cache import LRUCache
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest2.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertIn('a', cache)
+
+    def test_entries(self):
+        cache = LRUCache(entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.keys(), ['c', 'a'])
+
+    def test_size(self):
+        cache = LRUCache(size=10)
+        cache.set('a', 1, size=6)
+        cache.set('b', 2, size=6)
+        self.assertEqual(cache.keys(), ['b'])
+        self.assertEqual(cache.size, 6)
+
+    def test_oversized(self):
+        cache = LRUCache(size=10)
+        cache.set('a', 1, size=11)
+        self.assertEqual(len(cache), 0)
+
+    def test_replace(self):
+        cache = LRUCache(size=10)
+        cache.set('a', 1, size=6)
+        cache.set('a', 2, size=8)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(cache.size, 8)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LRUCache(clock=clock)
+        cache.set('a', 1, ttl=5)
+        clock.now = 4
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 5
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_discard(self):
+        cache = LRUCache()
+        cache.set('a', 1, size=3)
+        cache.discard('a')
+        cache.discard('b')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_discard_if(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.discard_if(lambda key, value: value > 1)
+        self.assertEqual(cache.keys(), ['a'])
+
+    def test_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1, size=3)
+        cache.clear()
+        self.assertEqual(cache.keys(), [])
+        self.assertEqual(cache.size, 0)
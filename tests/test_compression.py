@@ -0,0 +1,29 @@
+import zlib
+
+import unittest2
+
+from mod_genshi import compression
+
+
+def gunzip(data):
+    return zlib.decompress(data, compression.GZIP_WBITS)
+
+
+class TestCompression(unittest2.TestCase):
+
+    def test_body(self):
+        body = 'text ' * 100
+        compressed = compression.gzip_body(body)
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(gunzip(compressed), body)
+
+    def test_chunks(self):
+        chunks = ['<head></head>', '', '<body>' + 'x' * 100 + '</body>']
+        compressed = list(compression.gzip_chunks(chunks))
+        self.assertEqual(len(compressed), 3)
+        self.assertEqual(gunzip(''.join(compressed)), ''.join(chunks))
+
+    def test_chunks_flushed(self):
+        decompressor = zlib.decompressobj(compression.GZIP_WBITS)
+        first = next(compression.gzip_chunks(['<head></head>', 'rest']))
+        self.assertEqual(decompressor.decompress(first), '<head></head>')
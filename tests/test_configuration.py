@@ -0,0 +1,20 @@
+import os
+
+import unittest2
+
+from mod_genshi.configuration import Config
+
+
+class TestConfig(unittest2.TestCase):
+
+    def test_defaults(self):
+        config = Config('.')
+        self.assertEqual(config.base, os.path.abspath('.'))
+        self.assertFalse(config.stream)
+
+    def test_settings(self):
+        config = Config('.', stream=True)
+        self.assertTrue(config.stream)
+
+    def test_unknown_setting(self):
+        self.assertRaises(TypeError, Config, '.', unknown=True)
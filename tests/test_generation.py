@@ -0,0 +1,51 @@
+import threading
+
+import unittest2
+
+from mod_genshi.generation import Generation
+
+from tests.test_watcher import wait_for
+
+
+class TestGeneration(unittest2.TestCase):
+
+    def setUp(self):
+        self.generation = Generation()
+
+    def test_request(self):
+        with self.generation.request() as number:
+            self.assertEqual(number, 0)
+        with self.generation.advance():
+            pass
+        with self.generation.request() as number:
+            self.assertEqual(number, 1)
+
+    def test_advance_waits(self):
+        advanced = threading.Event()
+
+        def advance():
+            with self.generation.advance():
+                advanced.set()
+
+        self.generation.enter()
+        thread = threading.Thread(target=advance)
+        thread.start()
+        self.assertFalse(advanced.wait(0.1))
+        self.generation.leave()
+        thread.join()
+        self.assertTrue(advanced.is_set())
+        self.assertEqual(self.generation.number, 1)
+
+    def test_request_waits(self):
+        numbers = []
+
+        def request():
+            with self.generation.request() as number:
+                numbers.append(number)
+
+        with self.generation.advance():
+            thread = threading.Thread(target=request)
+            thread.start()
+            self.assertFalse(wait_for(lambda: numbers, 0.1))
+        thread.join()
+        self.assertEqual(numbers, [1])
@@ -1,9 +1,17 @@
+import ast
 import os
+import py_compile
+import shutil
 import sys
+import tempfile
+import types
 
 import unittest2
 
 from mod_genshi import importer
+from mod_genshi import watcher
+
+from tests.test_watcher import inotify_available, wait_for
 
 
 class TestImporter(unittest2.TestCase):
@@ -27,8 +35,29 @@ class TestImporter(unittest2.TestCase):
     def tearDown(self):
         self.importer.clear()
 
-    def test_sys_path(self):
-        self.assertIn(self.importer._token, sys.path)
+    def test_meta_path(self):
+        self.assertIn(self.importer, sys.meta_path)
+        self.assertEqual(self.importer.packages, frozenset(['package']))
+
+    def test_declined(self):
+        self.assertIsNone(self.importer.find_module('os'))
+        self.assertIsNone(self.importer.find_module('unknown.package'))
+
+    def test_packages(self):
+        finder = importer.ReloadingFinder(self.PACKAGE, packages=['other'])
+        self.assertIsNone(finder.find_module('package'))
+
+    def test_refresh(self):
+        os.utime(self.PACKAGE, (0, 0))
+        self.importer.refresh()
+        self.addCleanup(os.utime, self.PACKAGE, None)
+        with open(os.path.join(self.PACKAGE, 'added.py'), 'w'):
+            pass
+        self.addCleanup(os.remove, os.path.join(self.PACKAGE, 'added.py'))
+        self.assertNotIn('added', self.importer.packages)
+        os.utime(self.PACKAGE, (1, 1))
+        self.importer.refresh()
+        self.assertIn('added', self.importer.packages)
 
     def test_import(self):
         __import__('package')
@@ -58,3 +87,243 @@ class TestImporter(unittest2.TestCase):
 
     def test_unregister(self):
         importer.unregister('UNKNOWN PATH')
+
+    def test_dependents(self):
+        __import__('package.module')
+        self.importer._imports['package.module'] = set(['package'])
+        self.assertEqual(self.importer.dependents(['package']),
+                         set(['package', 'package.module']))
+        self.assertEqual(self.importer.dependents(['package.module']),
+                         set(['package.module']))
+
+    def test_reload_cached_code(self):
+        module = __import__('package.module', fromlist=['module'])
+        code = module.__loader__.bytecode.get(module.__file__).code
+        self.importer.unload(['package.module'])
+        module = __import__('package.module', fromlist=['module'])
+        self.assertIs(module.__loader__.bytecode.get(module.__file__).code,
+                      code)
+
+    def test_unload_stale_code(self):
+        module = __import__('package.module', fromlist=['module'])
+        pathname = module.__file__
+        self.assertIn(pathname, self.importer._bytecode._entries)
+        mtime = os.path.getmtime(pathname)
+        os.utime(pathname, (mtime + 1, mtime + 1))
+        self.addCleanup(os.utime, pathname, (mtime, mtime))
+        self.importer.unload(['package.module'])
+        self.assertNotIn(pathname, self.importer._bytecode._entries)
+
+    def test_listing(self):
+        listing = self.importer._listing(self.PACKAGE)
+        self.assertIn('package', listing)
+        self.assertIs(self.importer._listing(self.PACKAGE), listing)
+
+    def test_package_directory(self):
+        __import__('package.module')
+        os.utime(os.path.join(self.PACKAGE, 'package'), None)
+        self.assertFalse(self.importer.ismodified)
+
+    def test_runtime_imports(self):
+        __import__('package.module')
+        __import__('package.dynamic')
+        self.assertIn('package.module',
+                      self.importer._imports['package.dynamic'])
+
+    def test_mtimes(self):
+        mtimes = self.importer.mtimes(['package.other', 'package.missing',
+                                       'os'])
+        self.assertEqual(mtimes, {
+            'package': os.path.getmtime(
+                os.path.join(self.PACKAGE, 'package', '__init__.py')),
+            'package.other': os.path.getmtime(
+                os.path.join(self.PACKAGE, 'package', 'other.py'))})
+        self.assertNotIn('package.other', sys.modules)
+
+    def test_reload_package(self):
+        __import__('package.module')
+        os.utime(os.path.join(self.PACKAGE, 'package', '__init__.py'), None)
+        self.assertTrue(wait_for(lambda: self.importer.ismodified))
+        self.assertEqual(self.importer.reload_modified(),
+                         ['package', 'package.module'])
+        self.assertNotIn('package.module', sys.modules)
+        module = __import__('package.module', fromlist=['module'])
+        self.assertIs(sys.modules['package'].module, module)
+
+    def test_ordered(self):
+        self.importer._imports['a'] = set(['b'])
+        self.importer._imports['b'] = set(['c', 'd'])
+        self.addCleanup(self.importer.unload, ['a', 'b'])
+        self.assertEqual(self.importer.ordered(['a', 'b', 'c']),
+                         ['c', 'b', 'a'])
+
+    def test_builtin_import(self):
+        import __builtin__
+        self.assertIsInstance(__builtin__.__import__,
+                              types.BuiltinFunctionType)
+
+    def test_reload_modified(self):
+        __import__('package.dynamic')
+        __import__('package.other')
+        self.assertEqual(self.importer.reload_modified(), [])
+        os.utime(self.MODULE, None)
+        self.assertTrue(wait_for(lambda: self.importer.ismodified))
+        self.assertEqual(self.importer.reload_modified(),
+                         ['package.module', 'package.dynamic'])
+        self.assertNotIn('package.dynamic', sys.modules)
+        self.assertIn('package.other', sys.modules)
+        self.assertIn('package', sys.modules)
+
+    def test_unload(self):
+        __import__('package.module')
+        self.importer.unload(['package.module'])
+        self.assertNotIn('package.module', sys.modules)
+        self.assertIn('package', sys.modules)
+        self.assertNotIn('package.module', self.importer.loaded)
+
+    @unittest2.skipUnless(inotify_available(), "inotify is not available")
+    def test_rewatch(self):
+        __import__('package.module')
+        previous = self.importer._watcher
+        inotify = watcher.InotifyWatcher()
+        try:
+            self.importer.rewatch(inotify)
+            self.assertFalse(self.importer._polled)
+            os.utime(self.MODULE, None)
+            self.assertTrue(wait_for(lambda: self.importer.modified))
+        finally:
+            self.importer.rewatch(previous)
+            inotify.close()
+
+
+@unittest2.skipUnless(inotify_available(), "inotify is not available")
+class TestWatchedImporter(TestImporter):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.watcher = watcher.InotifyWatcher()
+        cls.importer = importer.register(cls.PACKAGE, cls.watcher)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.importer.clear()
+        importer.unregister(cls.PACKAGE)
+        cls.watcher.close()
+
+    def test_modified(self):
+        __import__('package.module')
+        self.assertFalse(self.importer._polled)
+        self.assertEqual(len(self.importer.modified), 0)
+        os.utime(self.MODULE, None)
+        self.assertTrue(wait_for(lambda: self.importer.modified))
+        del self.importer.modified
+        self.assertNotIn('package.module', sys.modules)
+
+
+class TestBytecodeCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.pathname = os.path.join(self.directory, 'module.py')
+        self.write('import os\nvalue = 1\n', 1000)
+        self.cache = importer.BytecodeCache()
+
+    def write(self, source, mtime):
+        with open(self.pathname, 'w') as fileobj:
+            fileobj.write(source)
+        os.utime(self.pathname, (mtime, mtime))
+
+    def run_code(self, code):
+        namespace = {}
+        exec code in namespace
+        return namespace['value']
+
+    def test_cached(self):
+        entry = self.cache.get(self.pathname)
+        self.assertEqual(entry.imports, set(['os']))
+        self.assertEqual(self.run_code(entry.code), 1)
+        self.assertIs(self.cache.get(self.pathname), entry)
+
+    def test_size_changed(self):
+        self.cache.get(self.pathname)
+        self.write('value = 22\n', 1000)
+        self.assertEqual(self.run_code(self.cache.get(self.pathname).code),
+                         22)
+
+    def test_stale_bytecode_file(self):
+        py_compile.compile(self.pathname)
+        self.write('value = 22\n', 1000)
+        self.assertEqual(self.run_code(self.cache.get(self.pathname).code),
+                         22)
+
+    def test_directory(self):
+        cachedir = os.path.join(self.directory, 'cache')
+        entry = importer.BytecodeCache(cachedir).get(self.pathname)
+        self.assertEqual(len(os.listdir(cachedir)), 1)
+        self.write('import re\nvalue = 2\n', 1000)
+        stored = importer.BytecodeCache(cachedir).get(self.pathname)
+        self.assertEqual(stored.imports, set(['os']))
+        self.assertEqual(self.run_code(stored.code), 1)
+        self.assertEqual(stored.code, entry.code)
+
+    def test_directory_stale(self):
+        cachedir = os.path.join(self.directory, 'cache')
+        importer.BytecodeCache(cachedir).get(self.pathname)
+        self.write('value = 22\n', 1000)
+        entry = importer.BytecodeCache(cachedir).get(self.pathname)
+        self.assertEqual(self.run_code(entry.code), 22)
+        entry = importer.BytecodeCache(cachedir).get(self.pathname)
+        self.assertEqual(self.run_code(entry.code), 22)
+
+    def test_directory_corrupt(self):
+        cachedir = os.path.join(self.directory, 'cache')
+        importer.BytecodeCache(cachedir).get(self.pathname)
+        for name in os.listdir(cachedir):
+            with open(os.path.join(cachedir, name), 'wb') as fileobj:
+                fileobj.write('corrupt')
+        entry = importer.BytecodeCache(cachedir).get(self.pathname)
+        self.assertEqual(self.run_code(entry.code), 1)
+
+    def test_directory_writable(self):
+        cachedir = os.path.join(self.directory, 'cache')
+        os.mkdir(cachedir)
+        os.chmod(cachedir, 0777)
+        self.assertRaises(ValueError, importer.BytecodeCache, cachedir)
+
+    def test_discard_stale(self):
+        self.cache.get(self.pathname)
+        self.cache.discard_stale(self.pathname)
+        self.assertIn(self.pathname, self.cache._entries)
+        os.remove(self.pathname)
+        self.cache.discard_stale(self.pathname)
+        self.assertNotIn(self.pathname, self.cache._entries)
+
+    def test_syntax_error(self):
+        self.write('value = (\n', 1000)
+        self.assertRaises(SyntaxError, self.cache.get, self.pathname)
+
+
+class TestFindImports(unittest2.TestCase):
+
+    def find(self, source, package=None):
+        return importer.find_imports(ast.parse(source), package)
+
+    def test_import(self):
+        self.assertEqual(self.find('import a.b'), set(['a', 'a.b']))
+
+    def test_from_import(self):
+        self.assertEqual(self.find('from a import b, c'),
+                         set(['a', 'a.b', 'a.c']))
+
+    def test_implicit_relative(self):
+        self.assertEqual(self.find('import b', 'a'), set(['b', 'a', 'a.b']))
+
+    def test_explicit_relative(self):
+        self.assertEqual(self.find('from .. import c', 'a.b'),
+                         set(['a', 'a.c']))
+        self.assertEqual(self.find('from .c import d', 'a.b'),
+                         set(['a', 'a.b', 'a.b.c', 'a.b.c.d']))
+
+    def test_star(self):
+        self.assertEqual(self.find('from a import *'), set(['a']))
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from mod_genshi.loader import Loader
+from mod_genshi import watcher
+
+from tests.test_watcher import inotify_available, wait_for
+
+LAYOUT = """<div xmlns:py="http://genshi.edgewall.org/">
+<?python
+import python.layout
+?>
+</div>"""
+
+PAGE = """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+<xi:include href="layout.html" />
+</html>"""
+
+OTHER = """<html xmlns:py="http://genshi.edgewall.org/">
+<py:if test="True"><?python
+from python import other
+?></py:if>
+</html>"""
+
+
+class TestLoader(unittest2.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        for name, content in (('layout.html', LAYOUT), ('page.html', PAGE),
+                              ('other.html', OTHER)):
+            with open(os.path.join(self.base, name), 'w') as template:
+                template.write(content)
+        self.loader = Loader(self.base, auto_reload=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def path(self, name):
+        return os.path.join(self.base, name)
+
+    def test_dependencies(self):
+        self.loader.load('page.html')
+        self.assertEqual(self.loader.dependencies(self.path('page.html')),
+                         set([self.path('layout.html')]))
+
+    def test_template_dependents(self):
+        self.loader.load('page.html')
+        self.loader.load('other.html')
+        affected = self.loader.dependents([self.path('layout.html')])
+        self.assertEqual(affected, set([self.path('layout.html'),
+                                        self.path('page.html')]))
+
+    def test_module_dependents(self):
+        self.loader.load('page.html')
+        self.loader.load('other.html')
+        affected = self.loader.dependents(modules=['python.layout'])
+        self.assertEqual(affected, set([self.path('layout.html'),
+                                        self.path('page.html')]))
+        affected = self.loader.dependents(modules=['python.other'])
+        self.assertEqual(affected, set([self.path('other.html')]))
+
+    def test_modified(self):
+        self.loader.load('page.html')
+        mtimes = self.loader.mtimes([self.path('layout.html')])
+        self.assertEqual(self.loader.modified(mtimes), [])
+        mtime = os.path.getmtime(self.path('layout.html')) + 1
+        os.utime(self.path('layout.html'), (mtime, mtime))
+        self.assertEqual(self.loader.modified(mtimes),
+                         [self.path('layout.html')])
+
+    def test_reload(self):
+        page = self.loader.load('page.html')
+        layout = self.loader.load('layout.html', relative_to=page.filepath)
+        mtime = os.path.getmtime(self.path('layout.html')) + 1
+        os.utime(self.path('layout.html'), (mtime, mtime))
+        self.assertIs(self.loader.load('page.html'), page)
+        self.assertIsNot(self.loader.load('layout.html'), layout)
+
+    @unittest2.skipUnless(inotify_available(), "inotify is not available")
+    def test_rewatch(self):
+        self.loader.load('page.html')
+        self.assertFalse(self.loader._watched)
+        inotify = watcher.InotifyWatcher()
+        try:
+            self.loader.rewatch(inotify)
+            self.assertIs(self.loader.watcher, inotify)
+            self.assertIn(self.path('layout.html'), self.loader._watched)
+            self.assertTrue(self.loader._isclean(self.path('layout.html')))
+            os.utime(self.path('layout.html'), None)
+            self.assertTrue(wait_for(
+                lambda: not self.loader._isclean(self.path('layout.html'))))
+        finally:
+            inotify.close()
+
+
+class TestCheckInterval(unittest2.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'page.html')
+        with open(self.path, 'w') as template:
+            template.write('<html />')
+        self.now = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def clock(self):
+        return self.now
+
+    def touch(self):
+        mtime = os.path.getmtime(self.path) + 1
+        os.utime(self.path, (mtime, mtime))
+
+    def test_interval(self):
+        loader = Loader(self.base, auto_reload=True, check_interval=1,
+                        clock=self.clock)
+        template = loader.load('page.html')
+        self.touch()
+        self.assertIs(loader.load('page.html'), template)
+        self.assertEqual(loader.modified(loader.mtimes([self.path])), [])
+        self.now = 1
+        self.assertIsNot(loader.load('page.html'), template)
+
+    def test_never(self):
+        loader = Loader(self.base, auto_reload=True, check_interval=None)
+        template = loader.load('page.html')
+        self.touch()
+        self.assertIs(loader.load('page.html'), template)
+        self.assertEqual(loader.modified(loader.mtimes([self.path])), [])
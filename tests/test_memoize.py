@@ -0,0 +1,223 @@
+import time
+
+from genshi.template import NewTextTemplate
+import unittest2
+
+from mod_genshi import generation
+from mod_genshi import memoize
+
+from tests.test_watcher import wait_for
+
+
+SOURCE = '''
+@memoized
+def square(value):
+    calls.append(value)
+    return value * value
+'''
+
+
+class TestMemoized(unittest2.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.calls = []
+
+    def memoized(self, **options):
+        def square(value):
+            self.calls.append(value)
+            return value * value
+        return memoize.Memoized(square, clock=lambda: self.now, **options)
+
+    def test_cached(self):
+        square = self.memoized()
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(value=3), 9)
+        self.assertEqual(self.calls, [3, 3])
+        self.assertEqual(square.stats, {'miss': 2, 'hit': 1})
+        self.assertEqual(square.__name__, 'square')
+
+    def test_unhashable(self):
+        square = memoize.Memoized(len)
+        self.assertEqual(square([1, 2]), 2)
+        self.assertEqual(square.stats, {'uncached': 1})
+
+    def test_ttl(self):
+        square = self.memoized(ttl=10)
+        square(2)
+        self.now += 9
+        square(2)
+        self.now += 1
+        square(2)
+        self.assertEqual(self.calls, [2, 2])
+
+    def test_entries(self):
+        square = self.memoized(entries=2)
+        for value in (1, 2, 3, 1):
+            square(value)
+        self.assertEqual(self.calls, [1, 2, 3, 1])
+
+    def test_stale(self):
+        square = self.memoized(ttl=10, stale=5)
+        square(2)
+        self.now += 12
+        self.assertEqual(square(2), 4)
+        self.assertTrue(wait_for(lambda: len(self.calls) == 2))
+        self.assertTrue(wait_for(lambda: not square._refreshing))
+        square(2)
+        self.assertEqual(square.stats, {'miss': 1, 'stale': 1, 'hit': 1})
+        self.now += 16
+        square(2)
+        self.assertEqual(square.stats['miss'], 2)
+
+    def test_stale_generation(self):
+        square = self.memoized(ttl=10, stale=5)
+        square.generation = generation.Generation()
+        square(2)
+        self.now += 12
+        with square.generation.advance():
+            square(2)
+            time.sleep(0.05)
+            self.assertEqual(self.calls, [2])
+        self.assertTrue(wait_for(lambda: len(self.calls) == 2))
+
+    def test_stale_cleared(self):
+        square = self.memoized(ttl=10, stale=5)
+        square.generation = generation.Generation()
+        square(2)
+        self.now += 12
+        with square.generation.advance():
+            square(2)
+            square.clear()
+        self.assertTrue(wait_for(lambda: not square._refreshing))
+        self.assertEqual(self.calls, [2])
+
+    def test_clear(self):
+        square = self.memoized()
+        square(2)
+        square.clear()
+        square(2)
+        self.assertEqual(self.calls, [2, 2])
+
+
+class TestRegistry(unittest2.TestCase):
+
+    def setUp(self):
+        self.registry = memoize.Registry()
+        self.calls = []
+
+    def define(self, source=SOURCE, filename='module.py'):
+        namespace = {'__name__': 'module', 'calls': self.calls,
+                     'memoized': self.register}
+        exec compile(source, filename, 'exec') in namespace
+        return namespace['square']
+
+    def register(self, function):
+        return self.registry.register(memoize.Memoized(function))
+
+    def test_same_code(self):
+        square = self.define()
+        square(2)
+        self.assertIs(self.define(), square)
+        square(2)
+        self.assertEqual(self.calls, [2])
+
+    def test_changed_code(self):
+        square = self.define()
+        square(2)
+        changed = self.define(SOURCE.replace('value * value', 'value ** 2'))
+        self.assertIsNot(changed, square)
+        changed(2)
+        self.assertEqual(self.calls, [2, 2])
+
+    def test_set_generation(self):
+        square = self.define()
+        requests = generation.Generation()
+        self.registry.set_generation(requests)
+        self.assertIs(square.generation, requests)
+        other = self.define(filename='other.py')
+        self.assertIs(other.generation, requests)
+
+    def test_invalidate_module(self):
+        square = self.define()
+        square(2)
+        self.registry.invalidate(modules=['other'])
+        self.assertIs(self.define(), square)
+        self.registry.invalidate(modules=['module'])
+        self.assertIsNot(self.define(), square)
+
+    def test_invalidate_filename(self):
+        square = self.define(filename='/templates/page.html')
+        self.registry.invalidate(filenames=['/templates/page.html'])
+        self.assertIsNot(self.define(filename='/templates/page.html'), square)
+
+    def test_collect(self):
+        square = self.define()
+        square(2)
+        square(2)
+        self.registry.invalidate(modules=['module'])
+        self.define()(2)
+        self.assertEqual(self.registry.collect(), [
+            ('mod_genshi_memoize_calls_total',
+             (('function', 'module.square'), ('result', 'hit')), 1),
+            ('mod_genshi_memoize_calls_total',
+             (('function', 'module.square'), ('result', 'miss')), 2),
+        ])
+
+    def test_template(self):
+        template = NewTextTemplate(
+            '{% python\n'
+            '    from mod_genshi.memoize import memoize\n'
+            '    def upper(text):\n'
+            '        calls.append(text)\n'
+            '        return text.upper()\n'
+            '    upper = memoize(upper)\n'
+            '%}${upper("a")}', filepath='/templates/upper.txt')
+        self.addCleanup(memoize.REGISTRY.invalidate,
+                        filenames=['/templates/upper.txt'])
+        for index in range(2):
+            self.assertEqual(template.generate(calls=self.calls).render(),
+                             'A')
+        self.assertEqual(self.calls, ['a'])
+
+    def test_decorator(self):
+        @memoize.memoize(ttl=60)
+        def double(value):
+            return value * 2
+        self.addCleanup(memoize.REGISTRY.invalidate, [__name__])
+        self.assertIsInstance(double, memoize.Memoized)
+        self.assertEqual(double.ttl, 60)
+        self.assertEqual(double(2), 4)
+
+    def test_closure(self):
+        def define(section):
+            def items():
+                self.calls.append(section)
+                return section.upper()
+            return self.register(items)
+        self.assertEqual(define('news')(), 'NEWS')
+        self.assertEqual(define('blog')(), 'BLOG')
+        self.assertEqual(define('blog')(), 'BLOG')
+        self.assertEqual(self.calls, ['news', 'blog'])
+
+    def test_globals(self):
+        square = self.define()
+        square(2)
+        self.calls = []
+        changed = self.define()
+        self.assertIsNot(changed, square)
+        changed(2)
+        self.assertEqual(self.calls, [2])
+
+    def test_recursive(self):
+        source = ('@memoized\n'
+                  'def factorial(value):\n'
+                  '    calls.append(value)\n'
+                  '    return value * factorial(value - 1) if value else 1\n'
+                  'square = factorial\n')
+        factorial = self.define(source)
+        self.assertEqual(factorial(3), 6)
+        self.assertIs(self.define(source), factorial)
+        self.assertEqual(factorial(3), 6)
+        self.assertEqual(self.calls, [3, 2, 1, 0])
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from mod_genshi.metrics import Metrics
+
+
+class TestMetrics(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.metrics = Metrics(self.directory, interval=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_counter(self):
+        labels = (('template', 'index.html'), ('status', 200))
+        self.metrics.inc('mod_genshi_requests_total', labels)
+        self.metrics.inc('mod_genshi_requests_total', labels)
+        self.metrics.inc('mod_genshi_reloads_total')
+        text = self.metrics.render()
+        self.assertIn('# TYPE mod_genshi_requests_total counter\n', text)
+        self.assertIn('mod_genshi_requests_total{template="index.html",'
+                      'status="200"} 2\n', text)
+        self.assertIn('mod_genshi_reloads_total 1\n', text)
+
+    def test_histogram(self):
+        labels = (('template', 'index.html'),)
+        for value in (0.001, 0.02, 20.0):
+            self.metrics.observe('mod_genshi_request_duration_seconds',
+                                 labels, value)
+        lines = self.metrics.render().splitlines()
+        self.assertIn('# TYPE mod_genshi_request_duration_seconds histogram',
+                      lines)
+        prefix = 'mod_genshi_request_duration_seconds_bucket{template=' \
+            '"index.html",le='
+        self.assertIn(prefix + '"0.005"} 1', lines)
+        self.assertIn(prefix + '"0.025"} 2', lines)
+        self.assertIn(prefix + '"10.0"} 2', lines)
+        self.assertIn(prefix + '"+Inf"} 3', lines)
+        self.assertIn('mod_genshi_request_duration_seconds_count'
+                      '{template="index.html"} 3', lines)
+        self.assertIn('mod_genshi_request_duration_seconds_sum'
+                      '{template="index.html"} 20.021', lines)
+
+    def test_escape(self):
+        self.metrics.inc('mod_genshi_requests_total',
+                         (('template', 'a"b\\c'), ('status', 200)))
+        self.assertIn('template="a\\"b\\\\c"', self.metrics.render())
+
+    def test_collectors(self):
+        self.metrics.collectors.append(
+            lambda: [('mod_genshi_template_loads_total',
+                      (('result', 'hit'),), 5)])
+        self.assertIn('mod_genshi_template_loads_total{result="hit"} 5',
+                      self.metrics.render())
+
+    def test_workers(self):
+        worker = Metrics(self.directory)
+        worker.inc('mod_genshi_reloads_total', value=2)
+        worker.observe('mod_genshi_request_duration_seconds', (), 0.5)
+        worker.publish()
+        os.rename(os.path.join(self.directory, '{0}.metrics'.format(
+            os.getpid())), os.path.join(self.directory, '1.metrics'))
+        self.metrics.inc('mod_genshi_reloads_total')
+        self.assertIn('mod_genshi_reloads_total 1\n', self.metrics.render())
+        self.metrics.after_fork()
+        self.metrics.inc('mod_genshi_reloads_total')
+        self.metrics.observe('mod_genshi_request_duration_seconds', (), 0.5)
+        text = self.metrics.render()
+        self.assertIn('mod_genshi_reloads_total 3\n', text)
+        self.assertIn('mod_genshi_request_duration_seconds_count 2\n', text)
+
+    def test_exited_workers(self):
+        self.metrics.after_fork()
+        worker = Metrics(self.directory)
+        worker.inc('mod_genshi_reloads_total', value=2)
+        worker.observe('mod_genshi_request_duration_seconds', (), 0.5)
+        worker.publish()
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        for exited in range(2):
+            os.rename(os.path.join(self.directory, '{0}.metrics'.format(
+                os.getpid())), os.path.join(self.directory,
+                                            '{0}.metrics'.format(pid)))
+            text = self.metrics.render()
+            self.assertIn('mod_genshi_reloads_total {0}\n'.format(
+                2 * (exited + 1)), text)
+            self.assertIn('mod_genshi_request_duration_seconds_count '
+                          '{0}\n'.format(exited + 1), text)
+            self.assertEqual(sorted(name for name in os.listdir(self.directory)
+                                    if name.endswith('.metrics')),
+                             ['exited.metrics'])
+            worker.publish()
+
+    def test_default_directory(self):
+        metrics = Metrics()
+        self.addCleanup(shutil.rmtree, metrics.directory)
+        self.assertEqual(os.stat(metrics.directory).st_mode & 0777, 0700)
+        self.assertNotEqual(Metrics().directory, metrics.directory)
@@ -0,0 +1,62 @@
+import os
+import pstats
+import shutil
+import tempfile
+
+import unittest2
+
+from mod_genshi.profiling import Profiler
+
+
+def work(count):
+    return sum(range(count))
+
+
+class TestProfiler(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_every(self):
+        profiler = Profiler(self.directory, every=3)
+        sampled = [profiler.sampled({}) for index in range(6)]
+        self.assertEqual(sampled, [False, False, True, False, False, True])
+        self.assertFalse(Profiler(self.directory).sampled({}))
+
+    def test_paths(self):
+        profiler = Profiler(self.directory, paths=('/slow/*',))
+        self.assertTrue(profiler.sampled({'PATH_INFO': '/slow/page.html'}))
+        self.assertFalse(profiler.sampled({'PATH_INFO': '/page.html'}))
+
+    def test_header(self):
+        profiler = Profiler(self.directory, header='X-Profile')
+        self.assertTrue(profiler.sampled({'HTTP_X_PROFILE': '1'}))
+        self.assertFalse(profiler.sampled({}))
+
+    def test_run(self):
+        profiler = Profiler(self.directory)
+        self.assertEqual(profiler.run('pages/index.html', work, 10), 45)
+        profiler.run('pages/index.html', work, 10)
+        pathname = profiler.filename('pages/index.html')
+        self.assertEqual(os.path.basename(pathname),
+                         'pages_index.html.{0}.pstats'.format(os.getpid()))
+        stats = pstats.Stats(pathname)
+        calls = [value[1] for key, value in stats.stats.items()
+                 if key[2] == 'work']
+        self.assertEqual(calls, [2])
+
+    def test_rotate(self):
+        profiler = Profiler(self.directory, max_bytes=1, backups=2)
+        for index in range(4):
+            profiler.run('index.html', work, 10)
+        pathname = profiler.filename('index.html')
+        self.assertTrue(os.path.exists(pathname + '.1'))
+        self.assertTrue(os.path.exists(pathname + '.2'))
+        self.assertFalse(os.path.exists(pathname + '.3'))
+        stats = pstats.Stats(pathname)
+        calls = [value[1] for key, value in stats.stats.items()
+                 if key[2] == 'work']
+        self.assertEqual(calls, [1])
@@ -1,8 +1,17 @@
 import os
+import shutil
 import sys
+import tempfile
+import threading
 
+import unittest2
+
+import mod_genshi.importer
+import mod_genshi.wsgi
 import mod_genshi.wsgitest
 
+from tests.test_watcher import inotify_available, wait_for
+
 
 class TestRequests(mod_genshi.wsgitest.TestWSGI):
 
@@ -87,3 +96,546 @@ class TestRequests(mod_genshi.wsgitest.TestWSGI):
         request = self.get_request(path)
         self.get_response(request)
         self.assertEqual(sys.modules['python.counter'].value, 1)
+
+
+class TestOutputCache(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+    PATH = 'templates/count.txt'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.APPLICATION.config.output_cache = True
+        cls.APPLICATION.config.output_cache_vary = ('Accept-Language',)
+
+    def setUp(self):
+        self.APPLICATION.pages.clear()
+
+    def render(self, url, **headers):
+        request = self.get_request(url)
+        request.headers.update(headers)
+        response = self.get_response(request)
+        self.assertEqual(response.status_int, 200)
+        return response
+
+    def test_cached(self):
+        first = self.render(self.PATH)
+        second = self.render(self.PATH)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.headers['Vary'], 'Accept-Language')
+
+    def test_query_string(self):
+        first = self.render(self.PATH + '?a')
+        second = self.render(self.PATH + '?b')
+        self.assertNotEqual(first.body, second.body)
+
+    def test_vary(self):
+        first = self.render(self.PATH, **{'Accept-Language': 'en'})
+        second = self.render(self.PATH, **{'Accept-Language': 'fr'})
+        self.assertNotEqual(first.body, second.body)
+
+    def test_path_ttl(self):
+        self.APPLICATION.config.output_cache_path_ttl = (('*/count.*', 0),)
+        try:
+            first = self.render(self.PATH)
+            second = self.render(self.PATH)
+        finally:
+            self.APPLICATION.config.output_cache_path_ttl = ()
+        self.assertNotEqual(first.body, second.body)
+
+    def test_template_modified(self):
+        first = self.render(self.PATH)
+        mtime = os.path.getmtime(os.path.join(self.BASE, self.PATH)) + 1
+        os.utime(os.path.join(self.BASE, self.PATH), (mtime, mtime))
+        second = self.render(self.PATH)
+        self.assertNotEqual(first.body, second.body)
+
+    def test_module_modified(self):
+        import python.counter
+        python.counter.value = 10
+        first = self.render(self.PATH)
+        os.utime('tests/app/python/counter.py', None)
+        second = self.render(self.PATH)
+        self.assertEqual(first.body.strip(), '11')
+        self.assertEqual(second.body.strip(), '1')
+
+    def test_streamed(self):
+        self.APPLICATION.config.stream = True
+        try:
+            first = self.render(self.PATH).body
+            second = self.render(self.PATH).body
+        finally:
+            self.APPLICATION.config.stream = False
+        self.assertEqual(first, second)
+
+    def test_include_modified(self):
+        path = 'templates/include.txt'
+        first = self.render(path)
+        self.assertEqual(first.body, self.render(path).body)
+        mtime = os.path.getmtime(os.path.join(self.BASE, self.PATH)) + 1
+        os.utime(os.path.join(self.BASE, self.PATH), (mtime, mtime))
+        second = self.render(path)
+        self.assertNotEqual(first.body, second.body)
+
+
+class TestCompression(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+    PATH = 'templates/hello_world.html'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.APPLICATION.config.compress = True
+        cls.APPLICATION.config.compress_min_bytes = 0
+
+    def setUp(self):
+        self.APPLICATION.pages.clear()
+
+    def tearDown(self):
+        self.APPLICATION.config.output_cache = False
+        self.APPLICATION.config.stream = False
+
+    def render(self, url, **headers):
+        request = self.get_request(url)
+        request.headers.update(headers)
+        response = self.get_response(request)
+        self.assertEqual(response.status_int, 200)
+        return response
+
+    def test_compressed(self):
+        plain = self.render(self.PATH)
+        self.assertIsNone(plain.content_encoding)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        response = self.render(self.PATH, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.content_length, len(response.body))
+        response.decode_content()
+        self.assertEqual(response.body, plain.body)
+
+    def test_min_bytes(self):
+        self.APPLICATION.config.compress_min_bytes = 1024 * 1024
+        try:
+            response = self.render(self.PATH, **{'Accept-Encoding': 'gzip'})
+        finally:
+            self.APPLICATION.config.compress_min_bytes = 0
+        self.assertIsNone(response.content_encoding)
+
+    def test_streamed(self):
+        self.APPLICATION.config.stream = True
+        response = self.render(self.PATH, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        response.decode_content()
+        self.assertIn('Hello', response.body)
+
+    def test_output_cache(self):
+        self.APPLICATION.config.output_cache = True
+        path = 'templates/count.txt'
+        first = self.render(path, **{'Accept-Encoding': 'gzip'})
+        second = self.render(path, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(second.content_encoding, 'gzip')
+        self.assertEqual(first.body, second.body)
+        plain = self.render(path)
+        self.assertIsNone(plain.content_encoding)
+        first.decode_content()
+        self.assertNotEqual(first.body, plain.body)
+
+
+class TestETag(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+    PATH = 'templates/counter.txt'
+
+    def tearDown(self):
+        self.APPLICATION.config.template_etag = None
+
+    def render(self, url, **headers):
+        request = self.get_request(url)
+        request.headers.update(headers)
+        return self.get_response(request)
+
+    def test_disabled(self):
+        self.assertNotIn('ETag', self.render(self.PATH).headers)
+
+    def test_content(self):
+        self.APPLICATION.config.template_etag = 'content'
+        path = 'templates/hello_world.html'
+        etag = self.render(path).headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        response = self.render(path, **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.body, '')
+        response = self.render(path, **{'If-None-Match': '"other"'})
+        self.assertEqual(response.status_int, 200)
+
+    def test_mtime(self):
+        import python.counter
+        self.APPLICATION.config.template_etag = 'mtime'
+        etag = self.render(self.PATH).headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        value = python.counter.value
+        response = self.render(self.PATH, **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(python.counter.value, value)
+        response = self.render(self.PATH + '?other',
+                               **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+
+    def test_mtime_template_modified(self):
+        self.APPLICATION.config.template_etag = 'mtime'
+        etag = self.render(self.PATH).headers['ETag']
+        mtime = os.path.getmtime(os.path.join(self.BASE, self.PATH)) + 1
+        os.utime(os.path.join(self.BASE, self.PATH), (mtime, mtime))
+        response = self.render(self.PATH, **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_mtime_include_modified(self):
+        self.APPLICATION.config.template_etag = 'mtime'
+        path = 'templates/include.txt'
+        etag = self.render(path).headers['ETag']
+        included = os.path.join(self.BASE, 'templates/count.txt')
+        mtime = os.path.getmtime(included) + 1
+        os.utime(included, (mtime, mtime))
+        response = self.render(path, **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        etag = response.headers['ETag']
+        response = self.render(path, **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+
+    def test_mtime_module_unloaded(self):
+        self.APPLICATION.config.template_etag = 'mtime'
+        self.render(self.PATH)
+        self.APPLICATION.importer.unload(['python.counter'])
+        etag = self.render(self.PATH).headers['ETag']
+        self.assertIn('python.counter', sys.modules)
+        response = self.render(self.PATH, **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+
+    def test_mtime_module_modified(self):
+        self.APPLICATION.config.template_etag = 'mtime'
+        etag = self.render(self.PATH).headers['ETag']
+        mtime = os.path.getmtime('tests/app/python/counter.py') + 1
+        os.utime('tests/app/python/counter.py', (mtime, mtime))
+        response = self.render(self.PATH, **{'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+class TestServerTiming(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.APPLICATION.config.server_timing = True
+
+    def test_template(self):
+        request = self.get_request('templates/hello_world.html')
+        response = self.get_response(request)
+        names = [item.split(';')[0]
+                 for item in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['route', 'reload', 'load', 'generate',
+                                 'render', 'total'])
+        timings = request.environ['mod_genshi.timings']
+        self.assertEqual([name for name, seconds in timings.phases],
+                         names[:-1])
+
+    def test_static(self):
+        request = self.get_request('static/logo.png')
+        response = self.get_response(request)
+        self.assertIn('route;dur=', response.headers['Server-Timing'])
+
+
+class TestMetrics(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.APPLICATION = mod_genshi.wsgi.WSGI(cls.BASE,
+                                               metrics_path='/metrics')
+
+    def test_metrics(self):
+        for path in ('templates/hello_world.html',
+                     'templates/hello_world.html',
+                     'templates/_does_not_exist_.html',
+                     'templates/invalid.html', 'static/logo.png'):
+            self.get_response(self.get_request(path))
+        response = self.get_response(self.get_request('/metrics'))
+        self.assertEqual(response.status_int, 200)
+        lines = response.body.splitlines()
+        self.assertIn('mod_genshi_requests_total{template="templates/'
+                      'hello_world.html",status="200"} 2', lines)
+        self.assertIn('mod_genshi_requests_total{template="",'
+                      'status="404"} 1', lines)
+        self.assertIn('mod_genshi_errors_total{status="500"} 1', lines)
+        self.assertIn('mod_genshi_request_duration_seconds_count{template='
+                      '"templates/hello_world.html"} 2', lines)
+        self.assertIn('mod_genshi_template_loads_total{result="hit"} 1',
+                      lines)
+        self.assertIn('mod_genshi_template_loads_total{result="miss"} 2',
+                      lines)
+
+
+    def metrics(self):
+        return self.get_response(self.get_request('/metrics')).body
+
+    def test_streamed(self):
+        line = 'mod_genshi_request_duration_seconds_count{template=' \
+            '"templates/counter.txt"} 1'
+        self.APPLICATION.config.stream = True
+        try:
+            environ = self.get_request('templates/counter.txt').environ
+            chunks = self.APPLICATION(environ, lambda *args: None)
+            self.assertNotIn(line, self.metrics().splitlines())
+            list(chunks)
+        finally:
+            self.APPLICATION.config.stream = False
+        self.assertIn(line, self.metrics().splitlines())
+
+    def test_streamed_error(self):
+        def dispatch(environ, start_response):
+            start_response('200 OK', [])
+            yield 'partial'
+            raise ValueError('rendering failed')
+        application = mod_genshi.wsgi.WSGI(self.BASE, metrics_path='/metrics')
+        application._dispatch = dispatch
+        environ = self.get_request('templates/hello_world.txt').environ
+        chunks = application(environ, lambda *args: None)
+        self.assertRaises(ValueError, list, chunks)
+        lines = application.metrics.render().splitlines()
+        self.assertIn('mod_genshi_requests_total{template="templates/'
+                      'hello_world.txt",status="500"} 1', lines)
+        self.assertNotIn('mod_genshi_requests_total{template="templates/'
+                         'hello_world.txt",status="200"} 1', lines)
+
+    def test_route_resolved_once(self):
+        request = self.get_request('templates/hello_world.txt')
+        self.get_response(request)
+        route = request.environ[mod_genshi.wsgi.ROUTE_KEY]
+        self.assertEqual(route.path, 'templates/hello_world.txt')
+
+
+class TestProfiling(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.PROFILE_DIR = tempfile.mkdtemp()
+        cls.APPLICATION = mod_genshi.wsgi.WSGI(cls.BASE,
+                                               profile_dir=cls.PROFILE_DIR,
+                                               profile_every=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.PROFILE_DIR)
+
+    def test_sampled(self):
+        path = 'templates/hello_world.html'
+        for index in range(4):
+            self.get_response(self.get_request(path))
+        pathname = self.APPLICATION.profiler.filename(path)
+        self.assertEqual(os.listdir(self.PROFILE_DIR),
+                         [os.path.basename(pathname)])
+
+
+class TestReloadInterval(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.APPLICATION = mod_genshi.wsgi.WSGI(cls.BASE,
+                                               reload_check_interval='never')
+
+    def test_never(self):
+        import python.counter
+        python.counter.value = 10
+        self.get_response(self.get_request('templates/counter.txt'))
+        os.utime('tests/app/python/counter.py', None)
+        self.get_response(self.get_request('templates/counter.txt'))
+        self.assertEqual(sys.modules['python.counter'].value, 12)
+
+
+class TestConcurrentReload(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+
+    def test_waits_for_requests(self):
+        self.get_response(self.get_request('templates/counter.txt'))
+        self.assertIn('python.counter', sys.modules)
+        reloaded = threading.Event()
+
+        def request():
+            self.get_response(self.get_request('templates/counter.txt'))
+            reloaded.set()
+
+        self.APPLICATION.generation.enter()
+        try:
+            os.utime('tests/app/python/counter.py', None)
+            thread = threading.Thread(target=request)
+            thread.start()
+            self.assertFalse(reloaded.wait(0.1))
+            self.assertIn('python.counter', sys.modules)
+        finally:
+            self.APPLICATION.generation.leave()
+        thread.join()
+        self.assertEqual(self.APPLICATION.generation.number, 1)
+
+    def test_streamed_holds_generation(self):
+        generation = self.APPLICATION.generation
+        self.APPLICATION.config.stream = True
+        try:
+            for close in (False, True):
+                environ = self.get_request('templates/counter.txt').environ
+                chunks = self.APPLICATION(environ, lambda *args: None)
+                self.assertEqual(generation._active, 1)
+                if close:
+                    next(iter(chunks))
+                    chunks.close()
+                else:
+                    list(chunks)
+                self.assertEqual(generation._active, 0)
+        finally:
+            self.APPLICATION.config.stream = False
+
+
+class TestFrozen(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.APPLICATION = mod_genshi.wsgi.WSGI(cls.BASE, frozen=True)
+
+    def test_precompiled(self):
+        cache = self.APPLICATION.loader._cache
+        self.assertIn('templates/hello_world.html', cache)
+        self.assertIn('templates/hello_world.txt', cache)
+        self.assertNotIn('templates/invalid.html', cache)
+
+    def test_preimported(self):
+        self.assertIn('python.counter', sys.modules)
+
+    def test_server_error(self):
+        response = self.get_response(self.get_request('templates/invalid.html'))
+        self.assertEqual(response.status_int, 500)
+
+    def test_no_reload(self):
+        import python.counter
+        python.counter.value = 10
+        os.utime('tests/app/python/counter.py', None)
+        self.get_response(self.get_request('templates/counter.txt'))
+        self.assertEqual(sys.modules['python.counter'].value, 11)
+
+
+class TestRoutes(unittest2.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'page.txt')
+
+    def tearDown(self):
+        mod_genshi.importer.unregister(os.path.abspath(self.base))
+        shutil.rmtree(self.base)
+
+    def application(self, **settings):
+        return mod_genshi.wsgi.WSGI(self.base, **settings)
+
+    def create(self):
+        with open(self.path, 'w') as template:
+            template.write('page')
+
+    def test_cached(self):
+        self.create()
+        app = self.application(reload_check_interval=60000)
+        route = app._route('/page.txt')
+        self.assertEqual(route.path, 'page.txt')
+        self.assertEqual(route.content_type, 'text/plain')
+        self.assertIsNone(route.error)
+        self.assertIs(app._route('/page.txt'), route)
+
+    def test_deleted_polled(self):
+        self.create()
+        app = self.application()
+        self.assertIsNone(app._route('/page.txt').error)
+        os.remove(self.path)
+        self.assertIsNotNone(app._route('/page.txt').error)
+
+    def test_deleted_interval(self):
+        self.create()
+        app = self.application(reload_check_interval=60000)
+        self.assertIsNone(app._route('/page.txt').error)
+        os.remove(self.path)
+        app.routes.clock = lambda: float('inf')
+        self.assertIsNotNone(app._route('/page.txt').error)
+
+    @unittest2.skipUnless(inotify_available(), "inotify is not available")
+    def test_deleted_watched(self):
+        self.create()
+        app = self.application(reload_watcher='inotify')
+        try:
+            self.assertIsNone(app._route('/page.txt').error)
+            self.assertIn('/page.txt', app.routes)
+            os.remove(self.path)
+            self.assertTrue(wait_for(lambda: '/page.txt' not in app.routes))
+            self.assertIsNotNone(app._route('/page.txt').error)
+        finally:
+            app.watcher.close()
+
+    def test_forbidden(self):
+        app = self.application()
+        route = app._route('/page.txt~')
+        self.assertIs(route.error, mod_genshi.wsgi.HTTPForbidden)
+        response = mod_genshi.wsgi.Request.blank('/page.txt~').get_response(app)
+        self.assertEqual(response.status_int, 403)
+
+    def test_escaping_not_watched(self):
+        app = self.application()
+        watched = []
+        app.watcher = type('Watcher', (object,), {
+            'watch': lambda self, path, callback: watched.append(path) or True
+        })()
+        route = app._route('/../../etc/page.txt')
+        self.assertIs(route.error, mod_genshi.wsgi.HTTPForbidden)
+        self.assertEqual(watched, [])
+        app._route('/sub/page.txt')
+        self.assertTrue(watched)
+        for path in watched:
+            self.assertTrue(path.startswith(os.path.abspath(self.base)))
+
+    def test_not_found(self):
+        app = self.application()
+        response = mod_genshi.wsgi.Request.blank('/page.txt').get_response(app)
+        self.assertEqual(response.status_int, 404)
+        self.assertEqual(len(app.loader._cache), 0)
+
+    def test_not_found_polled(self):
+        app = self.application()
+        self.assertIsNotNone(app._route('/page.txt').error)
+        self.assertNotIn('/page.txt', app.routes)
+        self.create()
+        self.assertIsNone(app._route('/page.txt').error)
+
+    def test_not_found_interval(self):
+        app = self.application(reload_check_interval=60000)
+        self.assertIsNotNone(app._route('/page.txt').error)
+        self.create()
+        self.assertIsNotNone(app._route('/page.txt').error)
+        app.routes.clock = lambda: float('inf')
+        self.assertIsNone(app._route('/page.txt').error)
+
+    @unittest2.skipUnless(inotify_available(), "inotify is not available")
+    def test_not_found_watched(self):
+        app = self.application(reload_watcher='inotify')
+        try:
+            self.assertIsNotNone(app._route('/page.txt').error)
+            self.assertIn('/page.txt', app.routes)
+            self.create()
+            self.assertTrue(wait_for(lambda: '/page.txt' not in app.routes))
+            self.assertIsNone(app._route('/page.txt').error)
+        finally:
+            app.watcher.close()
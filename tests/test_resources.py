@@ -0,0 +1,172 @@
+from StringIO import StringIO
+import sys
+import threading
+import time
+
+import unittest2
+
+from mod_genshi import resources
+
+
+MODULE = '''
+from mod_genshi import resources
+
+def create():
+    return object()
+
+resource = registry.declare('pool', create, closed.append)
+'''
+
+CHANGED = MODULE.replace('object()', 'list()')
+
+
+class TestResources(unittest2.TestCase):
+
+    def setUp(self):
+        self.registry = resources.Registry()
+        self.closed = []
+
+    def load(self, source):
+        namespace = {'__name__': 'module', 'registry': self.registry,
+                     'closed': self.closed}
+        exec compile(source, 'module.py', 'exec') in namespace
+        return namespace['resource']
+
+    def test_lazy(self):
+        created = []
+        resource = self.registry.declare('pool', lambda: created.append(1))
+        self.assertFalse(resource.created)
+        self.assertEqual(created, [])
+        resource.get()
+        resource.get()
+        self.assertEqual(created, [1])
+
+    def test_threads(self):
+        created = []
+
+        def create():
+            created.append(1)
+            time.sleep(0.01)
+            return object()
+
+        resource = self.registry.declare('pool', create)
+        values = []
+        threads = [threading.Thread(target=lambda: values.append(
+            resource.get())) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(created, [1])
+        self.assertEqual(len(set(map(id, values))), 1)
+
+    def test_reload(self):
+        value = self.load(MODULE).get()
+        self.assertIs(self.load(MODULE).get(), value)
+        self.assertEqual(self.closed, [])
+
+    def test_changed(self):
+        value = self.load(MODULE).get()
+        self.assertEqual(self.load(CHANGED).get(), [])
+        self.assertEqual(self.closed, [value])
+
+    def test_close(self):
+        first = self.registry.declare('first', object, self.closed.append)
+        second = self.registry.declare('second', object, self.closed.append)
+        self.registry.declare('unused', object, self.closed.append)
+        values = [first.get(), second.get()]
+        self.registry.close()
+        self.assertEqual(self.closed, values[::-1])
+        self.assertNotIn('first', self.registry)
+
+    def test_close_error(self):
+        def fail(value):
+            raise ValueError(value)
+        self.registry.declare('first', object, self.closed.append).get()
+        self.registry.declare('second', object, fail).get()
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.registry.close()
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertIn('Error closing resource second', output)
+        self.assertEqual(len(self.closed), 1)
+
+    def test_after_fork(self):
+        resource = self.registry.declare('pool', object, self.closed.append)
+        value = resource.get()
+        self.registry.after_fork()
+        self.assertFalse(resource.created)
+        self.assertIsNot(resource.get(), value)
+        self.assertEqual(self.closed, [])
+
+    def test_moved(self):
+        value = self.load(MODULE).get()
+        self.assertIs(self.load('\n\n' + MODULE).get(), value)
+
+    def test_changed_global(self):
+        source = MODULE.replace('object()', '[SIZE]')
+        value = self.load('SIZE = 1\n' + source).get()
+        self.assertIs(self.load('SIZE = 1\n' + source).get(), value)
+        self.assertEqual(self.load('SIZE = 2\n' + source).get(), [2])
+        self.assertEqual(self.closed, [value])
+
+    def test_changed_closure(self):
+        def declare(size):
+            return self.registry.declare('pool', lambda: [size])
+        value = declare(1).get()
+        self.assertIs(declare(1).get(), value)
+        self.assertEqual(declare(2).get(), [2])
+
+    def test_changed_helper(self):
+        source = MODULE.replace('object()', 'helper()')
+        helper = 'def helper():\n    return {0}\n'
+        value = self.load(helper.format(1) + source).get()
+        self.assertIs(self.load(helper.format(1) + source).get(), value)
+        self.assertEqual(self.load(helper.format(2) + source).get(), 2)
+
+    def test_class(self):
+        source = MODULE.replace('object()', '[Settings.dsn, Settings.size()]')
+        settings = ('class Settings(object):\n'
+                    '    dsn = {0!r}\n'
+                    '    @classmethod\n'
+                    '    def size(cls):\n'
+                    '        return 4\n')
+        value = self.load(settings.format('db') + source).get()
+        self.assertEqual(value, ['db', 4])
+        self.assertIs(self.load(settings.format('db') + source).get(), value)
+        self.assertEqual(self.load(settings.format('other') + source).get(),
+                         ['other', 4])
+        self.assertEqual(self.closed, [value])
+
+    def test_class_factory(self):
+        source = ('class Pool(list):\n'
+                  '    size = {0}\n'
+                  'resource = registry.declare("pool", Pool)\n')
+        value = self.load(source.format(1)).get()
+        self.assertIs(self.load(source.format(1)).get(), value)
+        self.assertIsNot(self.load(source.format(2)).get(), value)
+
+    def test_instance(self):
+        source = MODULE.replace('object()', '[settings.dsn]')
+        settings = ('class Settings(object):\n'
+                    '    def __init__(self, dsn):\n'
+                    '        self.dsn = dsn\n'
+                    'settings = Settings({0!r})\n')
+        value = self.load(settings.format('db') + source).get()
+        self.assertIs(self.load(settings.format('db') + source).get(), value)
+        self.assertEqual(self.load(settings.format('other') + source).get(),
+                         ['other'])
+
+    def test_partial(self):
+        source = ('import functools\n'
+                  'def create(dsn, size=1):\n'
+                  '    return [dsn, size]\n'
+                  'resource = registry.declare(\n'
+                  '    "pool", functools.partial(create, {0!r}, size={1}))\n')
+        value = self.load(source.format('db', 1)).get()
+        self.assertIs(self.load(source.format('db', 1)).get(), value)
+        self.assertEqual(self.load(source.format('db', 2)).get(), ['db', 2])
+        self.assertEqual(self.load(source.format('other', 2)).get(),
+                         ['other', 2])
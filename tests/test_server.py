@@ -1,7 +1,26 @@
-import unittest2
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+import os
+import signal
 import socket
+import tempfile
+import threading
+import time
+import urllib2
+
+import unittest2
+
+from tests.test_watcher import wait_for
 
 from mod_genshi.server import parse_command_line, open_browser_cmd
+from mod_genshi.server import PreforkServer, ThreadPoolWSGIServer
+from mod_genshi.server import RequestHandler
+from mod_genshi.static import FileWrapper
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
 
 
 class TestBrowserCommnd(unittest2.TestCase):
@@ -36,3 +55,155 @@ class TestBrowserCommnd(unittest2.TestCase):
         cmd = open_browser_cmd(opts)
         self.assertEqual(cmd.args, (self.URL,))
         self.assertEqual(cmd.keywords, {'new': 2, 'autoraise': True})
+
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+
+class TestPreforkServer(unittest2.TestCase):
+
+    def setUp(self):
+        httpd = make_server('127.0.0.1', 0, pid_app,
+                            handler_class=QuietHandler)
+        self.url = 'http://127.0.0.1:{0}/'.format(httpd.server_port)
+        self.master = os.fork()
+        if self.master == 0:
+            try:
+                PreforkServer(httpd, 2).serve_forever()
+            finally:
+                os._exit(0)
+        httpd.server_close()
+
+    def tearDown(self):
+        try:
+            os.kill(self.master, signal.SIGTERM)
+            os.waitpid(self.master, 0)
+        except OSError:
+            pass
+
+    def request(self):
+        return int(urllib2.urlopen(self.url, timeout=5).read())
+
+    def test_workers(self):
+        pids = set(self.request() for i in range(20))
+        self.assertNotIn(self.master, pids)
+        self.assertLessEqual(len(pids), 2)
+
+    def test_respawn(self):
+        worker = self.request()
+        os.kill(worker, signal.SIGKILL)
+        time.sleep(0.1)
+        for i in range(20):
+            self.assertNotEqual(self.request(), worker)
+
+    def test_shutdown(self):
+        worker = self.request()
+        os.kill(self.master, signal.SIGTERM)
+        pid, status = os.waitpid(self.master, 0)
+        self.assertEqual(status, 0)
+        self.assertRaises(OSError, os.kill, worker, 0)
+
+
+class TestThreadPoolWSGIServer(unittest2.TestCase):
+
+    def setUp(self):
+        self.waiting = []
+        self.release = threading.Event()
+        self.httpd = make_server('127.0.0.1', 0, self.blocking_app,
+                                 server_class=ThreadPoolWSGIServer,
+                                 handler_class=QuietHandler)
+        self.httpd.threads = 2
+        self.url = 'http://127.0.0.1:{0}/'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+
+    def blocking_app(self, environ, start_response):
+        self.waiting.append(threading.current_thread())
+        self.release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    def request(self, bodies):
+        bodies.append(urllib2.urlopen(self.url, timeout=5).read())
+
+    def test_concurrent(self):
+        bodies = []
+        clients = [threading.Thread(target=self.request, args=(bodies,))
+                   for index in range(2)]
+        for client in clients:
+            client.start()
+        self.assertTrue(wait_for(lambda: len(self.waiting) == 2))
+        self.assertNotEqual(self.waiting[0], self.waiting[1])
+        self.release.set()
+        for client in clients:
+            client.join()
+        self.assertEqual(bodies, ['done', 'done'])
+
+    def test_close(self):
+        self.release.set()
+        bodies = []
+        self.request(bodies)
+        self.assertEqual(len(self.httpd._pool), 2)
+        self.httpd.close_pool()
+        self.assertIsNone(self.httpd._pool)
+
+
+class QuietRequestHandler(RequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRequestHandler(unittest2.TestCase):
+
+    def setUp(self):
+        self.fileobj = tempfile.TemporaryFile()
+        self.fileobj.write('x' * 100000 + 'end')
+        self.fileobj.flush()
+        self.httpd = make_server('127.0.0.1', 0, self.file_app,
+                                 handler_class=QuietRequestHandler)
+        self.url = 'http://127.0.0.1:{0}/'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+
+    def file_app(self, environ, start_response):
+        self.assertIs(environ['wsgi.file_wrapper'], FileWrapper)
+        start_response('200 OK', [('Content-Length', '100001')])
+        return environ['wsgi.file_wrapper'](self.fileobj, offset=2,
+                                            length=100001)
+
+    def test_sendfile(self):
+        body = urllib2.urlopen(self.url, timeout=5).read()
+        self.assertEqual(len(body), 100001)
+        self.assertTrue(body.endswith('xend'))
+
+
+class TestCommandLine(unittest2.TestCase):
+
+    def test_defaults(self):
+        opts = parse_command_line([])
+        self.assertEqual(opts.threads, 0)
+        self.assertEqual(opts.workers, 0)
+        self.assertFalse(opts.frozen)
+
+    def test_workers(self):
+        opts = parse_command_line(['--workers', '4', '--threads', '8',
+                                   '--frozen'])
+        self.assertEqual(opts.threads, 8)
+        self.assertEqual(opts.workers, 4)
+        self.assertTrue(opts.frozen)
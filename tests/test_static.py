@@ -0,0 +1,223 @@
+import os
+import shutil
+import socket
+import tempfile
+
+import unittest2
+from webob import Request, Response
+
+from mod_genshi.static import StaticCache, FileWrapper, sendfile
+from mod_genshi.static import negotiate_encoding
+
+
+def fallback(environ, start_response):
+    return Response('fallback', status=404)(environ, start_response)
+
+
+class TestStaticCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'logo.png')
+        self.write('image')
+        self.now = 1000.0
+        self.app = StaticCache(self.base, fallback, 1024, 16,
+                               clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def write(self, content, mtime=None):
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(content)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def get(self, path='/logo.png', **kwargs):
+        return Request.blank(path, **kwargs).get_response(self.app)
+
+    def test_cached(self):
+        response = self.get()
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, 'image')
+        self.assertEqual(response.content_type, 'image/png')
+        self.assertEqual(response.content_length, 5)
+        self.assertIsNotNone(response.etag)
+        self.assertIsNotNone(response.last_modified)
+        self.assertIn(self.path, self.app.files)
+
+    def test_head(self):
+        response = self.get(method='HEAD')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_length, 5)
+        self.assertEqual(response.body, '')
+
+    def test_if_none_match(self):
+        etag = self.get().headers['ETag']
+        response = self.get(headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.get(headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.status_int, 200)
+
+    def test_if_modified_since(self):
+        modified = self.get().headers['Last-Modified']
+        response = self.get(headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_int, 304)
+        response = self.get(headers={
+            'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(response.status_int, 200)
+
+    def test_changed(self):
+        self.write('image', 1000)
+        self.get()
+        self.write('changed', 2000)
+        self.assertEqual(self.get().body, 'changed')
+
+    def test_check_interval(self):
+        self.app.check_interval = 10
+        self.write('image', 1000)
+        self.get()
+        self.write('changed', 2000)
+        self.assertEqual(self.get().body, 'image')
+        self.now += 10
+        self.assertEqual(self.get().body, 'changed')
+
+    def test_large_file(self):
+        self.write('x' * 17)
+        response = self.get()
+        self.assertEqual(response.body, 'x' * 17)
+        self.assertEqual(response.content_length, 17)
+        self.assertNotIn(self.path, self.app.files)
+        etag = response.headers['ETag']
+        response = self.get(headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+
+    def test_file_wrapper(self):
+        self.write('x' * 17)
+        response = self.get(environ={'wsgi.file_wrapper': FileWrapper},
+                            headers={'Range': 'bytes=2-5'})
+        self.assertIsInstance(response.app_iter, FileWrapper)
+        self.assertEqual(response.app_iter.offset, 2)
+        self.assertEqual(response.app_iter.length, 4)
+        self.assertEqual(response.body, 'xxxx')
+
+    def test_range(self):
+        for size in (5, 17):
+            self.write('abcdefghijklmnopq'[:size])
+            response = self.get(headers={'Range': 'bytes=1-3'})
+            self.assertEqual(response.status_int, 206)
+            self.assertEqual(response.body, 'bcd')
+            self.assertEqual(response.headers['Content-Range'],
+                             'bytes 1-3/{0}'.format(size))
+            response = self.get(headers={'Range': 'bytes=-2'})
+            self.assertEqual(response.body, 'abcdefghijklmnopq'[size - 2:size])
+            response = self.get(headers={'Range': 'bytes=3-'})
+            self.assertEqual(response.body, 'abcdefghijklmnopq'[3:size])
+
+    def test_range_not_satisfiable(self):
+        response = self.get(headers={'Range': 'bytes=10-20'})
+        self.assertEqual(response.status_int, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */5')
+
+    def test_range_ignored(self):
+        for header in ('bytes=0-1,3-4', 'bytes=3-1', 'lines=1-2'):
+            response = self.get(headers={'Range': header})
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.body, 'image')
+
+    def test_if_range(self):
+        etag = self.get().headers['ETag']
+        response = self.get(headers={'Range': 'bytes=1-2', 'If-Range': etag})
+        self.assertEqual(response.status_int, 206)
+        response = self.get(headers={'Range': 'bytes=1-2',
+                                     'If-Range': '"other"'})
+        self.assertEqual(response.status_int, 200)
+
+    def test_precompressed(self):
+        path = os.path.join(self.base, 'style.css')
+        for suffix, content in (('', 'body'), ('.gz', 'gz'), ('.br', 'br')):
+            with open(path + suffix, 'wb') as fileobj:
+                fileobj.write(content)
+        response = self.get('/style.css',
+                            headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.body, 'br')
+        self.assertEqual(response.content_type, 'text/css')
+        self.assertEqual(response.content_encoding, 'br')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        response = self.get('/style.css',
+                            headers={'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(response.body, 'gz')
+        self.assertEqual(response.content_encoding, 'gzip')
+        response = self.get('/style.css')
+        self.assertEqual(response.body, 'body')
+        self.assertIsNone(response.content_encoding)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Vary', self.get().headers)
+
+    def test_precompressed_cached(self):
+        path = os.path.join(self.base, 'style.css')
+        with open(path, 'wb') as fileobj:
+            fileobj.write('body')
+        self.app.check_interval = 10
+        self.get('/style.css', headers={'Accept-Encoding': 'gzip'})
+        with open(path + '.gz', 'wb') as fileobj:
+            fileobj.write('gz')
+        response = self.get('/style.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.body, 'body')
+        self.now += 10
+        response = self.get('/style.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.body, 'gz')
+
+    def test_precompressed_mtime(self):
+        path = os.path.join(self.base, 'style.css')
+        with open(path, 'wb') as fileobj:
+            fileobj.write('body')
+        os.utime(path, (1000, 1000))
+        self.get('/style.css', headers={'Accept-Encoding': 'gzip'})
+        with open(path + '.gz', 'wb') as fileobj:
+            fileobj.write('gz')
+        response = self.get('/style.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.body, 'body')
+        os.utime(path, (2000, 2000))
+        response = self.get('/style.css', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.body, 'gz')
+
+    def test_negotiate_encoding(self):
+        encodings = ('br', 'gzip')
+        def negotiate(header):
+            return negotiate_encoding({'HTTP_ACCEPT_ENCODING': header},
+                                      encodings)
+        self.assertEqual(negotiate('gzip, deflate, br'), 'br')
+        self.assertEqual(negotiate('GZIP'), 'gzip')
+        self.assertEqual(negotiate('br;q=0, gzip;q=0.5'), 'gzip')
+        self.assertEqual(negotiate('*'), 'br')
+        self.assertEqual(negotiate('*;q=0, gzip'), 'gzip')
+        self.assertIsNone(negotiate('identity'))
+        self.assertIsNone(negotiate_encoding({}, encodings))
+
+    def test_missing(self):
+        self.assertEqual(self.get('/missing.png').body, 'fallback')
+
+    def test_outside(self):
+        self.assertEqual(self.get('/../logo.png').body, 'fallback')
+
+    def test_post(self):
+        self.assertEqual(self.get(method='POST').body, 'fallback')
+
+
+class TestSendfile(unittest2.TestCase):
+
+    def test_sendfile(self):
+        fileobj = tempfile.TemporaryFile()
+        fileobj.write('abcdef')
+        fileobj.flush()
+        reader, writer = socket.socketpair()
+        try:
+            sent = sendfile(writer.fileno(), fileobj.fileno(), 2, 3)
+            self.assertEqual(sent, 3)
+            self.assertEqual(reader.recv(10), 'cde')
+        finally:
+            reader.close()
+            writer.close()
+            fileobj.close()
@@ -0,0 +1,74 @@
+import os
+
+import unittest2
+from genshi.template import MarkupTemplate, NewTextTemplate
+
+from mod_genshi import streaming
+import mod_genshi.wsgitest
+
+
+class TestChunks(unittest2.TestCase):
+
+    MARKUP = '<html><head><title>T</title></head><body>${"x" * 100}</body></html>'
+
+    def render(self, **kwargs):
+        stream = MarkupTemplate(self.MARKUP).generate()
+        return list(streaming.iter_chunks(stream, **kwargs))
+
+    def test_matches_render(self):
+        stream = MarkupTemplate(self.MARKUP).generate()
+        self.assertEqual(''.join(self.render()), stream.render())
+
+    def test_chunk_size(self):
+        chunks = self.render(size=16)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 16)
+
+    def test_flush(self):
+        chunks = self.render(flush=('</head>',))
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(chunks[0].endswith('</head>'))
+
+    def test_encoded(self):
+        stream = NewTextTemplate(u'\xe9').generate()
+        chunks = list(streaming.iter_chunks(stream))
+        self.assertEqual(chunks, ['\xc3\xa9'])
+
+    def test_prime_error(self):
+        def chunks():
+            raise ValueError
+            yield ''
+        self.assertRaises(ValueError, streaming.prime, chunks())
+
+    def test_prime_empty(self):
+        self.assertEqual(list(streaming.prime([])), [])
+
+
+class TestStreamingRequests(mod_genshi.wsgitest.TestWSGI):
+
+    BASE = 'tests/app'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.APPLICATION.config.stream = True
+        cls.APPLICATION.config.stream_chunk_size = 64
+
+    def test_streamed(self):
+        path = 'templates/hello_world.html'
+        with open(os.path.join(self.BASE, path), 'rt') as template:
+            content = template.read()
+        response = self.get_response(self.get_request(path))
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, content)
+
+    def test_chunks(self):
+        path = 'templates/listing.html'
+        response = self.get_response(self.get_request(path))
+        self.assertEqual(response.status_int, 200)
+        self.assertGreater(len(list(response.app_iter)), 1)
+
+    def test_server_error(self):
+        path = 'templates/invalid.html'
+        response = self.get_response(self.get_request(path))
+        self.assertEqual(response.status_int, 500)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import stat
+import tempfile
+
+import unittest2
+from genshi.template import MarkupTemplate, NewTextTemplate
+
+from mod_genshi.loader import Loader
+from mod_genshi import templatecache
+from mod_genshi.templatecache import TemplateCache
+
+PAGE = """<html xmlns:py="http://genshi.edgewall.org/">
+<?python
+def double(values):
+    return [value * 2 for value in values]
+?>
+<ul><li py:for="value in double(range(3))">${value}</li></ul>
+</html>"""
+
+
+class TestTemplateCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.base, 'cache')
+        self.path = os.path.join(self.base, 'page.html')
+        with open(self.path, 'w') as template:
+            template.write(PAGE)
+        self.cache = TemplateCache(self.cachedir)
+        self.loader = Loader(self.base, template_cache=self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def compile(self):
+        with open(self.path) as fileobj:
+            tmpl = MarkupTemplate(fileobj, filepath=self.path,
+                                  filename='page.html', loader=self.loader)
+        tmpl.stream
+        return tmpl
+
+    def entries(self):
+        return os.listdir(self.cachedir)
+
+    def test_round_trip(self):
+        tmpl = self.compile()
+        stat = os.stat(self.path)
+        self.assertTrue(self.cache.save(self.loader, tmpl, 'utf-8', stat))
+        cached = self.cache.load(self.loader, MarkupTemplate, self.path,
+                                 'utf-8', stat)
+        self.assertIsNotNone(cached)
+        self.assertIs(cached.loader, self.loader)
+        self.assertEqual(cached.generate().render(),
+                         tmpl.generate().render())
+
+    def test_missing(self):
+        stat = os.stat(self.path)
+        self.assertIsNone(self.cache.load(self.loader, MarkupTemplate,
+                                          self.path, 'utf-8', stat))
+
+    def test_stale(self):
+        self.cache.save(self.loader, self.compile(), 'utf-8',
+                        os.stat(self.path))
+        mtime = os.path.getmtime(self.path) + 1
+        os.utime(self.path, (mtime, mtime))
+        self.assertIsNone(self.cache.load(self.loader, MarkupTemplate,
+                                          self.path, 'utf-8',
+                                          os.stat(self.path)))
+
+    def test_class(self):
+        stat = os.stat(self.path)
+        self.cache.save(self.loader, self.compile(), 'utf-8', stat)
+        self.assertIsNone(self.cache.load(self.loader, NewTextTemplate,
+                                          self.path, 'utf-8', stat))
+
+    def test_corrupt(self):
+        stat = os.stat(self.path)
+        self.cache.save(self.loader, self.compile(), 'utf-8', stat)
+        for name in self.entries():
+            with open(os.path.join(self.cachedir, name), 'wb') as entry:
+                entry.write('corrupt')
+        self.assertIsNone(self.cache.load(self.loader, MarkupTemplate,
+                                          self.path, 'utf-8', stat))
+
+    def test_loader(self):
+        rendered = self.loader.load('page.html').generate().render()
+        self.assertEqual(len(self.entries()), 1)
+        loader = Loader(self.base, template_cache=self.cache)
+        cached = self.cache.load(loader, MarkupTemplate, self.path,
+                                 None, os.stat(self.path))
+        self.assertEqual(cached.generate().render(), rendered)
+
+    def test_loader_rebuild(self):
+        self.loader.load('page.html')
+        name = self.entries()[0]
+        with open(os.path.join(self.cachedir, name), 'wb') as entry:
+            entry.write('corrupt')
+        loader = Loader(self.base, template_cache=self.cache)
+        tmpl = loader.load('page.html')
+        self.assertIn('<li>4</li>', tmpl.generate().render())
+        self.assertEqual(self.entries(), [name])
+        self.assertIsNotNone(self.cache.load(loader, MarkupTemplate,
+                                             self.path, None,
+                                             os.stat(self.path)))
+
+    def test_permissions(self):
+        mode = os.stat(self.cachedir).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0700)
+
+    def test_shared_directory(self):
+        os.chmod(self.cachedir, 0777)
+        self.assertRaises(ValueError, TemplateCache, self.cachedir)
+
+    def test_recursive_function(self):
+        def outer():
+            def factorial(value):
+                return value * factorial(value - 1) if value else 1
+            return factorial
+        persistent_id = templatecache._persistent_id(self.loader)
+        persistent_load = templatecache._persistent_load(self.loader)
+        copy = persistent_load(persistent_id(outer()))
+        self.assertEqual(copy(4), 24)
+        self.assertIs(copy.func_closure[0].cell_contents, copy)
@@ -0,0 +1,37 @@
+import unittest2
+
+from mod_genshi import timing
+
+
+class TestTimings(unittest2.TestCase):
+
+    def setUp(self):
+        self.now = 1.0
+        self.timings = timing.Timings(clock=lambda: self.now)
+
+    def test_phase(self):
+        with self.timings.phase('load'):
+            self.now += 0.5
+        with self.timings.phase('render'):
+            self.now += 0.25
+        with self.timings.phase('load'):
+            self.now += 0.25
+        self.assertEqual(self.timings.phases,
+                         [['load', 0.75], ['render', 0.25]])
+        self.assertEqual(self.timings.header(),
+                         'load;dur=750.000, render;dur=250.000, '
+                         'total;dur=1000.000')
+
+    def test_start_response(self):
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started.append(headers)
+        headers = [('Content-Type', 'text/plain')]
+        self.timings.start_response(start_response)('200 OK', headers)
+        self.assertEqual(started[0][-1], ('Server-Timing', 'total;dur=0.000'))
+        self.assertEqual(len(headers), 1)
+
+    def test_null(self):
+        with timing.NULL.phase('load'):
+            pass
+        timing.NULL.add('load', 1.0)
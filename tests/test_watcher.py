@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import unittest2
+from genshi.template import NewTextTemplate
+
+from mod_genshi import watcher
+from mod_genshi.loader import Loader
+
+
+def inotify_available():
+    try:
+        watcher.InotifyWatcher().close()
+    except OSError:
+        return False
+    return True
+
+
+def wait_for(predicate, timeout=5.0):
+    event = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        event.wait(0.01)
+    return predicate()
+
+
+class TestCreate(unittest2.TestCase):
+
+    def test_poll(self):
+        self.assertIs(type(watcher.create('poll')), watcher.Watcher)
+
+    def test_auto(self):
+        instance = watcher.create('auto')
+        self.assertIsInstance(instance, watcher.Watcher)
+        instance.close()
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, watcher.create, 'unknown')
+
+    def test_polling(self):
+        self.assertFalse(watcher.Watcher().watch(__file__, None))
+
+
+@unittest2.skipUnless(inotify_available(), "inotify is not available")
+class TestInotifyWatcher(unittest2.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.path = os.path.join(self.base, 'file.txt')
+        open(self.path, 'w').close()
+        self.changed = set()
+        self.watcher = watcher.InotifyWatcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.base)
+
+    def test_modify(self):
+        self.assertTrue(self.watcher.watch(self.path, self.changed.add))
+        with open(self.path, 'w') as source:
+            source.write('changed')
+        self.assertTrue(wait_for(lambda: self.path in self.changed))
+
+    def test_attrib(self):
+        self.watcher.watch(self.path, self.changed.add)
+        os.utime(self.path, None)
+        self.assertTrue(wait_for(lambda: self.path in self.changed))
+
+    def test_unicode(self):
+        self.watcher.watch(unicode(self.path), self.changed.add)
+        os.utime(self.path, None)
+        self.assertTrue(wait_for(lambda: self.path in self.changed))
+
+    def test_rename(self):
+        self.watcher.watch(self.path, self.changed.add)
+        replacement = os.path.join(self.base, 'file.tmp')
+        open(replacement, 'w').close()
+        os.rename(replacement, self.path)
+        self.assertTrue(wait_for(lambda: self.path in self.changed))
+
+    def test_directory(self):
+        self.watcher.watch(self.base, self.changed.add)
+        open(os.path.join(self.base, 'new.txt'), 'w').close()
+        self.assertTrue(wait_for(lambda: self.base in self.changed))
+
+    def test_unwatched(self):
+        self.watcher.watch(self.path, self.changed.add)
+        os.utime(self.base, None)
+        other = os.path.join(self.base, 'other.txt')
+        open(other, 'w').close()
+        threading.Event().wait(0.1)
+        self.assertNotIn(other, self.changed)
+
+    def test_missing_directory(self):
+        path = os.path.join(self.base, 'missing', 'file.txt')
+        self.assertFalse(self.watcher.watch(path, self.changed.add))
+
+    def test_loader(self):
+        loader = Loader(self.base, auto_reload=True, watcher=self.watcher,
+                        default_class=NewTextTemplate)
+        template = loader.load('file.txt')
+        self.assertIs(loader.load('file.txt'), template)
+        os.utime(self.path, (1, 1))
+        self.assertTrue(wait_for(lambda: loader.load('file.txt')
+                                 is not template))
+
+
+class TestThrottle(unittest2.TestCase):
+
+    def setUp(self):
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def test_always(self):
+        throttle = watcher.Throttle(0)
+        self.assertTrue(throttle.ready())
+        self.assertTrue(throttle.ready())
+
+    def test_never(self):
+        self.assertFalse(watcher.Throttle(None).ready())
+
+    def test_interval(self):
+        throttle = watcher.Throttle(1, clock=self.clock)
+        self.assertTrue(throttle.ready())
+        self.assertFalse(throttle.ready())
+        self.now = 0.5
+        self.assertFalse(throttle.ready())
+        self.now = 1
+        self.assertTrue(throttle.ready())
+
+    def test_threads(self):
+        throttle = watcher.Throttle(60)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                   throttle.ready())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 1)
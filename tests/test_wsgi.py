@@ -75,6 +75,12 @@ class TestStyle(ModGenshiApp):
     def test_unknown(self):
         self.assertIs(self.get_style('file.xxx'), None)
 
+    def test_is_static(self):
+        is_static = self.APPLICATION.is_static
+        self.assertTrue(is_static({'PATH_INFO': '/static/logo.png'}))
+        self.assertFalse(is_static({'PATH_INFO': '/file.html'}))
+        self.assertFalse(is_static({'PATH_INFO': '/'}))
+
 
 class TestSecurity(ModGenshiApp):
 